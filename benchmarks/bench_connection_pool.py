@@ -0,0 +1,97 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+
+ Benchmark loading and then refreshing every domains capability
+ documents with and without pooled keep-alive connections, against
+ local stand-in HTTPS servers with injected latency. Reports the time
+ taken and the pool's connection reuse. Must be ran with the QGIS
+ python interpreter e.g.
+
+     python3 benchmarks/bench_connection_pool.py --domains 6 --latency 0.05
+"""
+
+import argparse
+import importlib
+
+from bench_load_services import (
+    SER_TYPES,
+    service_data,
+    service_feeds,
+    serving,
+    timed_load,
+)
+
+connection_pool = importlib.import_module("linz-data-importer.connection_pool")
+request_policy = importlib.import_module("linz-data-importer.request_policy")
+
+
+def load(domains, pool, max_workers):
+    """
+    Fetch all feeds, revalidating cached documents. Return the elapsed seconds
+    """
+
+    feeds = service_feeds(domains)
+    for feed in feeds:
+        feed.request_policy.opener = connection_pool.build_pooled_opener(
+            pool, request_policy.READ_TIMEOUT
+        )
+    return timed_load(feeds, max_workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[-1])
+    parser.add_argument("--domains", type=int, default=6)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--layers", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--refreshes", type=int, default=5)
+    args = parser.parse_args()
+
+    with serving(args.domains, args.latency, args.layers) as domains:
+        print(
+            "{0} domains x {1} services, {2}s latency, {3} refreshes".format(
+                args.domains, len(SER_TYPES), args.latency, args.refreshes
+            )
+        )
+        # no idle connections kept: every request opens a connection
+        for name, pool in (
+            ("unpooled", connection_pool.ConnectionPool(max_idle_per_host=0)),
+            ("pooled", connection_pool.ConnectionPool()),
+        ):
+            for domain in domains:
+                service_data.Localstore().store.delete(domain)
+            elapsed = sum(
+                load(domains, pool, args.workers) for _ in range(args.refreshes + 1)
+            )
+            stats = pool.stats()
+            pool.clear()
+            print(
+                "{0:<9} {1:8.3f}s requests={2} opened={3} resumed={4} "
+                "reused={5} reuse_rate={6:.0%}".format(
+                    name,
+                    elapsed,
+                    stats["requests"],
+                    stats["opened"],
+                    stats["resumed"],
+                    stats["reused"],
+                    stats["reuse_rate"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Benchmark loading every domains capability documents with a varying
+ number of worker threads, and optionally of processes the documents
+ are parsed in, against local stand-in servers with injected latency.
+ Must be ran with the QGIS python interpreter e.g.
+
+     python3 benchmarks/bench_load_services.py --domains 6 --latency 0.5
+"""
+
+import argparse
+import contextlib
+import importlib
+import os
+import sys
+import time
+
+from standin_server import standin_servers
+
+# The plugin is a package with a hyphenated name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+service_data = importlib.import_module("linz-data-importer.service_data")
+
+SER_TYPES = ["wmts", "wfs"]
+SERVICE_VERSIONS = {"wfs": "2.0.0", "wmts": "1.0.0"}
+
+
+class BenchApiKey:
+    """
+    Stand in for service_data.ApiKey. Avoids touching the users QSettings
+    """
+
+    @staticmethod
+    def get_api_key(domain):  # pylint:disable=unused-argument
+        return "benchmark"
+
+
+def service_feeds(domains):
+    """
+    Return a ServiceData instance per domain and service type
+    """
+
+    return [
+        service_data.ServiceData(domain, service, SERVICE_VERSIONS, BenchApiKey(), True)
+        for domain in domains
+        for service in SER_TYPES
+    ]
+
+
+def timed_load(feeds, max_workers, parse_processes=0):
+    """
+    Fetch, parse and format the feeds. Return the elapsed seconds
+    """
+
+    start = time.perf_counter()
+    service_data.process_services(feeds, max_workers, None, parse_processes)
+    elapsed = time.perf_counter() - start
+    for feed in feeds:
+        if feed.err:
+            raise RuntimeError(feed.err)
+    return elapsed
+
+
+def load(domains, max_workers, parse_processes=0):
+    """
+    Fetch, parse and format all feeds. Return the elapsed seconds
+    """
+
+    feeds = service_feeds(domains)
+    # rows stored by an earlier load would be used rather than parsing
+    for domain in domains:
+        feeds[0].store.delete(domain)
+    return timed_load(feeds, max_workers, parse_processes)
+
+
+@contextlib.contextmanager
+def serving(count, latency, layers):
+    """
+    Run count stand-in servers and yield their domains. The
+    domains' cached docs are deleted once the servers stop
+    """
+
+    cert_dir, servers = standin_servers(count, latency, layers)
+    domains = [server.domain for server in servers]
+    try:
+        for server in servers:
+            server.__enter__()
+        yield domains
+    finally:
+        for server in servers:
+            server.__exit__()
+        local_store = service_data.Localstore()
+        for domain in domains:
+            local_store.del_domains_xml(domain)
+        cert_dir.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[-1])
+    parser.add_argument("--domains", type=int, default=6)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--layers", type=int, default=500)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--processes",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="parse processes. 0 parses in the worker threads",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with serving(args.domains, args.latency, args.layers) as domains:
+        print(
+            "{0} domains x {1} services, {2}s latency, {3} layers per feed".format(
+                args.domains, len(SER_TYPES), args.latency, args.layers
+            )
+        )
+        for max_workers in args.workers:
+            for processes in args.processes:
+                best = min(
+                    load(domains, max_workers, processes) for _ in range(args.repeat)
+                )
+                print(
+                    "max_workers={0:<3} parse_processes={1:<3} {2:8.3f}s".format(
+                        max_workers, processes, best
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Benchmark parse time and peak RSS of turning a synthetic capabilities
+ document into table rows. Each parser runs in its own process so peak
+ RSS is not shared. Must be ran with the QGIS python interpreter e.g.
+
+     python3 benchmarks/bench_parse_capabilities.py --layers 10000 --service wfs
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_capabilities import wfs_capabilities, wmts_capabilities
+
+# The plugin is a package with a hyphenated name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+SERVICE_VERSIONS = {"wfs": "2.0.0", "wmts": "1.0.0"}
+DOMAIN = "data.linz.govt.nz"
+PARSERS = ["owslib", "stream-bytes", "stream-file"]
+
+
+def parse(parser, service, file):
+    """
+    Parse file with parser. Return the number of rows
+    """
+
+    service_data = importlib.import_module("linz-data-importer.service_data")
+    extractor = service_data.STREAM_EXTRACTORS[service]
+    if parser == "stream-file":
+        with open(file, "rb") as file_pointer:
+            return len(extractor(file_pointer, DOMAIN))
+
+    with open(file, "rb") as file_pointer:
+        xml = file_pointer.read()
+    if parser == "stream-bytes":
+        return len(extractor(io.BytesIO(xml), DOMAIN))
+
+    feed = service_data.ServiceData(DOMAIN, service, SERVICE_VERSIONS, None)
+    feed.xml = xml
+    feed.get_service_obj()
+    feed.format_for_ui()
+    return len(feed.info)
+
+
+def child(parser, service, file):
+    """
+    Runs in a sub process. Print the results as JSON
+    """
+
+    importlib.import_module("linz-data-importer.service_data")
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    rows = parse(parser, service, file)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"rows": rows, "seconds": elapsed, "rss_kb": peak - baseline}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[-1])
+    parser.add_argument("--layers", type=int, default=10000)
+    parser.add_argument("--service", choices=["wfs", "wmts"], default="wfs")
+    parser.add_argument("--tile-matrices", type=int, default=25)
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "capabilities.xml")
+        with open(file, "wb") as file_pointer:
+            if args.service == "wfs":
+                file_pointer.write(wfs_capabilities(DOMAIN, args.layers))
+            else:
+                file_pointer.write(wmts_capabilities(args.layers, args.tile_matrices))
+        print(
+            "{0} {1} layers, {2:.1f} MB".format(
+                args.layers, args.service.upper(), os.path.getsize(file) / 1024**2
+            )
+        )
+        for name in PARSERS:
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", name, args.service, file],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                "{0:<13} {1:>6} rows {2:8.3f}s  peak RSS +{3:7.1f} MB".format(
+                    name, result["rows"], result["seconds"], result["rss_kb"] / 1024
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
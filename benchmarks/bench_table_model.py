@@ -0,0 +1,241 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Benchmark the table model on a large catalogue. Reports the memory
+ held per row, the time to sort the table by each column and to paint
+ a screen of cells, and to refresh the catalogue with a few changed
+ layers. --legacy compares the previous model, which held the JSON
+ decoded rows and was sorted by the proxy. Must be ran with the QGIS
+ python interpreter e.g.
+
+     python3 benchmarks/bench_table_model.py --rows 50000 --legacy
+"""
+
+import argparse
+import copy
+import gc
+import importlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from bench_filter_table import synthetic_rows
+
+# The plugin is a package with a hyphenated name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+HEADERS = ["domain", "type", "service", "id", "layer name", "_desc", "_crs"]
+# rows of cells painted per screen
+SCREEN_ROWS = 40
+
+
+def legacy_table_model():
+    """
+    Return the class of the table model before rows were stored by column
+    """
+
+    # pylint:disable=import-outside-toplevel
+    from qgis.PyQt.QtCore import QAbstractTableModel, Qt  # pylint:disable=import-error
+
+    search_index = importlib.import_module("linz-data-importer.search_index")
+
+    class LegacyTableModel(QAbstractTableModel):
+        """
+        Holds the rows as decoded and formats cells as they are painted
+        """
+
+        def __init__(self, data):
+            QAbstractTableModel.__init__(self)
+            self.arraydata = data
+            self.search_index = search_index.SearchIndex(data)
+
+        def rowCount(self, parent=None):  # pylint:disable=invalid-name,unused-argument
+            return len(self.arraydata)
+
+        def columnCount(
+            self, parent=None
+        ):  # pylint:disable=invalid-name,unused-argument
+            return len(HEADERS) - 2
+
+        def data(self, index, role):
+            if not index.isValid() or role != Qt.DisplayRole:
+                return None
+            return str(self.arraydata[index.row()][index.column()])
+
+    return LegacyTableModel
+
+
+def decoded_rows(rows):
+    """
+    Return the rows as the plugin decodes them from its JSON cache
+    """
+
+    return json.loads(json.dumps(rows))
+
+
+def model_memory(rows, build_model):
+    """
+    Return the bytes per row held by the model build_model returns
+    """
+
+    encoded = json.dumps(rows)
+    gc.collect()
+    tracemalloc.start()
+    model = build_model(json.loads(encoded))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del model
+    return size / len(rows)
+
+
+def proxy_model(rows, legacy):
+    """
+    Return a sorting proxy model over a model of rows
+    """
+
+    # pylint:disable=import-outside-toplevel
+    from qgis.PyQt.QtCore import QSortFilterProxyModel  # pylint:disable=import-error
+
+    if legacy:
+        model = legacy_table_model()(rows)
+        proxy = QSortFilterProxyModel()
+    else:
+        tablemodel = importlib.import_module("linz-data-importer.tablemodel")
+        plugin = importlib.import_module("linz-data-importer.linz_data_importer")
+        model = tablemodel.TableModel(rows, HEADERS)
+        proxy = plugin.CustomSortFilterProxyModel()
+    proxy.setSourceModel(model)
+    # the proxy maps rows lazily. Force the mapping as a view would
+    proxy.rowCount()
+    return model, proxy
+
+
+def time_sorts(proxy):
+    """
+    Return the milliseconds to sort the proxy by each column, in order
+    """
+
+    # pylint:disable=import-outside-toplevel
+    from qgis.PyQt.QtCore import Qt  # pylint:disable=import-error
+
+    times = []
+    for column in range(proxy.columnCount()):
+        for order in (Qt.AscendingOrder, Qt.DescendingOrder):
+            start = time.perf_counter()
+            proxy.sort(column, order)
+            proxy.rowCount()
+            times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def time_paint(proxy):
+    """
+    Return the milliseconds to fetch the display text of a screen of cells
+    """
+
+    # pylint:disable=import-outside-toplevel
+    from qgis.PyQt.QtCore import Qt  # pylint:disable=import-error
+
+    start = time.perf_counter()
+    for row in range(SCREEN_ROWS):
+        for column in range(proxy.columnCount()):
+            proxy.data(proxy.index(row, column), Qt.DisplayRole)
+    return (time.perf_counter() - start) * 1000
+
+
+def refreshed_rows(rows):
+    """
+    Return the rows as refreshed with a layer renamed, one removed and one added
+    """
+
+    rows = copy.deepcopy(rows)
+    rows[len(rows) // 3][4] = "Renamed Parcels"
+    del rows[len(rows) // 2]
+    rows.insert(5, ["data.linz.govt.nz", "layer", "WFS", "99999", "Lakes", "", []])
+    return rows
+
+
+def time_refresh(rows):
+    """
+    Return the milliseconds to refresh the sorted table with the rows
+    matched to the table's rows, the number of rows signalled, and the
+    milliseconds to replace all rows
+    """
+
+    search_index = importlib.import_module("linz-data-importer.search_index")
+    refreshed = refreshed_rows(rows)
+    segments = [search_index.TokenSegment.from_rows(refreshed)]
+    times = []
+    signalled = []
+    for method in ("setData", "replace_rows"):
+        model, proxy = proxy_model(decoded_rows(rows), False)
+        proxy.sort(3)
+        proxy.rowCount()
+        for signal in (model.rowsInserted, model.rowsRemoved):
+            signal.connect(
+                lambda _parent, first, last: signalled.append(last - first + 1)
+            )
+        model.dataChanged.connect(
+            lambda top, bottom: signalled.append(bottom.row() - top.row() + 1)
+        )
+        start = time.perf_counter()
+        getattr(model, method)(refreshed, segments)
+        proxy.rowCount()
+        times.append((time.perf_counter() - start) * 1000)
+    return times[0], sum(signalled), times[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[-1])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--legacy", action="store_true")
+    args = parser.parse_args()
+
+    # pylint:disable=import-outside-toplevel
+    from qgis.PyQt.QtWidgets import QApplication  # pylint:disable=import-error
+
+    app = QApplication.instance() or QApplication([])  # pylint:disable=unused-variable
+    rows = synthetic_rows(args.rows)
+    tablemodel = importlib.import_module("linz-data-importer.tablemodel")
+    runs = [("model", False)]
+    if args.legacy:
+        runs.append(("legacy model", True))
+    for name, legacy in runs:
+        if legacy:
+            memory = model_memory(rows, legacy_table_model())
+        else:
+            memory = model_memory(
+                rows, lambda data: tablemodel.TableModel(data, HEADERS)
+            )
+        _model, proxy = proxy_model(decoded_rows(rows), legacy)
+        sorts = time_sorts(proxy)
+        print(
+            "{0:<13} {1:7.0f} bytes/row  sort max {2:7.1f} ms  mean {3:7.1f} ms"
+            "  paint {4:5.2f} ms".format(
+                name, memory, max(sorts), sum(sorts) / len(sorts), time_paint(proxy)
+            )
+        )
+    print(
+        "refresh       {0:7.1f} ms  {1} rows signalled  "
+        "(replacing all rows {2:.1f} ms)".format(*time_refresh(rows))
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Local HTTPS stand-in for the data portals. Serves synthetic capability
+ documents with an injected per request latency.
+"""
+
+import gzip
+import hashlib
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from synthetic_capabilities import wfs_capabilities, wmts_capabilities
+
+
+def self_signed_cert(directory):
+    """
+    Create a self signed certificate for localhost and trust it for
+    all ssl default contexts created by this process
+
+    @return: (certificate file, key file)
+    @rtype: tuple
+    """
+
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost,IP:127.0.0.1",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    os.environ["SSL_CERT_FILE"] = cert
+    return cert, key
+
+
+class CapabilitiesHandler(BaseHTTPRequestHandler):
+    """
+    Serve the servers WFS or WMTS document depending on the request path
+    """
+
+    protocol_version = "HTTP/1.1"  # keep connections open, as the portals do
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        time.sleep(self.server.latency)
+        if "/wmts/" in self.path:
+            body = self.server.documents["wmts"]
+        else:
+            body = self.server.documents["wfs"]
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "text/xml")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint:disable=arguments-differ
+        pass
+
+
+class StandinServer:
+    """
+    A HTTPS server on localhost impersonating a single data portal domain
+    """
+
+    def __init__(self, cert, latency=0.0, layers=500):
+        """
+        :param cert: (certificate file, key file)
+        :type cert: tuple
+        :param latency: seconds to wait before responding to each request
+        :type latency: float
+        :param layers: number of layers in each capability document
+        :type layers: int
+        """
+
+        self.httpd = ThreadingHTTPServer(("localhost", 0), CapabilitiesHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*cert)
+        self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.httpd.latency = latency
+        self.domain = "localhost:{0}".format(self.httpd.server_address[1])
+        self.httpd.documents = {
+            "wfs": wfs_capabilities(self.domain, layers),
+            "wmts": wmts_capabilities(layers),
+        }
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def standin_servers(count, latency, layers=500):
+    """
+    Return a temp dir and a list of count stand-in servers. The temp dir
+    holds the servers certificate and must outlive them.
+    """
+
+    directory = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+    cert = self_signed_cert(directory.name)
+    return directory, [StandinServer(cert, latency, layers) for _ in range(count)]
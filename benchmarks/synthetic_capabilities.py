@@ -0,0 +1,161 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Build synthetic WFS / WMTS capability documents shaped like those
+ served by the Koordinates based data portals.
+"""
+
+ABSTRACT = (
+    "Synthetic dataset {0} generated for benchmarking. Lorem ipsum dolor sit "
+    "amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut "
+    "labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
+    "exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat."
+)
+
+WFS_CRS = ["2193", "4326", "3857", "4167", "3793"]
+
+
+def wfs_capabilities(domain, layers):
+    """
+    Return a WFS 2.0.0 GetCapabilities document
+
+    :param domain: Service Domain (e.g. data.linz.govt.nz)
+    :type domain: str
+    :param layers: Number of FeatureTypes in the document
+    :type layers: int
+    @return: capabilities document
+    @rtype: bytes
+    """
+
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<wfs:WFS_Capabilities version="2.0.0" '
+        'xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+        'xmlns:ows="http://www.opengis.net/ows/1.1" '
+        'xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+        "<ows:ServiceIdentification>"
+        "<ows:Title>Synthetic Data Service</ows:Title>"
+        "<ows:ServiceType>WFS</ows:ServiceType>"
+        "<ows:ServiceTypeVersion>2.0.0</ows:ServiceTypeVersion>"
+        "</ows:ServiceIdentification>\n"
+        "<ows:OperationsMetadata>"
+        '<ows:Operation name="GetFeature"><ows:DCP><ows:HTTP>'
+        '<ows:Get xlink:href="https://{0}/services/wfs"/>'
+        "</ows:HTTP></ows:DCP></ows:Operation>"
+        "</ows:OperationsMetadata>\n"
+        "<wfs:FeatureTypeList>\n".format(domain)
+    ]
+    for layer in range(layers):
+        object_type = "table" if layer % 10 == 9 else "layer"
+        object_id = 50000 + layer
+        crs = (
+            ""
+            if object_type == "table"
+            else "".join(
+                "<wfs:{0}>urn:ogc:def:crs:EPSG::{1}</wfs:{0}>".format(
+                    "DefaultCRS" if i == 0 else "OtherCRS", code
+                )
+                for i, code in enumerate(WFS_CRS)
+            )
+        )
+        parts.append(
+            "<wfs:FeatureType>"
+            "<wfs:Name>{0}:{1}-{2}</wfs:Name>"
+            "<wfs:Title>Synthetic {1} {2}</wfs:Title>"
+            "<wfs:Abstract>{3}</wfs:Abstract>"
+            "<ows:Keywords><ows:Keyword>synthetic</ows:Keyword></ows:Keywords>"
+            "{4}"
+            "<ows:WGS84BoundingBox>"
+            "<ows:LowerCorner>166.0 -48.0</ows:LowerCorner>"
+            "<ows:UpperCorner>179.0 -34.0</ows:UpperCorner>"
+            "</ows:WGS84BoundingBox>"
+            "</wfs:FeatureType>\n".format(
+                domain, object_type, object_id, ABSTRACT.format(object_id), crs
+            )
+        )
+    parts.append("</wfs:FeatureTypeList>\n</wfs:WFS_Capabilities>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def wmts_capabilities(layers, tile_matrices=20, tile_matrix_sets=("2193", "3857")):
+    """
+    Return a WMTS 1.0.0 GetCapabilities document
+
+    :param layers: Number of Layers in the document
+    :type layers: int
+    :param tile_matrices: Number of TileMatrix per TileMatrixSet
+    :type tile_matrices: int
+    :param tile_matrix_sets: EPSG codes of the TileMatrixSets
+    :type tile_matrix_sets: tuple
+    @return: capabilities document
+    @rtype: bytes
+    """
+
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<Capabilities xmlns="http://www.opengis.net/wmts/1.0" '
+        'xmlns:ows="http://www.opengis.net/ows/1.1" '
+        'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">\n'
+        "<ows:ServiceIdentification>"
+        "<ows:Title>Synthetic Data Service</ows:Title>"
+        "<ows:ServiceType>OGC WMTS</ows:ServiceType>"
+        "<ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>"
+        "</ows:ServiceIdentification>\n"
+        "<Contents>\n"
+    ]
+    links = "".join(
+        "<TileMatrixSetLink><TileMatrixSet>EPSG:{0}</TileMatrixSet>"
+        "</TileMatrixSetLink>".format(code)
+        for code in tile_matrix_sets
+    )
+    for layer in range(layers):
+        object_id = 50000 + layer
+        parts.append(
+            "<Layer>"
+            "<ows:Title>Synthetic layer {0}</ows:Title>"
+            "<ows:Abstract>{1}</ows:Abstract>"
+            "<ows:Identifier>layer-{0}</ows:Identifier>"
+            "<ows:WGS84BoundingBox>"
+            "<ows:LowerCorner>166.0 -48.0</ows:LowerCorner>"
+            "<ows:UpperCorner>179.0 -34.0</ows:UpperCorner>"
+            "</ows:WGS84BoundingBox>"
+            '<Style isDefault="true"><ows:Identifier>style=auto</ows:Identifier>'
+            "</Style>"
+            "<Format>image/png</Format>"
+            "{2}"
+            "</Layer>\n".format(object_id, ABSTRACT.format(object_id), links)
+        )
+    for code in tile_matrix_sets:
+        parts.append(
+            "<TileMatrixSet>"
+            "<ows:Identifier>EPSG:{0}</ows:Identifier>"
+            "<ows:SupportedCRS>urn:ogc:def:crs:EPSG::{0}</ows:SupportedCRS>".format(
+                code
+            )
+        )
+        for matrix in range(tile_matrices):
+            parts.append(
+                "<TileMatrix>"
+                "<ows:Identifier>{0}</ows:Identifier>"
+                "<ScaleDenominator>{1}</ScaleDenominator>"
+                "<TopLeftCorner>10000000.0 -1000000.0</TopLeftCorner>"
+                "<TileWidth>256</TileWidth><TileHeight>256</TileHeight>"
+                "<MatrixWidth>{2}</MatrixWidth><MatrixHeight>{2}</MatrixHeight>"
+                "</TileMatrix>".format(matrix, 2 ** (26 - matrix), 2**matrix)
+            )
+        parts.append("</TileMatrixSet>\n")
+    parts.append("</Contents>\n</Capabilities>\n")
+    return "".join(parts).encode("utf-8")
@@ -0,0 +1,546 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ SQLite index of the capability documents cached in the plugin
+ settings dir. Each domain / service has one row referencing its
+ cached doc, with the doc's HTTP validators, fetch time and the
+ table rows formatted from it. The layers' abstracts are only shown for
+ the selected row, so they are kept out of the rows and read on demand.
+ Domains whose requests keep failing are recorded so they can be skipped
+ for a while. See request_policy. Interrupted downloads are recorded
+ so they can be resumed. See download.
+"""
+
+import json
+import os.path
+import sqlite3
+import threading
+import time
+import zlib
+
+STORE_FILE = "cache.sqlite"
+
+# Bump when the schema changes. The store only holds cached
+# data so it is simply rebuilt
+STORE_VERSION = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS capabilities (
+    domain TEXT NOT NULL,
+    service TEXT NOT NULL,
+    file TEXT NOT NULL,
+    content_hash TEXT,
+    validators TEXT,
+    fetched REAL NOT NULL,
+    rows_version INTEGER,
+    rows BLOB,
+    PRIMARY KEY (domain, service)
+);
+CREATE TABLE IF NOT EXISTS abstracts (
+    domain TEXT NOT NULL,
+    service TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    abstract TEXT,
+    PRIMARY KEY (domain, service, type, id)
+);
+CREATE TABLE IF NOT EXISTS breakers (
+    domain TEXT NOT NULL PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    open_until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS partials (
+    domain TEXT NOT NULL,
+    service TEXT NOT NULL,
+    validator TEXT NOT NULL,
+    encoding TEXT,
+    PRIMARY KEY (domain, service)
+)
+"""
+
+# A new doc only keeps the stored rows if its content is unchanged.
+# Expressions in the SET clause see the values of the existing row
+RECORD_SQL = """
+INSERT INTO capabilities (domain, service, file, content_hash, validators, fetched)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (domain, service) DO UPDATE SET
+    file = excluded.file,
+    rows = CASE WHEN content_hash = excluded.content_hash THEN rows END,
+    rows_version = CASE WHEN content_hash = excluded.content_hash
+        THEN rows_version END,
+    content_hash = excluded.content_hash,
+    validators = excluded.validators,
+    fetched = excluded.fetched
+"""
+
+SCHEMA_LOCK = threading.Lock()
+SCHEMA_READY = set()  # store paths with a current schema
+
+
+class CacheStore:
+    """
+    Store of the cached capability documents. Every method uses its
+    own short lived connection so a store can be used from any thread
+    and each update is a single atomic transaction
+    """
+
+    def __init__(self, directory):
+        """
+        Initialise CacheStore
+
+        :param directory: plugin settings dir holding the cached docs
+        :type directory: str
+        """
+
+        self.path = os.path.join(directory, STORE_FILE)
+
+    def connect(self):
+        """
+        Open a connection to the store, creating
+        or rebuilding the store if required
+
+        @return: connection
+        @rtype: sqlite3.Connection
+        """
+
+        with SCHEMA_LOCK:
+            if self.path in SCHEMA_READY and os.path.exists(self.path):
+                return self.open_connection()
+            connection = None
+            try:
+                connection = self.open_connection()
+                self.create_schema(connection)
+            except sqlite3.DatabaseError:
+                # Not a database. The store only holds cached data
+                if connection is not None:
+                    connection.close()
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                connection = self.open_connection()
+                self.create_schema(connection)
+            SCHEMA_READY.add(self.path)
+            return connection
+
+    def open_connection(self):
+        """
+        @return: connection
+        @rtype: sqlite3.Connection
+        """
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @staticmethod
+    def create_schema(connection):
+        """
+        Create the store's tables. Tables of other
+        store versions are dropped
+
+        :param connection: connection
+        :type connection: sqlite3.Connection
+        """
+
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != STORE_VERSION:
+            connection.execute("DROP TABLE IF EXISTS capabilities")
+            connection.execute("DROP TABLE IF EXISTS abstracts")
+            connection.execute("DROP TABLE IF EXISTS breakers")
+            connection.execute("DROP TABLE IF EXISTS partials")
+        connection.executescript(SCHEMA)
+        connection.execute("PRAGMA user_version = {0}".format(STORE_VERSION))
+        # readers are not blocked by writers
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.commit()
+
+    def execute(self, sql, params=()):
+        """
+        Execute a statement in its own transaction
+
+        :param sql: SQL statement
+        :type sql: str
+        :param params: statement parameters
+        :type params: tuple
+        @return: result rows
+        @rtype: list
+        """
+
+        connection = self.connect()
+        try:
+            with connection:
+                return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def get(self, domain, service):
+        """
+        Return the store entry of a domain / service
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        @return: {"file": ..., "content_hash": ..., "validators": {...},
+        "fetched": ...}. None if the domain / service has no entry
+        @rtype: dict
+        """
+
+        result = self.execute(
+            "SELECT file, content_hash, validators, fetched FROM capabilities "
+            "WHERE domain = ? AND service = ?",
+            (domain, service),
+        )
+        if not result:
+            return None
+        entry = dict(result[0])
+        entry["validators"] = json.loads(entry["validators"] or "{}")
+        return entry
+
+    def files(self):
+        """
+        Return the cached docs referenced by the store
+
+        @return: file names
+        @rtype: set
+        """
+
+        return {row["file"] for row in self.execute("SELECT file FROM capabilities")}
+
+    def record(  # pylint:disable=too-many-arguments
+        self, domain, service, file, content_hash, validators, fetched=None
+    ):
+        """
+        Record a doc as the domain / service's cached doc
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        :param file: file name of the doc in the settings dir
+        :type file: str
+        :param content_hash: sha1 hex digest of the doc. None if unknown
+        :type content_hash: str
+        :param validators: e.g. {"ETag": '"abc"', "Last-Modified": "Wed, ..."}
+        :type validators: dict
+        :param fetched: time the doc was fetched. Defaults to now
+        :type fetched: float
+        """
+
+        self.execute(
+            RECORD_SQL,
+            (
+                domain,
+                service,
+                file,
+                content_hash,
+                json.dumps(validators or {}),
+                time.time() if fetched is None else fetched,
+            ),
+        )
+
+    def revalidated(self, domain, service, validators):
+        """
+        Record that the server confirmed the cached doc is current
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        :param validators: e.g. {"ETag": '"abc"', "Last-Modified": "Wed, ..."}
+        :type validators: dict
+        """
+
+        self.execute(
+            "UPDATE capabilities SET validators = ?, fetched = ? "
+            "WHERE domain = ? AND service = ?",
+            (json.dumps(validators), time.time(), domain, service),
+        )
+
+    def read_rows(self, domain, service, content_hash, version):
+        """
+        Return the stored table rows if they were
+        formatted from a doc with the given hash
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        :param content_hash: sha1 hex digest of the doc
+        :type content_hash: str
+        :param version: version of the table row format
+        :type version: int
+        @return: table rows. None if there are no current rows
+        @rtype: list
+        """
+
+        result = self.execute(
+            "SELECT rows FROM capabilities WHERE domain = ? AND service = ? "
+            "AND content_hash = ? AND rows_version = ? AND rows IS NOT NULL",
+            (domain, service, content_hash, version),
+        )
+        if not result:
+            return None
+        try:
+            return json.loads(zlib.decompress(result[0]["rows"]))
+        except (ValueError, zlib.error):
+            return None
+
+    def write_rows(  # pylint:disable=too-many-arguments
+        self, domain, service, content_hash, version, rows, abstracts=()
+    ):
+        """
+        Store the table rows formatted from the domain / service's doc,
+        replacing its abstracts in the same transaction
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        :param content_hash: sha1 hex digest of the doc
+        :type content_hash: str
+        :param version: version of the table row format
+        :type version: int
+        :param rows: table rows
+        :type rows: list
+        :param abstracts: (type, id, abstract) of each layer
+        :type abstracts: list
+        """
+
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "UPDATE capabilities SET content_hash = ?, rows_version = ?, "
+                    "rows = ? WHERE domain = ? AND service = ?",
+                    (
+                        content_hash,
+                        version,
+                        zlib.compress(json.dumps(rows).encode("utf-8"), 1),
+                        domain,
+                        service,
+                    ),
+                )
+                connection.execute(
+                    "DELETE FROM abstracts WHERE domain = ? AND service = ?",
+                    (domain, service),
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO abstracts VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (domain, service, object_type, object_id, abstract)
+                        for object_type, object_id, abstract in abstracts
+                    ),
+                )
+        finally:
+            connection.close()
+
+    def read_abstract(self, domain, service, object_type, object_id):
+        """
+        Return a layer's abstract
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        :param object_type: layer or table
+        :type object_type: str
+        :param object_id: layer id
+        :type object_id: str
+        @return: abstract. None if the layer has no stored abstract
+        @rtype: str
+        """
+
+        result = self.execute(
+            "SELECT abstract FROM abstracts WHERE domain = ? AND service = ? "
+            "AND type = ? AND id = ?",
+            (domain, service, object_type, object_id),
+        )
+        if not result:
+            return None
+        return result[0]["abstract"]
+
+    def read_abstracts(self, domain, service):
+        """
+        Return the abstracts of all a domain / service's layers
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        @return: {(type, id): abstract}
+        @rtype: dict
+        """
+
+        return {
+            (row["type"], row["id"]): row["abstract"]
+            for row in self.execute(
+                "SELECT type, id, abstract FROM abstracts "
+                "WHERE domain = ? AND service = ?",
+                (domain, service),
+            )
+        }
+
+    def open_until(self, domain):
+        """
+        Return the time until which requests to a domain are skipped
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        @return: time. 0 if the domain's requests are not skipped
+        @rtype: float
+        """
+
+        result = self.execute(
+            "SELECT open_until FROM breakers WHERE domain = ?", (domain,)
+        )
+        if not result:
+            return 0
+        return result[0]["open_until"]
+
+    def request_failed(self, domain, threshold, cool_down):
+        """
+        Record a failed request to a domain. Once threshold requests
+        in a row have failed the domain's requests are skipped
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param threshold: failures in a row before requests are skipped
+        :type threshold: int
+        :param cool_down: seconds requests are skipped for
+        :type cool_down: float
+        """
+
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT INTO breakers VALUES (?, 1, 0) ON CONFLICT (domain) "
+                    "DO UPDATE SET failures = failures + 1",
+                    (domain,),
+                )
+                connection.execute(
+                    "UPDATE breakers SET open_until = ? "
+                    "WHERE domain = ? AND failures >= ?",
+                    (time.time() + cool_down, domain, threshold),
+                )
+        finally:
+            connection.close()
+
+    def request_succeeded(self, domain):
+        """
+        Record a domain answered a request, clearing its failures
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        """
+
+        self.execute("DELETE FROM breakers WHERE domain = ?", (domain,))
+
+    def partial(self, domain, service):
+        """
+        Return the record of a domain / service's partial download
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        @return: {"validator": ..., "encoding": ...}. None if
+        there is no partial download
+        @rtype: dict
+        """
+
+        result = self.execute(
+            "SELECT validator, encoding FROM partials WHERE domain = ? AND service = ?",
+            (domain, service),
+        )
+        if not result:
+            return None
+        return dict(result[0])
+
+    def record_partial(self, domain, service, validator, encoding):
+        """
+        Record the response a partial download is received from
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        :param validator: ETag or Last-Modified to resume with (If-Range)
+        :type validator: str
+        :param encoding: Content-Encoding of the response. None if not encoded
+        :type encoding: str
+        """
+
+        self.execute(
+            "INSERT OR REPLACE INTO partials VALUES (?, ?, ?, ?)",
+            (domain, service, validator, encoding),
+        )
+
+    def delete_partial(self, domain, service):
+        """
+        Delete the record of a domain / service's partial download
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        """
+
+        self.execute(
+            "DELETE FROM partials WHERE domain = ? AND service = ?", (domain, service)
+        )
+
+    def delete(self, domain):
+        """
+        Delete the entries of a domain
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        """
+
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "DELETE FROM capabilities WHERE domain = ?", (domain,)
+                )
+                connection.execute("DELETE FROM abstracts WHERE domain = ?", (domain,))
+                connection.execute("DELETE FROM breakers WHERE domain = ?", (domain,))
+                connection.execute("DELETE FROM partials WHERE domain = ?", (domain,))
+        finally:
+            connection.close()
+
+    def delete_file(self, file):
+        """
+        Delete the entries referencing a doc
+
+        :param file: file name of the doc in the settings dir
+        :type file: str
+        """
+
+        connection = self.connect()
+        try:
+            with connection:
+                # the abstracts were stored with the doc's rows
+                connection.execute(
+                    "DELETE FROM abstracts WHERE EXISTS (SELECT 1 FROM capabilities "
+                    "WHERE file = ? AND domain = abstracts.domain "
+                    "AND service = abstracts.service)",
+                    (file,),
+                )
+                connection.execute("DELETE FROM capabilities WHERE file = ?", (file,))
+        finally:
+            connection.close()
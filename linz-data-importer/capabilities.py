@@ -0,0 +1,453 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Streaming extraction of table rows from capability documents.
+ Only the values shown in the table are read and elements are
+ discarded as soon as they are processed, so memory use does not
+ grow with the size of the document. Documents can be parsed as they
+ are downloaded. See RowStream.
+"""
+
+import gzip
+import re
+from xml.etree.ElementTree import XMLPullParser, iterparse
+
+WFS_NS = "{http://www.opengis.net/wfs/2.0}"
+WMTS_NS = "{http://www.opengis.net/wmts/1.0}"
+OWS_NS = "{http://www.opengis.net/ows/1.1}"
+
+FULL_ID_REGEX = re.compile(
+    r"([aA-zZ]+\\.[aA-zZ]+\\.[aA-zZ]+\\.[aA-zZ]+\\:)?(?P<type>[aA-zZ]+)-(?P<id>[0-9]+)"
+)
+VALID_CRS_REGEX = re.compile(r"^EPSG:\d+")
+
+# Bytes handed to the parser at a time by RowStream
+FEED_SIZE = 16 * 1024
+
+# First bytes of all gzip files
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class UnsupportedCapabilities(Exception):
+    """
+    The document is not one the streaming extractors understand.
+    It should be handled by owslib instead
+    """
+
+
+def parse_dataset_id(domain, dataset_id):
+    """
+    Split a dataset identifier into its type and id
+
+    :param domain: Service Domain (e.g. data.linz.govt.nz)
+    :type domain: str
+    :param dataset_id: e.g. data.linz.govt.nz:layer-50772
+    :type dataset_id: str
+    @return: (object type, object id) e.g ("layer", "50772")
+    @rtype: tuple
+    """
+
+    if domain == "basemaps.linz.govt.nz":
+        return "layer", dataset_id
+    full_id = FULL_ID_REGEX.search(dataset_id)
+    return full_id.group("type"), full_id.group("id")
+
+
+def crs_code(crs):
+    """
+    Return the code of an OGC crs reference
+
+    :param crs: e.g. urn:ogc:def:crs:EPSG::2193 or EPSG:2193
+    :type crs: str
+    @return: e.g. 2193
+    @rtype: str
+    """
+
+    return re.split(r"[:/#]", crs.strip())[-1]
+
+
+def sort_crs(crs):
+    """
+    Drop invalid crs values and sort by EPSG code
+
+    :param crs: e.g. ["EPSG:4326", "EPSG:2193"]
+    :type crs: list
+    @return: e.g. ["EPSG:2193", "EPSG:4326"]
+    @rtype: list
+    """
+
+    # wfs returns some no valid crs values
+    crs = [s for s in crs if VALID_CRS_REGEX.match(s)]
+    crs.sort(key=lambda x: int(x.split(":")[1]))
+    return crs
+
+
+def linked_crs(links, tms_crs, shared):
+    """
+    Return the crs a layer is available in via its TileMatrixSetLinks.
+    Layers linking to the same TileMatrixSets share one list
+
+    :param links: TileMatrixSet identifiers the layer links to
+    :type links: iterable
+    :param tms_crs: {TileMatrixSet identifier: "EPSG:code"}
+    :type tms_crs: dict
+    :param shared: {links: crs list} already resolved
+    :type shared: dict
+    @return: e.g. ["EPSG:2193", "EPSG:3857"]
+    @rtype: list
+    """
+
+    key = tuple(links)
+    if key not in shared:
+        shared[key] = sort_crs(list({tms_crs[link] for link in key if link in tms_crs}))
+    return shared[key]
+
+
+def wfs_row(feature_type, domain):
+    """
+    Format a WFS FeatureType element as a table row
+
+    :param feature_type: wfs:FeatureType element
+    :type feature_type: xml.etree.ElementTree.Element
+    :param domain: Service Domain (e.g. data.linz.govt.nz)
+    :type domain: str
+    @return: [domain, type, service, id, title, abstract, crs]
+    @rtype: list
+    """
+
+    object_type, object_id = parse_dataset_id(
+        domain, feature_type.findtext(WFS_NS + "Name")
+    )
+    crs = [
+        "EPSG:{0}".format(crs_code(elem.text))
+        for elem in feature_type
+        if elem.tag in (WFS_NS + "DefaultCRS", WFS_NS + "OtherCRS") and elem.text
+    ]
+    return [
+        domain,
+        object_type,
+        "WFS",
+        object_id,
+        feature_type.findtext(WFS_NS + "Title"),
+        feature_type.findtext(WFS_NS + "Abstract"),
+        sort_crs(crs),
+    ]
+
+
+def extract_wfs_rows(source, domain):
+    """
+    Stream a WFS 2.0.0 capabilities document and return its table rows
+
+    :param source: file name or binary file object
+    :type source: str
+    :param domain: Service Domain (e.g. data.linz.govt.nz)
+    :type domain: str
+    @return: list of [domain, type, service, id, title, abstract, crs]
+    @rtype: list
+    """
+
+    return extract_rows(source, WfsExtractor(domain))
+
+
+def extract_rows(source, extractor):
+    """
+    Stream a capabilities document through an extractor
+
+    :param source: file name or binary file object
+    :type source: str
+    :param extractor: WfsExtractor or WmtsExtractor
+    :type extractor: WfsExtractor
+    @return: list of [domain, type, service, id, title, abstract, crs]
+    @rtype: list
+    """
+
+    for event, elem in iterparse(source, events=("start", "end")):
+        if event == "start":
+            extractor.start(elem)
+        else:
+            extractor.end(elem)
+    return extractor.rows()
+
+
+def open_document(file):
+    """
+    Open a capabilities document file for reading. A gzip
+    compressed file is decompressed as it is read
+
+    :param file: file name
+    :type file: str
+    @return: binary file object
+    @rtype: io.BufferedIOBase
+    """
+
+    with open(file, "rb") as file_pointer:
+        compressed = file_pointer.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if compressed:
+        return gzip.open(file, "rb")
+    return open(file, "rb")  # pylint:disable=consider-using-with
+
+
+def extract_file_rows(extractor, file, domain):
+    """
+    Stream a capabilities document file through extract_wfs_rows or
+    extract_wmts_rows. Parse processes are handed the file name
+    rather than the document
+
+    :param extractor: extract_wfs_rows or extract_wmts_rows
+    :type extractor: callable
+    :param file: file name
+    :type file: str
+    :param domain: Service Domain (e.g. data.linz.govt.nz)
+    :type domain: str
+    @return: list of [domain, type, service, id, title, abstract, crs]
+    @rtype: list
+    """
+
+    with open_document(file) as source:
+        return extractor(source, domain)
+
+
+class WfsExtractor:
+    """
+    Build table rows from the start / end events of a
+    streamed WFS 2.0.0 capabilities document
+    """
+
+    def __init__(self, domain):
+        """
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        """
+
+        self.domain = domain
+        self.feature_types = []  # table rows
+        self.root = None
+        self.feature_type_list = None
+
+    def start(self, elem):
+        """
+        Handle an element start event
+
+        :param elem: element
+        :type elem: xml.etree.ElementTree.Element
+        """
+
+        if self.root is None:
+            self.root = elem
+            if elem.tag != WFS_NS + "WFS_Capabilities":
+                raise UnsupportedCapabilities(elem.tag)
+        if elem.tag == WFS_NS + "FeatureTypeList":
+            self.feature_type_list = elem
+
+    def end(self, elem):
+        """
+        Handle an element end event. Processed
+        FeatureTypes are removed from the tree
+
+        :param elem: element
+        :type elem: xml.etree.ElementTree.Element
+        """
+
+        if elem.tag == WFS_NS + "FeatureType" and self.feature_type_list is not None:
+            self.feature_types.append(wfs_row(elem, self.domain))
+            self.feature_type_list.remove(elem)
+
+    def rows(self):
+        """
+        Return the table rows once the whole document is processed
+
+        @return: list of [domain, type, service, id, title, abstract, crs]
+        @rtype: list
+        """
+
+        if self.feature_type_list is None:
+            raise UnsupportedCapabilities("No FeatureTypeList")
+        return self.feature_types
+
+
+class WmtsExtractor:
+    """
+    Build table rows from the start / end events of a streamed
+    WMTS 1.0.0 capabilities document. TileMatrix elements are
+    discarded unread. The crs of each TileMatrixSet is resolved
+    once and attached to the layers linking to it
+    """
+
+    def __init__(self, domain):
+        """
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        """
+
+        self.domain = domain
+        self.layers = []  # (row, TileMatrixSet links)
+        self.tms_crs = {}
+        self.depth = 0
+        self.contents = None
+        self.tile_matrix_set = None
+
+    def start(self, elem):
+        """
+        Handle an element start event
+
+        :param elem: element
+        :type elem: xml.etree.ElementTree.Element
+        """
+
+        self.depth += 1
+        if self.depth == 1 and elem.tag != WMTS_NS + "Capabilities":
+            raise UnsupportedCapabilities(elem.tag)
+        if self.depth == 2 and elem.tag == WMTS_NS + "Contents":
+            self.contents = elem
+        elif self.depth == 3 and elem.tag == WMTS_NS + "TileMatrixSet":
+            self.tile_matrix_set = elem
+
+    def end(self, elem):
+        """
+        Handle an element end event. Processed elements
+        are removed from the tree
+
+        :param elem: element
+        :type elem: xml.etree.ElementTree.Element
+        """
+
+        self.depth -= 1
+        if self.depth == 3 and elem.tag == WMTS_NS + "TileMatrix":
+            self.tile_matrix_set.remove(elem)
+        elif self.depth == 2 and elem.tag == WMTS_NS + "Layer":
+            self.layers.append(wmts_layer(elem, self.domain))
+            self.contents.remove(elem)
+        elif self.depth == 2 and elem.tag == WMTS_NS + "TileMatrixSet":
+            crs = elem.findtext(OWS_NS + "SupportedCRS")
+            if crs:
+                self.tms_crs[elem.findtext(OWS_NS + "Identifier")] = "EPSG:{0}".format(
+                    crs_code(crs)
+                )
+            self.contents.remove(elem)
+            self.tile_matrix_set = None
+
+    def rows(self):
+        """
+        Return the table rows once the whole document is processed
+
+        @return: list of [domain, type, service, id, title, abstract, crs]
+        @rtype: list
+        """
+
+        if self.contents is None:
+            raise UnsupportedCapabilities("No Contents")
+        shared = {}
+        for row, links in self.layers:
+            row.append(linked_crs(links, self.tms_crs, shared))
+        return [row for row, _links in self.layers]
+
+
+def extract_wmts_rows(source, domain):
+    """
+    Stream a WMTS 1.0.0 capabilities document and return its table rows
+
+    :param source: file name or binary file object
+    :type source: str
+    :param domain: Service Domain (e.g. data.linz.govt.nz)
+    :type domain: str
+    @return: list of [domain, type, service, id, title, abstract, crs]
+    @rtype: list
+    """
+
+    return extract_rows(source, WmtsExtractor(domain))
+
+
+class RowStream:
+    """
+    Extract table rows from a capabilities document fed to it in
+    chunks, e.g. as it is downloaded. Raises what the extractors
+    raise, or ElementTree.ParseError, from feed() or close()
+    """
+
+    def __init__(self, extractor):
+        """
+        :param extractor: WfsExtractor or WmtsExtractor
+        :type extractor: WfsExtractor
+        """
+
+        self.parser = XMLPullParser(events=("start", "end"))
+        self.extractor = extractor
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the document
+
+        :param data: chunk
+        :type data: bytes
+        """
+
+        # in slices, so only a slice's elements are held at once
+        for start in range(0, len(data), FEED_SIZE):
+            self.parser.feed(data[start : start + FEED_SIZE])
+            self.handle_events()
+
+    def handle_events(self):
+        """
+        Hand the events parsed so far to the extractor
+        """
+
+        for event, elem in self.parser.read_events():
+            if event == "start":
+                self.extractor.start(elem)
+            else:
+                self.extractor.end(elem)
+
+    def close(self):
+        """
+        Finish parsing the document
+
+        @return: list of [domain, type, service, id, title, abstract, crs]
+        @rtype: list
+        """
+
+        self.parser.close()
+        self.handle_events()
+        return self.extractor.rows()
+
+
+def wmts_layer(layer, domain):
+    """
+    Format a WMTS Layer element as a table row, less its crs
+
+    :param layer: wmts:Layer element
+    :type layer: xml.etree.ElementTree.Element
+    :param domain: Service Domain (e.g. data.linz.govt.nz)
+    :type domain: str
+    @return: ([domain, type, service, id, title, abstract], TileMatrixSet links)
+    @rtype: tuple
+    """
+
+    object_type, object_id = parse_dataset_id(
+        domain, layer.findtext(OWS_NS + "Identifier")
+    )
+    links = [
+        link.findtext(WMTS_NS + "TileMatrixSet")
+        for link in layer.findall(WMTS_NS + "TileMatrixSetLink")
+    ]
+    row = [
+        domain,
+        object_type,
+        "WMTS",
+        object_id,
+        layer.findtext(OWS_NS + "Title"),
+        layer.findtext(OWS_NS + "Abstract"),
+    ]
+    return row, links
@@ -0,0 +1,181 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+"""
+
+from qgis.core import QgsTask  # pylint:disable=import-error
+from qgis.PyQt.QtCore import pyqtSignal  # pylint:disable=import-error
+
+from .search_index import TokenSegment
+from .service_data import process_services
+
+
+class CatalogueLoadTask(QgsTask):  # pylint:disable=too-many-instance-attributes
+    """
+    Fetch, parse and format the capability documents of all
+    feeds as a background task. The task never touches Qt widgets
+    or models, results are handed back via queued signals.
+    """
+
+    # rows and TokenSegment of a single feed, emitted as each feed completes
+    feedLoaded = pyqtSignal(list, object)  # pylint:disable=invalid-name
+    # all rows, their TokenSegments, summary of any failed feeds, update_cache
+    loaded = pyqtSignal(list, list, object, bool)
+    # why the task did not complete, update_cache
+    failed = pyqtSignal(str, bool)
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        feeds,
+        update_cache=False,
+        max_workers=None,
+        parse_processes=None,
+        previous_segments=None,
+    ):
+        """
+        Initialise CatalogueLoadTask
+
+        :param feeds: ServiceData instances in table order
+        :type feeds: list
+        :param update_cache: True if the feeds are refreshing the cache
+        :type update_cache: bool
+        :param max_workers: Max concurrent feeds
+        :type max_workers: int
+        :param parse_processes: Number of processes to parse the feeds in
+        :type parse_processes: int
+        :param previous_segments: TokenSegments of the previous load
+        by the hash of the doc they were built from
+        :type previous_segments: dict
+        """
+
+        if update_cache:
+            description = "LINZ Data Importer: Updating datasets"
+        else:
+            description = "LINZ Data Importer: Loading datasets"
+        super().__init__(description, QgsTask.CanCancel)
+        self.feeds = feeds
+        self.update_cache = update_cache
+        self.max_workers = max_workers
+        self.parse_processes = parse_processes
+        self.rows = []
+        self.segments = []
+        self.feed_segments = {}  # ServiceData: TokenSegment
+        self.previous_segments = previous_segments or {}
+        self.hashed_segments = {}  # doc hash: TokenSegment, for the next load
+        self.err = None
+
+    def run(self):
+        """
+        Runs in a QgsTaskManager thread
+
+        @return: True if the task was not cancelled and did not fail
+        @rtype: boolean
+        """
+
+        try:
+            process_services(
+                self.feeds,
+                self.max_workers,
+                self.feed_processed,
+                self.parse_processes,
+                self.isCanceled,
+            )
+        except Exception as error:  # pylint:disable=broad-except
+            # reported as failed so the rows already shown are kept
+            self.err = "Error: {0}".format(error)
+            return False
+        if self.isCanceled():
+            return False
+
+        # Merge in domain / service order so the table is deterministic.
+        # A failed feed does not hold up the others
+        for service_data_instance in self.feeds:
+            if service_data_instance.disabled or service_data_instance.err:
+                continue
+            self.rows.extend(service_data_instance.info)
+            self.segments.append(self.feed_segments[service_data_instance])
+        self.err = failure_summary(self.feeds)
+        return True
+
+    def feed_processed(self, service_data_instance, done, total):
+        """
+        Report progress to the task manager and hand the rows of
+        the completed feed over. Their search index tokens are built
+        here so the GUI thread does not have to, unless the feed's doc
+        is unchanged since the previous load. A cache update hands
+        all rows over at once, replacing those already in the table
+
+        :param service_data_instance: completed feed
+        :type service_data_instance: ServiceData
+        :param done: number of feeds processed
+        :type done: int
+        :param total: number of feeds
+        :type total: int
+        """
+
+        self.setProgress(100.0 * done / total)
+        if service_data_instance.disabled or service_data_instance.err:
+            return
+        content_hash = service_data_instance.content_hash()
+        segment = self.previous_segments.get(content_hash)
+        if segment is None or segment.length != len(service_data_instance.info):
+            segment = TokenSegment(service_data_instance.row_texts())
+        self.feed_segments[service_data_instance] = segment
+        if content_hash:
+            self.hashed_segments[content_hash] = segment
+        if not self.update_cache:
+            self.feedLoaded.emit(service_data_instance.info, segment)
+
+    def finished(self, result):  # pylint:disable=arguments-differ
+        """
+        Runs on the GUI thread once run() has returned, or the
+        task was cancelled before it started
+
+        :param result: run()'s return value
+        :type result: bool
+        """
+
+        if result:
+            self.loaded.emit(self.rows, self.segments, self.err, self.update_cache)
+        else:
+            self.failed.emit(
+                self.err or "Loading datasets was cancelled", self.update_cache
+            )
+
+
+def failure_summary(feeds):
+    """
+    Summarise the errors of the feeds that failed to load. The
+    feeds of a domain usually fail alike, each error is listed once
+
+    :param feeds: ServiceData instances
+    :type feeds: list
+    @return: one line per error. None if no feed failed
+    @rtype: str
+    """
+
+    lines = []
+    for service_data_instance in feeds:
+        if service_data_instance.err:
+            line = service_data_instance.err
+        elif service_data_instance.fallback_err:
+            line = "{0} (showing cached datasets)".format(
+                service_data_instance.fallback_err
+            )
+        else:
+            continue
+        if line not in lines:
+            lines.append(line)
+    return "\n".join(lines) or None
@@ -0,0 +1,442 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Keep-alive connections shared by every request made to a host, be it
+ a capability document fetch, its refresh or a preview image. Idle
+ connections are kept per host, up to a cap, until they expire. A new
+ TLS connection resumes the host's last TLS session, skipping most of
+ its handshake. The pool counts its requests so connection reuse can be
+ measured.
+"""
+
+import ssl
+import threading
+import time
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+from socket import timeout
+from urllib.error import URLError
+from urllib.parse import urlsplit
+from urllib.request import HTTPHandler, HTTPSHandler, build_opener
+
+# Idle connections kept per host, and in all
+MAX_IDLE_PER_HOST = 4
+MAX_IDLE = 16
+
+# Seconds an idle connection is kept. Servers close idle connections
+# themselves, commonly after a minute or so
+IDLE_TIMEOUT = 30
+
+# Counted by the pool
+COUNTS = (
+    "requests",
+    "reused",
+    "opened",
+    "resumed",
+    "stale",
+    "expired",
+    "discarded",
+)
+
+
+class ConnectionPool:  # pylint: disable=too-many-instance-attributes
+    """
+    Idle keep-alive connections, per (scheme, host). A connection is
+    used by one request at a time and handed back once its response is
+    read to the end. Shared across threads
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host=MAX_IDLE_PER_HOST,
+        max_idle=MAX_IDLE,
+        idle_timeout=IDLE_TIMEOUT,
+    ):
+        """
+        Initialise ConnectionPool
+
+        :param max_idle_per_host: idle connections kept per host
+        :type max_idle_per_host: int
+        :param max_idle: idle connections kept in all
+        :type max_idle: int
+        :param idle_timeout: seconds an idle connection is kept
+        :type idle_timeout: float
+        """
+
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}  # {(scheme, host): [(connection, idle since)]}
+        self.sessions = {}  # {(scheme, host): last TLS session}
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.context = None
+
+    def tls_context(self):
+        """
+        @return: the context TLS connections are made with. Their
+        sessions can only be resumed with the same context
+        @rtype: ssl.SSLContext
+        """
+
+        with self.lock:
+            if self.context is None:
+                self.context = ssl.create_default_context()
+            return self.context
+
+    def count(self, name):
+        """
+        :param name: one of COUNTS
+        :type name: str
+        """
+
+        with self.lock:
+            self.counts[name] += 1
+
+    def stale(self):
+        """
+        Count a request whose idle connection had been closed by the
+        server, so was sent on a new connection instead
+        """
+
+        with self.lock:
+            self.counts["stale"] += 1
+            self.counts["reused"] -= 1
+            self.counts["opened"] += 1
+
+    def acquire(self, key):
+        """
+        Take the host's most recently used idle connection. Expired
+        ones are closed
+
+        :param key: (scheme, host)
+        :type key: tuple
+        @return: connection. None if there are no idle connections
+        @rtype: http.client.HTTPConnection
+        """
+
+        now = time.monotonic()
+        conn, expired = None, []
+        with self.lock:
+            self.counts["requests"] += 1
+            idle = self.idle.get(key, [])
+            if idle:
+                candidate, since = idle.pop()
+                if now - since < self.idle_timeout:
+                    conn = candidate
+                else:
+                    # the others have been idle for longer
+                    expired = [candidate] + [c for c, _ in idle]
+                    idle.clear()
+            self.counts["expired"] += len(expired)
+            self.counts["reused" if conn else "opened"] += 1
+        for candidate in expired:
+            candidate.close()
+        return conn
+
+    def release(self, key, conn, reusable):
+        """
+        Hand back a connection. It is kept if reusable and there is
+        room for it, and closed if not
+
+        :param key: (scheme, host)
+        :type key: tuple
+        :param conn: connection
+        :type conn: http.client.HTTPConnection
+        :param reusable: True if the response was read to the end and
+        the server keeps the connection open
+        :type reusable: bool
+        """
+
+        with self.lock:
+            if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session:
+                self.sessions[key] = conn.sock.session
+            if reusable and conn.sock is not None:
+                idle = self.idle.setdefault(key, [])
+                total = sum(len(conns) for conns in self.idle.values())
+                if len(idle) < self.max_idle_per_host and total < self.max_idle:
+                    idle.append((conn, time.monotonic()))
+                    return
+                self.counts["discarded"] += 1
+        conn.close()
+
+    def session(self, key):
+        """
+        :param key: (scheme, host)
+        :type key: tuple
+        @return: the host's last TLS session. None if there is none
+        @rtype: ssl.SSLSession
+        """
+
+        with self.lock:
+            return self.sessions.get(key)
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+
+        with self.lock:
+            idle = [conn for conns in self.idle.values() for conn, _ in conns]
+            self.idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        """
+        Return the pool's counts. "reused" requests were sent on an idle
+        connection, "opened" ones on a new connection, of which "resumed"
+        ones resumed a TLS session. "stale" idle connections had been
+        closed by the server, "expired" ones by the pool, and "discarded"
+        ones did not fit in the pool
+
+        @return: counts and the reuse rate (reused / requests)
+        @rtype: dict
+        """
+
+        with self.lock:
+            stats = dict(self.counts)
+        stats["reuse_rate"] = (
+            stats["reused"] / stats["requests"] if stats["requests"] else 0.0
+        )
+        return stats
+
+
+# Shared by all of the plugin's requests
+POOL = ConnectionPool()
+
+
+class PooledResponse(HTTPResponse):
+    """
+    Response that hands its connection back to the pool once closed
+    """
+
+    release = None  # called with True if the connection can be reused
+
+    def close(self):
+        reusable = (self.fp is None or self.length == 0) and not self.will_close
+        super().close()
+        release, self.release = self.release, None
+        if release:
+            release(reusable)
+
+
+class ReadTimeoutMixin:
+    """
+    A connection's timeout applies to connecting. Once
+    connected each read waits up to the read timeout
+    """
+
+    def __init__(self, *args, read_timeout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.read_timeout)
+
+
+class ReadTimeoutHTTPConnection(ReadTimeoutMixin, HTTPConnection):
+    pass
+
+
+class ReadTimeoutHTTPSConnection(ReadTimeoutMixin, HTTPSConnection):
+    pass
+
+
+class PooledHTTPConnection(ReadTimeoutHTTPConnection):
+    response_class = PooledResponse
+
+
+class PooledHTTPSConnection(ReadTimeoutHTTPSConnection):
+    """
+    HTTPS connection resuming a TLS session
+    """
+
+    response_class = PooledResponse
+
+    def __init__(self, *args, context=None, session=None, **kwargs):
+        super().__init__(*args, context=context, **kwargs)
+        self.tls_context = context
+        self.session = session
+        self.resumed = False  # True if the TLS session was resumed
+
+    def connect(self):
+        HTTPConnection.connect(self)  # TCP only. Wrapped below
+        self.sock = self.tls_context.wrap_socket(
+            self.sock, server_hostname=self.host, session=self.session
+        )
+        self.resumed = self.sock.session_reused
+        self.sock.settimeout(self.read_timeout)
+
+
+def proxied(req):
+    """
+    :param req: request
+    :type req: urllib.request.Request
+    @return: True if the request is sent via a proxy. These are not pooled
+    @rtype: bool
+    """
+
+    return urlsplit(req.full_url).netloc != req.host
+
+
+class PooledHandlerMixin:
+    """
+    Send requests on the pool's connections, with a read timeout.
+    A request whose idle connection turns out to have been closed
+    by the server is sent again on a new one
+    """
+
+    def __init__(self, pool=POOL, read_timeout=None):
+        """
+        :param pool: pool the connections are kept in
+        :type pool: ConnectionPool
+        :param read_timeout: seconds each read waits. Defaults to the
+        request's timeout
+        :type read_timeout: float
+        """
+
+        super().__init__()
+        self.pool = pool
+        self.read_timeout = read_timeout
+
+    def pooled_open(self, connection_class, req, **kwargs):
+        """
+        Send a request and return its response. As urllib's do_open,
+        new connections are made with the given class and arguments
+
+        :param connection_class: class of new connections
+        :type connection_class: type
+        :param req: request
+        :type req: urllib.request.Request
+        :param kwargs: arguments of new connections
+        :type kwargs: dict
+        @return: response
+        @rtype: PooledResponse
+        @raise URLError: if the request could not be sent
+        """
+
+        key = (req.type, req.host)
+        read_timeout = self.read_timeout or req.timeout
+        conn = self.pool.acquire(key)
+        if conn is not None:
+            conn.sock.settimeout(read_timeout)
+            try:
+                return self.send(key, conn, req)
+            except timeout as error:
+                conn.close()
+                raise URLError(error) from error
+            except (OSError, HTTPException):
+                # closed by the server while idle
+                conn.close()
+                self.pool.stale()
+        conn = connection_class(
+            req.host, timeout=req.timeout, read_timeout=read_timeout, **kwargs
+        )
+        try:
+            response = self.send(key, conn, req)
+        except OSError as error:
+            conn.close()
+            raise URLError(error) from error
+        except HTTPException:
+            conn.close()
+            raise
+        if getattr(conn, "resumed", False):
+            self.pool.count("resumed")
+        return response
+
+    def send(self, key, conn, req):
+        """
+        Send a request as urllib's do_open does, asking for the
+        connection to be kept open
+
+        :param key: (scheme, host)
+        :type key: tuple
+        :param conn: connection
+        :type conn: http.client.HTTPConnection
+        :param req: request
+        :type req: urllib.request.Request
+        @return: response
+        @rtype: PooledResponse
+        """
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers["Connection"] = "keep-alive"
+        headers = {name.title(): value for name, value in headers.items()}
+        conn.request(
+            req.get_method(),
+            req.selector,
+            req.data,
+            headers,
+            encode_chunked=req.has_header("Transfer-encoding"),
+        )
+        response = conn.getresponse()
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        response.release = lambda reusable: self.pool.release(key, conn, reusable)
+        return response
+
+
+class PooledHTTPHandler(PooledHandlerMixin, HTTPHandler):
+    """
+    Open http requests on pooled connections
+    """
+
+    def http_open(self, req):
+        if proxied(req):
+            return self.do_open(
+                ReadTimeoutHTTPConnection,
+                req,
+                read_timeout=self.read_timeout or req.timeout,
+            )
+        return self.pooled_open(PooledHTTPConnection, req)
+
+
+class PooledHTTPSHandler(PooledHandlerMixin, HTTPSHandler):
+    """
+    Open https requests on pooled connections
+    """
+
+    def https_open(self, req):
+        if proxied(req):
+            return self.do_open(
+                ReadTimeoutHTTPSConnection,
+                req,
+                read_timeout=self.read_timeout or req.timeout,
+            )
+        return self.pooled_open(
+            PooledHTTPSConnection,
+            req,
+            context=self.pool.tls_context(),
+            session=self.pool.session((req.type, req.host)),
+        )
+
+
+def build_pooled_opener(pool=POOL, read_timeout=None):
+    """
+    :param pool: pool the connections are kept in
+    :type pool: ConnectionPool
+    :param read_timeout: seconds each read waits. Defaults to the
+    request's timeout
+    :type read_timeout: float
+    @return: opener whose http and https requests use the pool
+    @rtype: urllib.request.OpenerDirector
+    """
+
+    return build_opener(
+        PooledHTTPHandler(pool, read_timeout), PooledHTTPSHandler(pool, read_timeout)
+    )
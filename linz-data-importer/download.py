@@ -0,0 +1,264 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Capability document downloads that survive a dropped connection. The
+ body received so far is kept in a .part file in the plugin settings dir
+ and its response's validator is recorded in the cache store, so an
+ interrupted download is resumed with a Range / If-Range request rather
+ than started again.
+"""
+
+import os.path
+import re
+import threading
+import zlib
+from http.client import IncompleteRead
+
+# Bytes of a response read at a time
+CHUNK_SIZE = 64 * 1024
+
+# e.g. bytes 1000-1999/2000
+CONTENT_RANGE_REGEX = re.compile(
+    r"^bytes (?P<start>[0-9]+)-[0-9]+/(?P<total>[0-9]+|\*)$"
+)
+
+PARTS_LOCK = threading.Lock()
+ACTIVE_PARTS = set()  # part files being written
+
+
+def range_validator(headers):
+    """
+    Return the validator a download of the response can be resumed
+    with. Weak ETags can not be used in an If-Range request
+
+    :param headers: response headers
+    :type headers: http.client.HTTPMessage
+    @return: ETag or Last-Modified. None if the download can not be resumed
+    @rtype: str
+    """
+
+    if headers.get("Accept-Ranges") != "bytes":
+        return None
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+class Download:  # pylint: disable=too-many-instance-attributes
+    """
+    Download of a domain / service's capability document. Used as a
+    context manager, only one download at a time uses the part file
+    """
+
+    def __init__(self, store, directory, domain, service):
+        """
+        Initialise Download
+
+        :param store: store the partial download is recorded in
+        :type store: linz-data-importer.cache_store.CacheStore
+        :param directory: plugin settings dir
+        :type directory: str
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (wmts or wfs)
+        :type service: str
+        """
+
+        self.store = store
+        self.domain = domain
+        self.service = service
+        self.part_file = os.path.join(directory, "{0}_{1}.part".format(domain, service))
+        self.owner = False  # True if this download uses the part file
+        # of the response being read
+        self.part = None  # part file object
+        self.resumed = False
+        self.length = None  # bytes of the whole body, if known
+        self.encoding = None
+
+    def __enter__(self):
+        with PARTS_LOCK:
+            self.owner = self.part_file not in ACTIVE_PARTS
+            ACTIVE_PARTS.add(self.part_file)
+        return self
+
+    def __exit__(self, *args):
+        if self.owner:
+            with PARTS_LOCK:
+                ACTIVE_PARTS.discard(self.part_file)
+            self.owner = False
+
+    def part_size(self):
+        """
+        @return: bytes received by the partial download
+        @rtype: int
+        """
+
+        try:
+            return os.path.getsize(self.part_file)
+        except OSError:
+            return 0
+
+    def resume_headers(self):
+        """
+        Return the request headers resuming the partial download
+
+        @return: Range / If-Range headers. Empty if there is no
+        partial download
+        @rtype: dict
+        """
+
+        if not self.owner:
+            return {}
+        partial = self.store.partial(self.domain, self.service)
+        size = self.part_size()
+        if not partial or not size:
+            return {}
+        return {"Range": "bytes={0}-".format(size), "If-Range": partial["validator"]}
+
+    def discard(self):
+        """
+        Delete the partial download
+        """
+
+        if not self.owner:
+            return
+        try:
+            os.remove(self.part_file)
+        except OSError:
+            pass
+        self.store.delete_partial(self.domain, self.service)
+
+    def open_part(self, response):
+        """
+        Open the part file to append the response's body to. A partial
+        response continues the partial download, a full response
+        replaces it. The part file is not used if the response's
+        download can not be resumed
+
+        :param response: response
+        :type response: http.client.HTTPResponse
+        @raise http.client.IncompleteRead: if the partial response
+        does not continue the partial download
+        """
+
+        headers = response.headers
+        self.part = None
+        self.resumed = response.status == 206
+        if self.resumed:
+            match = CONTENT_RANGE_REGEX.match(headers.get("Content-Range", ""))
+            partial = self.store.partial(self.domain, self.service)
+            if (
+                not match
+                or not partial
+                or int(match.group("start")) != self.part_size()
+            ):
+                # retried from the start
+                self.discard()
+                raise IncompleteRead(b"")
+            total = match.group("total")
+            self.length = None if total == "*" else int(total)
+            self.encoding = partial["encoding"]
+            self.open_part_file("a+b")
+            return
+
+        self.discard()
+        length = headers.get("Content-Length")
+        self.length = int(length) if length else None
+        self.encoding = headers.get("Content-Encoding")
+        validator = range_validator(headers)
+        if self.owner and validator:
+            self.store.record_partial(
+                self.domain, self.service, validator, self.encoding
+            )
+            self.open_part_file("wb")
+
+    def open_part_file(self, mode):
+        """
+        :param mode: "a+b" to append to the part file, "wb" to replace it
+        :type mode: str
+        """
+
+        self.part = open(self.part_file, mode)  # pylint:disable=consider-using-with
+
+    def raw_chunks(self, response):
+        """
+        Yield the body as received, replaying the partial
+        download first. New chunks are appended to it
+
+        :param response: response
+        :type response: http.client.HTTPResponse
+        @return: chunks
+        @rtype: generator
+        """
+
+        if self.resumed:
+            self.part.seek(0)
+            yield from iter(lambda: self.part.read(CHUNK_SIZE), b"")
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+            if self.part:
+                self.part.write(chunk)
+            yield chunk
+
+    def chunks(self, response):
+        """
+        Yield the decoded body of a response in chunks. The length of
+        the body and, if gzip encoded, its checksum are verified. The
+        partial download is kept if the body is cut short and
+        deleted once it is complete
+
+        :param response: response
+        :type response: http.client.HTTPResponse
+        @return: chunks
+        @rtype: generator
+        @raise http.client.IncompleteRead: if the body is truncated or corrupt
+        """
+
+        self.open_part(response)
+        decoder = None
+        if self.encoding == "gzip":
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        received = 0
+        try:
+            for chunk in self.raw_chunks(response):
+                received += len(chunk)
+                yield decoder.decompress(chunk) if decoder else chunk
+            if decoder:
+                yield decoder.flush()
+        except zlib.error as error:
+            self.close_part()
+            self.discard()
+            raise IncompleteRead(b"") from error
+        finally:
+            self.close_part()
+        if self.length is not None and received < self.length:
+            # cut short. Resumed by the next attempt
+            raise IncompleteRead(b"", self.length - received)
+        if (self.length is not None and received > self.length) or (
+            decoder and not decoder.eof
+        ):
+            self.discard()
+            raise IncompleteRead(b"")
+        self.discard()
+
+    def close_part(self):
+        """
+        Close the part file, if open
+        """
+
+        if self.part:
+            self.part.close()
+            self.part = None
@@ -18,16 +18,15 @@
 # This program is released under the terms of the 3 clause BSD license. See the
 # LICENSE file for more information.
 
+# pylint: disable=too-many-lines
+
 import os.path
 import re
-import threading
-import urllib.request
-from socket import timeout
-from urllib.error import URLError
 
 from PyQt5.QtCore import QItemSelectionModel
 from qgis.core import (  # pylint:disable=import-error
     Qgis,
+    QgsApplication,
     QgsCoordinateReferenceSystem,
     QgsProject,
     QgsRasterLayer,
@@ -38,12 +37,12 @@ from qgis.PyQt.QtCore import (  # pylint:disable=import-error
     QSettings,
     QSortFilterProxyModel,
     Qt,
+    QTimer,
     QTranslator,
     qVersion,
 )
 from qgis.PyQt.QtGui import (  # pylint:disable=import-error
     QIcon,
-    QImage,
     QPixmap,
     QStandardItemModel,
 )
@@ -54,8 +53,24 @@ from qgis.PyQt.QtWidgets import (  # pylint:disable=import-error
 )
 
 # Import the code for the dialog
+from .catalogue_loader import CatalogueLoadTask
+from .connection_pool import POOL
 from .gui.service_dialog import ServiceDialog
-from .service_data import ApiKey, Localstore, ServiceData
+from .preview import (
+    PREVIEW_DIR,
+    PreviewDiskCache,
+    PreviewLoader,
+    PreviewMemoryCache,
+    neighbour_rows,
+)
+from .service_data import (
+    ApiKey,
+    CacheTtl,
+    Localstore,
+    ServiceData,
+    get_max_workers,
+    get_parse_processes,
+)
 from .tablemodel import TableModel
 
 # Hardcoded service .see #20 for enhancement
@@ -73,29 +88,53 @@ SER = [
 SER_TYPES = ["wmts", "wfs"]
 SER_TYPES_SKIP = {"basemaps.linz.govt.nz": ["wfs"]}
 
+# Milliseconds of typing pause before the table is filtered
+FILTER_DELAY = 200
+
 
 class CustomSortFilterProxyModel(QSortFilterProxyModel):
+    """
+    Filters the TableModel by service type and filter text. Rows
+    are matched by the source model's SearchIndex and the TableModel
+    only has the rows it accepts, so the proxy filters nothing.
+    Sorting is also left to the TableModel, which sorts the most
+    relevant rows first while the filter text is ranked
+    """
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.data_type = ("WMTS", "WFS")
 
     def set_service_type(self, service_type):
         self.data_type = service_type
-        self.invalidateFilter()
-
-    def filterAcceptsRow(self, sourceRow, sourceParent):  # pylint:disable=invalid-name
-        index2 = self.sourceModel().index(sourceRow, 2, sourceParent)  # SERVICE TYPE
-        index3 = self.sourceModel().index(sourceRow, 4, sourceParent)  # LAYER NAME
-        index4 = self.sourceModel().index(sourceRow, 0, sourceParent)  # DOMAIN
-
-        return self.sourceModel().data(index2, Qt.DisplayRole) in self.data_type and (
-            self.filterRegExp().indexIn(self.sourceModel().data(index3, Qt.DisplayRole))
-            >= 0
-            or self.filterRegExp().indexIn(
-                self.sourceModel().data(index4, Qt.DisplayRole)
-            )
-            >= 0
-        )
+        self.sourceModel().search_index.set_service_types(service_type)
+        self.refilter()
+
+    def set_filter_text(self, filter_text):
+        """
+        Filter the rows by layer name and domain (case insensitive)
+
+        :param filter_text: filter text
+        :type filter_text: str
+        """
+
+        if self.sourceModel().search_index.set_query(filter_text):
+            self.refilter()
+
+    def refilter(self):
+        """
+        Filter the rows again once the search index changes
+        """
+
+        # The source filters and sorts its rows again, as one layout
+        # change. Filtering in the proxy instead calls filterAcceptsRow()
+        # in Python for every row, too slow on every keystroke
+        self.sourceModel().update_order()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # The TableModel sorts from precomputed keys, far faster than
+        # the proxy's comparisons. The proxy keeps the source's order
+        self.sourceModel().sort(column, order)
 
 
 class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
@@ -117,6 +156,11 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
         self.services_loaded = False
         self.cache_updated = False
         self.update_cache = True  # Skip cache updates. Useful for testing.
+        self.load_task = None  # CatalogueLoadTask in progress
+        self.token_segments = {}  # doc hash: TokenSegment of the loaded feeds
+        self.filter_timer = QTimer()  # delays filtering until typing pauses
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DELAY)
 
         # initialise plugin directory
         self.plugin_dir = os.path.dirname(__file__)
@@ -153,23 +197,31 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
 
         # Instances
         self.api_key_instance = ApiKey()
+        self.cache_ttl_instance = CacheTtl()
         self.local_store = Localstore()
+        self.preview_cache = PreviewMemoryCache()
+        self.preview_loader = PreviewLoader(
+            disk_cache=PreviewDiskCache(
+                os.path.join(self.local_store.pl_settings_dir, PREVIEW_DIR)
+            )
+        )
+        self.preview_generation = None
+        # previewLoaded is emitted from the loader's worker threads
+        self.preview_loader.previewLoaded.connect(
+            self.preview_loaded_handler, Qt.QueuedConnection
+        )
+        self.preview_loader.previewPrefetched.connect(
+            self.preview_prefetched_handler, Qt.QueuedConnection
+        )
 
         self.dlg = ServiceDialog()
 
-        self.qimage = QImage
         self.domain: str
         self.data_type: str
         self.proxy_model: CustomSortFilterProxyModel
         self.table_model: TableModel
         self.selection_model: QItemSelectionModel
 
-        self.qimage = QImage
-        self.data_type: str
-        self.proxy_model: CustomSortFilterProxyModel
-        self.table_model: TableModel
-        self.selection_model: QItemSelectionModel
-
     # noinspection PyMethodMayBeStatic
     def translate(self, message):  # pylint:disable=no-self-use
         """
@@ -462,6 +514,9 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
             )
             self.iface.removeToolBarIcon(action)
         del self.toolbar
+        self.cancel_load()
+        self.preview_loader.shutdown()
+        POOL.clear()
 
     def run(self):
         """
@@ -475,10 +530,9 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
                     "Access the “Settings” tab to configure a service domain and API key."
                 )
                 self.dlg.uLabelWarning.show()
-            else:
+            elif not self.load_task:
+                # The cache is updated once loading from it has finished
                 self.load_ui()
-                if not self.cache_updated and self.update_cache:
-                    self.update_service_data_cache()
         self.dlg.show()
 
     def purge_cache(self):
@@ -490,27 +544,128 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
 
     def update_service_data_cache(self):
         """
-        Update the local cache by deleting the locally stored capability
-        documents and then re-fetching from the associated web resource
+        Update the local cache by revalidating the locally stored capability
+        documents that have outlived their domain's TTL with the associated
+        web resource. Nothing is requested while all documents are fresh
         """
 
-        self.services_loaded = False
-        thread = threading.Thread(target=self.load_all_services, args=(True,))
-        thread.start()
         self.cache_updated = True
+        if not any(
+            self.feed_is_stale(domain, service)
+            for domain, service in self.domain_services()
+        ):
+            return
+        self.load_all_services(True)
+
+    def domain_services(self):
+        """
+        Return the domain / service type feeds of the configured domains
+
+        @return: e.g. [("data.linz.govt.nz", "wfs"), ...]
+        @rtype: list
+        """
+
+        return [
+            (domain, service)
+            for domain in self.api_key_instance.get_api_keys()
+            for service in SER_TYPES
+            if service not in SER_TYPES_SKIP.get(domain, [])
+        ]
+
+    def feed_is_stale(self, domain, service):
+        """
+        Test if the cached capabilities doc of a feed has outlived
+        its domain's TTL and should be revalidated
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (WMTS or WFS)
+        :type service: str
+        @return: True if the doc is missing or older than the TTL
+        @rtype: boolean
+        """
+
+        return Localstore(domain, service).cache_is_stale(
+            self.cache_ttl_instance.get_cache_ttl(domain)
+        )
 
     def load_ui(self):
         """
-        Wrapper for loadAllServices() to handle any errors
+        Load the table data from the cache. Errors are handled
+        once loading has finished. See services_loaded_handler()
         """
 
-        load_data_err = self.load_all_services()
+        self.load_all_services()
+
+    def feed_loaded_handler(self, feed_data, segment):
+        """
+        Connected to CatalogueLoadTask.feedLoaded. Append the rows of
+        a loaded feed so the table can be searched while other feeds
+        are still loading. Runs on the GUI thread.
+
+        :param feed_data: table rows of one domain / service
+        :type feed_data: list
+        :param segment: search index tokens of the rows
+        :type segment: TokenSegment
+        """
+
+        self.table_model.appendData(feed_data, segment)
+
+    def services_loaded_handler(self, all_data, segments, load_data_err, update_cache):
+        """
+        Connected to CatalogueLoadTask.loaded. Display the loaded
+        data or any error. Runs on the GUI thread.
+
+        :param all_data: table rows
+        :type all_data: list
+        :param segments: search index tokens of each feed's rows
+        :type segments: list
+        :param load_data_err: summary of the feeds that failed or None.
+        The rows of the other feeds are loaded regardless
+        :type load_data_err: str
+        :param update_cache: True if the load updated the cache
+        :type update_cache: bool
+        """
+
+        # reused by the next load for the feeds whose doc is unchanged
+        self.token_segments = self.load_task.hashed_segments
+        self.load_task = None
+        if update_cache and (all_data or not load_data_err):
+            # failed feeds are served from the cache where possible
+            self.table_model.setData(all_data, segments)
+            self.purge_cache()
+        # else every feed failed, the cached rows are still shown
+        # else rows were appended as each feed loaded
+        self.set_section_size()
+        # loaded again when the dialog is next opened if every feed failed
+        self.services_loaded = bool(all_data) or not load_data_err
         if load_data_err:
             self.dlg.uLabelWarning.setText(load_data_err)
             self.dlg.uLabelWarning.show()
-            self.update_cache = False
         else:
             self.dlg.uLabelWarning.hide()
+        if not self.cache_updated and self.update_cache:
+            self.update_service_data_cache()
+
+    def services_failed_handler(self, err, update_cache):
+        """
+        Connected to CatalogueLoadTask.failed, e.g. when the task was
+        cancelled from the task manager. Runs on the GUI thread.
+
+        :param err: why the load did not complete
+        :type err: str
+        :param update_cache: True if the load was updating the cache
+        :type update_cache: bool
+        """
+
+        self.load_task = None
+        if update_cache:
+            # the cached rows are still shown
+            return
+        # loaded again when the dialog is next opened
+        self.services_loaded = False
+        self.dlg.uLabelWarning.setText(err)
+        self.dlg.uLabelWarning.show()
 
     def set_section_size(self):
         """
@@ -530,48 +685,75 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
             3, QHeaderView.ResizeToContents
         )
 
+    def cancel_load(self):
+        """
+        Cancel any load in progress. Its results are not handled
+        """
+
+        if not self.load_task:
+            return
+        self.load_task.feedLoaded.disconnect(self.feed_loaded_handler)
+        self.load_task.loaded.disconnect(self.services_loaded_handler)
+        self.load_task.failed.disconnect(self.services_failed_handler)
+        self.load_task.cancel()
+        self.load_task = None
+
     def load_all_services(self, update_cache=False):
         """
         Iterate over all domains and service types (WMTS, WFS).
-        Request, process, store and format capability documents
-        """
-
-        all_data = []
-        for domain in self.api_key_instance.get_api_keys():
-            for service in SER_TYPES:
-                if domain in SER_TYPES_SKIP:
-                    if service in SER_TYPES_SKIP[domain]:
-                        continue
-                # set service_data obj e.g self.linz_wms=service_data obj
-                data_feed = "{0}_{1}".format(domain, service)  # eg linz_wms
-                setattr(
-                    self,
-                    data_feed,
-                    ServiceData(
-                        domain,
-                        service,
-                        self.service_versions,
-                        self.api_key_instance,
-                        update_cache,
-                    ),
-                )
-                service_data_instance = getattr(self, data_feed)
-                self.data_feeds[
-                    data_feed
-                ] = service_data_instance  # keep record of ser data insts
-                service_data_instance.process_service_data()
-                if service_data_instance.disabled:
-                    continue
-                if service_data_instance.err:
-                    return service_data_instance.err
-                all_data.extend(service_data_instance.info)
-        self.table_model.setData(all_data)
-        self.set_section_size()
-        self.services_loaded = True
+        Request, process, store and format capability documents.
+        Feeds are fetched and parsed concurrently by a CatalogueLoadTask
+        so the dialog is never blocked. Any load in progress is cancelled
 
-        if update_cache:
-            self.purge_cache()
-        return None
+        :param update_cache: True if the cache should be updated
+        :type update_cache: bool
+        """
+
+        self.cancel_load()
+        if not update_cache:
+            # rows are appended to the table as each feed loads. A cache
+            # update replaces all rows once every feed has loaded
+            self.table_model.clearData()
+
+        feeds = []
+        for domain, service in self.domain_services():
+            # set service_data obj e.g self.linz_wms=service_data obj
+            data_feed = "{0}_{1}".format(domain, service)  # eg linz_wms
+            # rows of the previous load are reused if the
+            # server reports the cached doc as not modified
+            previous = self.data_feeds.get(data_feed)
+            setattr(
+                self,
+                data_feed,
+                ServiceData(
+                    domain,
+                    service,
+                    self.service_versions,
+                    self.api_key_instance,
+                    # docs within their TTL are served from the cache
+                    update_cache and self.feed_is_stale(domain, service),
+                    previous.info if previous else None,
+                ),
+            )
+            service_data_instance = getattr(self, data_feed)
+            self.data_feeds[
+                data_feed
+            ] = service_data_instance  # keep record of ser data insts
+            feeds.append(service_data_instance)
+
+        # keep a reference, the task manager does not
+        self.load_task = CatalogueLoadTask(
+            feeds,
+            update_cache,
+            get_max_workers(),
+            get_parse_processes(),
+            self.token_segments,
+        )
+        # feedLoaded is emitted from the task's thread
+        self.load_task.feedLoaded.connect(self.feed_loaded_handler, Qt.QueuedConnection)
+        self.load_task.loaded.connect(self.services_loaded_handler)
+        self.load_task.failed.connect(self.services_failed_handler)
+        QgsApplication.taskManager().addTask(self.load_task)
 
     def show_selected_option(self, item):
         """
@@ -622,55 +804,88 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
             if self.selected_crs:
                 self.selected_crs_int = int(self.selected_crs.strip("EPSG:"))
 
-    def get_preview(self, res, res_timeout):
-        """
-        Fetch the preview image from the internet
-
-        :param res: The resolution of the image to be fetched
-        :type res: str
-        :param res_timeout: How long the request should wait for a response
-        :type res_timeout: int
-        """
-
-        self.qimage = QImage()
-        url = (
-            "http://koordinates-tiles-d.global.ssl.fastly.net"
-            "/services/tiles/v4/thumbnail/layer={0},style=auto/{1}.png".format(
-                self.object_id, res
-            )
-        )
-        try:
-            img_data = urllib.request.urlopen(url, timeout=res_timeout).read()
-        except URLError:
-            return False
-        except timeout:
-            return False
-        self.qimage.loadFromData(img_data)
-        if res == "300x200":
-            self.dlg.uLabelImgPreview.setPixmap(QPixmap(self.qimage))
-        else:
-            self.dlg.uLabelImgPreview.setPixmap(
-                QPixmap(self.qimage).scaledToHeight(200)
-            )
-        return True
-
     def upd_preview(self):
         """
-        On the tableviews rowChanged fetch the datasets preview image
+        On the tableviews rowChanged request the datasets preview image.
+        It is fetched in the background, see preview_loaded_handler()
         """
 
+        self.dlg.uLabelImgPreview.clear()
+        # results of earlier requests may still be queued. Ignore them
+        self.preview_generation = None
         if self.data_type != "layer":
-            self.dlg.uLabelImgPreview.clear()
+            self.preview_loader.cancel()
             self.dlg.uLabelImgPreview.setText("No preview available")
             return
 
-        if self.get_preview("300x200", 0.5):
-            return
-        if self.get_preview("150x100", 5):
+        pixmap = self.preview_cache.get(self.object_id)
+        if pixmap is not None:
+            self.preview_loader.cancel()
+            self.dlg.uLabelImgPreview.setPixmap(pixmap)
             return
 
+        self.dlg.uLabelImgPreview.setText("Loading preview...")
+        self.preview_generation = self.preview_loader.request(self.object_id)
+
+    def preview_loaded_handler(self, generation, object_id, image):
+        """
+        Connected to PreviewLoader.previewLoaded. Show the preview
+        of the current selection. Runs on the GUI thread.
+
+        :param generation: request generation
+        :type generation: int
+        :param object_id: dataset id
+        :type object_id: str
+        :param image: preview image or None if not available
+        :type image: QImage
+        """
+
+        if generation != self.preview_generation:
+            # the selection has moved on
+            return
         self.dlg.uLabelImgPreview.clear()
-        self.dlg.uLabelImgPreview.setText("No preview available")
+        if image is None:
+            self.dlg.uLabelImgPreview.setText("No preview available")
+            return
+        pixmap = QPixmap.fromImage(image)
+        self.preview_cache.put(object_id, pixmap)
+        self.dlg.uLabelImgPreview.setPixmap(pixmap)
+
+    def preview_prefetched_handler(self, object_id, image):
+        """
+        Connected to PreviewLoader.previewPrefetched. Cache the
+        preview, showing it if the current selection awaits it.
+        Runs on the GUI thread.
+
+        :param object_id: dataset id
+        :type object_id: str
+        :param image: preview image
+        :type image: QImage
+        """
+
+        pixmap = QPixmap.fromImage(image)
+        self.preview_cache.put(object_id, pixmap)
+        if self.preview_generation is not None and object_id == self.object_id:
+            self.preview_loader.cancel()
+            self.preview_generation = None
+            self.dlg.uLabelImgPreview.setPixmap(pixmap)
+
+    def prefetch_previews(self, proxy_row):
+        """
+        Prefetch the previews of the table rows either side
+        of the selected row that are not yet cached
+
+        :param proxy_row: selected row of the proxy model
+        :type proxy_row: int
+        """
+
+        object_ids = []
+        for row in neighbour_rows(proxy_row, self.proxy_model.rowCount()):
+            source_index = self.proxy_model.mapToSource(self.proxy_model.index(row, 0))
+            data = self.table_model.selectedRow(source_index.row())
+            if data[1] == "layer" and data[3] not in self.preview_cache:
+                object_ids.append(data[3])
+        self.preview_loader.prefetch(object_ids)
 
     def curr_selection(self):
         """
@@ -679,12 +894,17 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
         """
 
         self.domain = self.row[0]
-        abstract = self.row[5]
         self.data_type = self.row[1]
         self.object_id = self.row[3]
         self.service = self.row[2]
         self.layer_title = self.row[4]
         crs_options = self.row[6]
+        # the table only holds the abstracts of rows not yet stored
+        abstract = self.row[5]
+        if abstract is None and self.domain:
+            abstract = self.local_store.read_abstract(
+                self.domain, self.service, self.data_type, self.object_id
+            )
         self.dlg.uCRSCombo.clear()
         if self.data_type != "table":
             self.dlg.uCRSCombo.addItems(crs_options)
@@ -707,23 +927,31 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
 
         self.curr_selection()
         self.upd_preview()
+        self.prefetch_previews(selected.row())
+
+    def filter_text_changed(self):
+        """
+        Connected to uTextFilter.textChanged. Restart the
+        delay before filtering so bursts of typing filter once
+        """
+
+        self.filter_timer.start()
 
     def filter_table(self):
         """
-        Filter the table data when uTextFilter.textChanged
+        Filter the table data once typing in uTextFilter pauses.
+        Layer names, domains, titles and abstracts are searched
         """
 
         filter_text = self.dlg.uTextFilter.text()
-        self.proxy_model.setFilterCaseSensitivity(Qt.CaseInsensitive)
-        self.proxy_model.setFilterKeyColumn(2)
-        self.proxy_model.setFilterFixedString(filter_text)
+        self.proxy_model.set_filter_text(filter_text)
 
     def set_table_model_view(self):
         """
         Connect the tableView to the proxy model to the table model
         """
         # Set Table Model
-        data = [["", "", "", "", ""]]
+        data = [["", "", "", "", "", "", []]]
 
         headers = ["domain", "type", "service", "id", "layer name", "_desc", "_crs"]
         self.proxy_model = CustomSortFilterProxyModel()
@@ -737,8 +965,9 @@ class LinzDataImporter:  # pylint: disable=too-many-instance-attributes,too-many
         self.selection_model = self.dlg.uTableView.selectionModel()
         self.selection_model.currentRowChanged.connect(self.user_selection)
 
-        # Table filtering trigger
-        self.dlg.uTextFilter.textChanged.connect(self.filter_table)
+        # Table filtering trigger. Keystrokes are coalesced
+        self.filter_timer.timeout.connect(self.filter_table)
+        self.dlg.uTextFilter.textChanged.connect(self.filter_text_changed)
 
         # Import Button Clicked
         self.dlg.uBtnImport.clicked.connect(self.import_dataset)
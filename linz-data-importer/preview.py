@@ -0,0 +1,506 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Fetch and decode dataset preview thumbnails on a worker pool.
+ Only the latest request's image is handed back to the GUI thread.
+ Fetched thumbnails are kept on disk, and decoded ones in memory, so
+ revisited datasets are previewed instantly and offline. Previews of
+ the datasets likely to be selected next are prefetched.
+"""
+
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from socket import timeout
+from urllib.error import URLError
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal  # pylint:disable=import-error
+from qgis.PyQt.QtGui import QImage  # pylint:disable=import-error
+
+from .connection_pool import build_pooled_opener
+
+PREVIEW_URL = (
+    "http://koordinates-tiles-d.global.ssl.fastly.net"
+    "/services/tiles/v4/thumbnail/layer={0},style=auto/{1}.png"
+)
+# (resolution, request timeout) in the order they are tried
+PREVIEW_RESOLUTIONS = (("300x200", 0.5), ("150x100", 5))
+PREVIEW_HEIGHT = 200
+
+MAX_PREVIEW_WORKERS = 2
+# Prefetches run on their own workers so never delay requests
+MAX_PREFETCH_WORKERS = 2
+# Table rows either side of the selection whose previews are prefetched
+PREFETCH_ROWS = 3
+
+# Sub dir of the plugin settings dir previews are cached in
+PREVIEW_DIR = "previews"
+# Bytes of preview files kept on disk
+DISK_CACHE_BUDGET = 64 * 1024 * 1024
+# Bytes of decoded previews kept in memory
+MEMORY_CACHE_BUDGET = 32 * 1024 * 1024
+
+# Previews are fetched on the shared keep-alive connections
+OPENER = build_pooled_opener()
+
+
+def fetch_preview(object_id, res, res_timeout):
+    """
+    Fetch a preview image from the internet
+
+    :param object_id: dataset id
+    :type object_id: str
+    :param res: The resolution of the image to be fetched
+    :type res: str
+    :param res_timeout: How long the request should wait for a response
+    :type res_timeout: int
+    @return: image data. None if it could not be fetched
+    @rtype: bytes
+    """
+
+    url = PREVIEW_URL.format(object_id, res)
+    try:
+        with OPENER.open(url, timeout=res_timeout) as response:
+            return response.read()
+    except (URLError, HTTPException, OSError, timeout):
+        # a dropped connection may surface as a truncated read
+        return None
+
+
+def decode_preview(img_data):
+    """
+    Decode image data, scaled to the preview height. QImage, unlike
+    QPixmap, can be used outside the GUI thread
+
+    :param img_data: image data
+    :type img_data: bytes
+    @return: image. None if the data is not an image
+    @rtype: QImage
+    """
+
+    image = QImage()
+    if not image.loadFromData(img_data):
+        return None
+    if image.height() != PREVIEW_HEIGHT:
+        image = image.scaledToHeight(PREVIEW_HEIGHT)
+    return image
+
+
+def neighbour_rows(row, row_count, count=PREFETCH_ROWS):
+    """
+    Return the rows either side of a row, nearest first
+
+    :param row: row number
+    :type row: int
+    :param row_count: number of rows
+    :type row_count: int
+    :param count: rows to return either side
+    :type count: int
+    @return: e.g. [row + 1, row - 1, row + 2, row - 2]
+    @rtype: list
+    """
+
+    rows = []
+    for offset in range(1, count + 1):
+        rows.extend(
+            neighbour
+            for neighbour in (row + offset, row - offset)
+            if 0 <= neighbour < row_count
+        )
+    return rows
+
+
+class PreviewDiskCache:
+    """
+    Preview image files keyed by dataset id and resolution. The
+    least recently used files are deleted once the files exceed
+    the size budget. Thread safe.
+    """
+
+    def __init__(self, directory, budget=DISK_CACHE_BUDGET):
+        """
+        Initialise PreviewDiskCache
+
+        :param directory: directory the files are kept in
+        :type directory: str
+        :param budget: max bytes of files kept
+        :type budget: int
+        """
+
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.size = None  # bytes of files. Summed on first write
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, object_id, res):
+        """
+        :param object_id: dataset id
+        :type object_id: str
+        :param res: image resolution
+        :type res: str
+        @return: path of the image file
+        @rtype: str
+        """
+
+        name = re.sub(r"[^\w.-]", "_", "{0}_{1}".format(object_id, res))
+        return os.path.join(self.directory, name + ".png")
+
+    def read(self, object_id, res):
+        """
+        Read a cached image and mark it as recently used
+
+        :param object_id: dataset id
+        :type object_id: str
+        :param res: image resolution
+        :type res: str
+        @return: image data. None if not cached
+        @rtype: bytes
+        """
+
+        path = self.path(object_id, res)
+        try:
+            with open(path, "rb") as file:
+                img_data = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return img_data
+
+    def write(self, object_id, res, img_data):
+        """
+        Cache an image, evicting the least recently used
+        images if over budget
+
+        :param object_id: dataset id
+        :type object_id: str
+        :param res: image resolution
+        :type res: str
+        :param img_data: image data
+        :type img_data: bytes
+        """
+
+        path = self.path(object_id, res)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _path, size, _mtime in self.files())
+            try:
+                self.size -= os.path.getsize(path)
+            except OSError:
+                pass
+            # readers never see a partly written file
+            handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(handle, "wb") as file:
+                file.write(img_data)
+            os.replace(temp_path, path)
+            self.size += len(img_data)
+            if self.size > self.budget:
+                self.evict()
+
+    def files(self):
+        """
+        @return: (path, size, mtime) of the cached images
+        @rtype: list
+        """
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def evict(self):
+        """
+        Delete the least recently used images until within budget.
+        Call with the lock held
+        """
+
+        for path, size, _mtime in sorted(self.files(), key=lambda file: file[2]):
+            if self.size <= self.budget:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+class PreviewMemoryCache:
+    """
+    Decoded preview QPixmaps keyed by dataset id. The least recently
+    used are dropped once the pixmaps exceed the size budget. QPixmaps
+    belong to the GUI thread, as must the cache
+    """
+
+    def __init__(self, budget=MEMORY_CACHE_BUDGET):
+        """
+        Initialise PreviewMemoryCache
+
+        :param budget: max bytes of pixmaps kept
+        :type budget: int
+        """
+
+        self.budget = budget
+        self.size = 0
+        self.pixmaps = OrderedDict()  # object_id: QPixmap. Most recent last
+
+    @staticmethod
+    def cost(pixmap):
+        """
+        :param pixmap: pixmap
+        :type pixmap: QPixmap
+        @return: approximate bytes of a pixmap
+        @rtype: int
+        """
+
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def __contains__(self, object_id):
+        return object_id in self.pixmaps
+
+    def get(self, object_id):
+        """
+        :param object_id: dataset id
+        :type object_id: str
+        @return: preview pixmap. None if not cached
+        @rtype: QPixmap
+        """
+
+        pixmap = self.pixmaps.get(object_id)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(object_id)
+        return pixmap
+
+    def put(self, object_id, pixmap):
+        """
+        Cache a preview pixmap
+
+        :param object_id: dataset id
+        :type object_id: str
+        :param pixmap: preview pixmap
+        :type pixmap: QPixmap
+        """
+
+        if object_id in self.pixmaps:
+            self.size -= self.cost(self.pixmaps.pop(object_id))
+        self.pixmaps[object_id] = pixmap
+        self.size += self.cost(pixmap)
+        while self.size > self.budget and len(self.pixmaps) > 1:
+            _object_id, dropped = self.pixmaps.popitem(last=False)
+            self.size -= self.cost(dropped)
+
+
+class PreviewLoader(QObject):
+    """
+    Load preview images in the background. Each request supersedes
+    the previous one. Superseded requests are cancelled if not yet
+    started, or dropped before their next fetch or their result is
+    handed back. Prefetches are handled the same way, on separate
+    workers.
+    """
+
+    # request generation, dataset id, QImage or None if no preview is available
+    previewLoaded = pyqtSignal(int, str, object)  # pylint:disable=invalid-name
+    # dataset id, QImage
+    previewPrefetched = pyqtSignal(str, object)  # pylint:disable=invalid-name
+
+    def __init__(
+        self,
+        max_workers=MAX_PREVIEW_WORKERS,
+        disk_cache=None,
+        prefetch_workers=MAX_PREFETCH_WORKERS,
+    ):
+        """
+        Initialise PreviewLoader
+
+        :param max_workers: Max concurrent requests
+        :type max_workers: int
+        :param disk_cache: cache of fetched images. None to always fetch
+        :type disk_cache: PreviewDiskCache
+        :param prefetch_workers: Max concurrent prefetches
+        :type prefetch_workers: int
+        """
+
+        super().__init__()
+        self.disk_cache = disk_cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.generation = 0
+        self.futures = []
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_workers)
+        self.prefetch_generation = 0
+        self.prefetch_futures = []
+
+    def request(self, object_id):
+        """
+        Request the preview of a dataset, superseding any previous request
+
+        :param object_id: dataset id
+        :type object_id: str
+        @return: generation of the request
+        @rtype: int
+        """
+
+        self.cancel()
+        self.futures.append(self.executor.submit(self.load, self.generation, object_id))
+        return self.generation
+
+    def cancel(self):
+        """
+        Supersede any pending request
+        """
+
+        self.generation += 1
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+
+    def prefetch(self, object_ids):
+        """
+        Fetch the previews of datasets likely to be requested next,
+        superseding any previous prefetch
+
+        :param object_ids: dataset ids, most likely first
+        :type object_ids: list
+        """
+
+        self.cancel_prefetch()
+        for object_id in object_ids:
+            self.prefetch_futures.append(
+                self.prefetch_executor.submit(
+                    self.load_prefetch, self.prefetch_generation, object_id
+                )
+            )
+
+    def cancel_prefetch(self):
+        """
+        Supersede any pending prefetch
+        """
+
+        self.prefetch_generation += 1
+        for future in self.prefetch_futures:
+            future.cancel()
+        self.prefetch_futures = []
+
+    def is_current(self, generation, prefetch=False):
+        """
+        :param generation: request or prefetch generation
+        :type generation: int
+        :param prefetch: True for a prefetch generation
+        :type prefetch: bool
+        @return: True if the request has not been superseded
+        @rtype: boolean
+        """
+
+        if prefetch:
+            return generation == self.prefetch_generation
+        return generation == self.generation
+
+    def load(self, generation, object_id):
+        """
+        Read or fetch and decode a preview. Runs in a worker thread.
+        Lower resolutions are tried if the full resolution is not
+        available
+
+        :param generation: request generation
+        :type generation: int
+        :param object_id: dataset id
+        :type object_id: str
+        """
+
+        image = self.read_cached(object_id)
+        if image is None:
+            image = self.fetch(generation, object_id)
+        if self.is_current(generation):
+            self.previewLoaded.emit(generation, object_id, image)
+
+    def load_prefetch(self, generation, object_id):
+        """
+        Read or fetch and decode a preview for the memory cache.
+        Runs in a prefetch worker thread
+
+        :param generation: prefetch generation
+        :type generation: int
+        :param object_id: dataset id
+        :type object_id: str
+        """
+
+        if not self.is_current(generation, prefetch=True):
+            return
+        image = self.read_cached(object_id)
+        if image is None:
+            image = self.fetch(generation, object_id, prefetch=True)
+        if image is not None:
+            # still worth caching if superseded
+            self.previewPrefetched.emit(object_id, image)
+
+    def read_cached(self, object_id):
+        """
+        :param object_id: dataset id
+        :type object_id: str
+        @return: the best resolution preview in the disk cache.
+        None if not cached
+        @rtype: QImage
+        """
+
+        if self.disk_cache is None:
+            return None
+        for res, _res_timeout in PREVIEW_RESOLUTIONS:
+            img_data = self.disk_cache.read(object_id, res)
+            image = decode_preview(img_data) if img_data else None
+            if image is not None:
+                return image
+        return None
+
+    def fetch(self, generation, object_id, prefetch=False):
+        """
+        Fetch a preview, caching it on disk
+
+        :param generation: request or prefetch generation
+        :type generation: int
+        :param object_id: dataset id
+        :type object_id: str
+        :param prefetch: True for a prefetch
+        :type prefetch: bool
+        @return: the best resolution preview available. None if none
+        is available or the request was superseded
+        @rtype: QImage
+        """
+
+        for res, res_timeout in PREVIEW_RESOLUTIONS:
+            if not self.is_current(generation, prefetch):
+                return None
+            img_data = fetch_preview(object_id, res, res_timeout)
+            image = decode_preview(img_data) if img_data is not None else None
+            if image is not None:
+                if self.disk_cache is not None:
+                    self.disk_cache.write(object_id, res, img_data)
+                return image
+        return None
+
+    def shutdown(self):
+        """
+        Cancel pending requests and release the worker threads
+        """
+
+        self.cancel()
+        self.cancel_prefetch()
+        self.executor.shutdown(wait=False)
+        self.prefetch_executor.shutdown(wait=False)
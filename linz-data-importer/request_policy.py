@@ -0,0 +1,183 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ How capability documents are requested. Requests time out, transient
+ failures are retried with jittered exponential backoff and a domain
+ whose requests keep failing is skipped for a cool-down period (a circuit
+ breaker) rather than holding up every load. Requests are sent on the
+ shared keep-alive connections of connection_pool.
+"""
+
+import random
+import time
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+
+from .connection_pool import POOL, build_pooled_opener
+
+# Seconds to wait for a connection, and for each read once connected
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+# Retries of a failed request, after the first attempt
+RETRIES = 2
+
+# Seconds the retry delay grows from, and its upper bound
+BACKOFF = 1.0
+BACKOFF_MAX = 30.0
+
+# Failed requests in a row before a domain is skipped,
+# and the seconds it is skipped for
+FAILURE_THRESHOLD = 2
+COOL_DOWN = 30 * 60
+
+# Server responses worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# e.g. timeouts, refused or reset connections and truncated responses
+TRANSIENT_ERRORS = (URLError, OSError, HTTPException)
+
+
+class CircuitOpen(URLError):
+    """
+    Raised in place of a request to a domain that is skipped
+    after repeated failures
+    """
+
+    def __init__(self, domain, open_until):
+        """
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param open_until: time until which the domain is skipped
+        :type open_until: float
+        """
+
+        URLError.__init__(
+            self,
+            "not requested after repeated failures. Retrying after {0}".format(
+                time.strftime("%H:%M", time.localtime(open_until))
+            ),
+        )
+        self.domain = domain
+        self.open_until = open_until
+
+
+def backoff_delay(backoff, attempt):
+    """
+    Return the delay before retrying a request. The delay is random
+    ("full jitter") so feeds failing together do not retry together
+
+    :param backoff: seconds the delay grows from
+    :type backoff: float
+    :param attempt: number of the attempt that failed. 0 for the first
+    :type attempt: int
+    @return: seconds
+    @rtype: float
+    """
+
+    return random.uniform(0, min(BACKOFF_MAX, backoff * 2**attempt))
+
+
+class RequestPolicy:
+    """
+    Make requests with timeouts, retries and a circuit breaker per
+    domain. The breakers are kept in the cache store so a failing
+    domain is also skipped by the next QGIS session
+    """
+
+    def __init__(
+        self, store, timeouts=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES
+    ):
+        """
+        Initialise RequestPolicy
+
+        :param store: store of the domains' breakers
+        :type store: linz-data-importer.cache_store.CacheStore
+        :param timeouts: (connect, read) timeouts in seconds
+        :type timeouts: tuple
+        :param retries: retries of a failed request
+        :type retries: int
+        """
+
+        self.store = store
+        self.connect_timeout, read_timeout = timeouts
+        self.retries = retries
+        self.backoff = BACKOFF
+        self.threshold = FAILURE_THRESHOLD
+        self.cool_down = COOL_DOWN
+        # shares keep-alive connections with the plugin's other requests
+        self.opener = build_pooled_opener(POOL, read_timeout)
+
+    def request(self, domain, request, read):
+        """
+        Open a request and read its response. Transient failures
+        are retried. A HTTP error response other than the transient
+        ones is raised as the server did answer
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param request: called before each attempt, returning the request
+        :type request: callable
+        :param read: called with the response, returning the result
+        :type read: callable
+        @return: the result of read
+        @raise CircuitOpen: if the domain is skipped
+        @raise URLError: if the request failed on its last attempt
+        """
+
+        open_until = self.store.open_until(domain)
+        if open_until > time.time():
+            raise CircuitOpen(domain, open_until)
+
+        attempt = 0
+        while True:
+            try:
+                with self.opener.open(request(), timeout=self.connect_timeout) as resp:
+                    result = read(resp)
+            except HTTPError as error:
+                # release the pooled connection, callers only need
+                # the status and headers
+                error.close()
+                if error.code not in RETRY_STATUS:
+                    self.store.request_succeeded(domain)
+                    raise
+                failure = error
+            except TRANSIENT_ERRORS as error:
+                failure = error
+            else:
+                self.store.request_succeeded(domain)
+                return result
+
+            if attempt >= self.retries:
+                self.give_up(domain, failure)
+            time.sleep(backoff_delay(self.backoff, attempt))
+            attempt += 1
+
+    def give_up(self, domain, failure):
+        """
+        Record the domain's request failed and raise its last failure
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param failure: the exception the last attempt failed with
+        :type failure: Exception
+        @raise URLError: the failure
+        """
+
+        self.store.request_failed(domain, self.threshold, self.cool_down)
+        if isinstance(failure, URLError):
+            raise failure
+        raise URLError(failure) from failure
@@ -0,0 +1,636 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+
+ Precomputed search index over the table rows. Each term of the
+ filter text is matched against case-folded copies of each row's
+ layer name and domain, and against an inverted index of the tokens
+ of its title and abstract. Terms are evaluated into accepted-row
+ masks the table's model filters its rows by, and matching rows are
+ ranked by relevance. Each term is only tested against the rows the
+ terms before it accept, typing refines the previous result rather
+ than rescanning all rows, and recent results are reused on backspace.
+"""
+
+import bisect
+import operator
+import re
+from array import array
+from collections import OrderedDict, deque
+from itertools import compress, count, islice, repeat
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+# Shorter terms only match whole title / abstract tokens, rather than
+# every token they prefix. Results are only ranked for longer terms
+MIN_PREFIX = 3
+
+# Relevance of a term found in the layer name / a title or abstract token
+TITLE_WEIGHT = 3
+TOKEN_WEIGHT = 1
+# Scores are summed a byte per row so must not exceed 255
+MAX_RANKED_TERMS = 255 // (TITLE_WEIGHT + TOKEN_WEIGHT)
+
+# Number of recent query results kept for reuse, e.g. on backspace
+RESULT_CACHE_SIZE = 16
+
+# Domains are matched by a code per row, held in a byte
+MAX_DOMAIN_CODES = 256
+
+
+def row_tokens(title, abstract):
+    """
+    Return the distinct case-folded tokens of a row's title and abstract
+
+    :param title: layer name as displayed
+    :type title: str
+    :param abstract: abstract or None
+    :type abstract: str
+    @return: tokens
+    @rtype: set
+    """
+
+    return set(TOKEN_REGEX.findall("{0} {1}".format(title, abstract or "").casefold()))
+
+
+def flag_rows(mask, rows):
+    """
+    Set the bytes of rows in a mask to 1. Runs in C, as
+    the rows may be many
+
+    :param mask: mask of all rows
+    :type mask: bytearray
+    :param rows: row numbers
+    :type rows: iterable
+    """
+
+    deque(map(mask.__setitem__, rows, repeat(1)), maxlen=0)
+
+
+def match_substring(values, term, rows=None):
+    """
+    Return the values containing a term
+
+    :param values: case-folded values of all rows
+    :type values: list
+    :param term: case-folded search term
+    :type term: str
+    :param rows: mask of the rows to test. All rows if None
+    :type rows: bytearray
+    @return: mask of all rows. Rows not tested may be 0
+    @rtype: bytearray
+    """
+
+    if rows is None:
+        return bytearray(map(operator.contains, values, repeat(term)))
+    mask = bytearray(len(values))
+    tested = map(operator.contains, compress(values, rows), repeat(term))
+    flag_rows(mask, compress(compress(count(), rows), tested))
+    return mask
+
+
+def combine_masks(mask1, mask2, combine):
+    """
+    Return the element wise combination of two masks of 0 / 1 bytes
+
+    :param mask1: mask
+    :type mask1: bytearray
+    :param mask2: mask of the same length
+    :type mask2: bytearray
+    :param combine: operator.and_ or operator.or_
+    :type combine: callable
+    @return: mask
+    @rtype: bytearray
+    """
+
+    # as integers the operation runs over all bytes at once
+    result = combine(int.from_bytes(mask1, "big"), int.from_bytes(mask2, "big"))
+    return bytearray(result.to_bytes(len(mask1), "big"))
+
+
+def and_masks(mask1, mask2):
+    """
+    @return: element wise AND of two masks. See combine_masks()
+    @rtype: bytearray
+    """
+
+    return combine_masks(mask1, mask2, operator.and_)
+
+
+def or_masks(mask1, mask2):
+    """
+    @return: element wise OR of two masks. See combine_masks()
+    @rtype: bytearray
+    """
+
+    return combine_masks(mask1, mask2, operator.or_)
+
+
+class TokenSegment:
+    """
+    Inverted index of the title and abstract tokens of a block of
+    rows, e.g. a feed, and of the title tokens alone. Row numbers are
+    relative to the block
+    """
+
+    def __init__(self, texts):
+        """
+        Index a block of rows. Tokenising is slow for large
+        blocks so segments are best built off the GUI thread
+
+        :param texts: (title, abstract) of each row
+        :type texts: list
+        """
+
+        postings = {}
+        title_postings = {}
+        for row_number, (title, abstract) in enumerate(texts):
+            for token in row_tokens(title, abstract):
+                token_rows = postings.get(token)
+                if token_rows is None:
+                    postings[token] = [row_number]
+                else:
+                    token_rows.append(row_number)
+            for token in row_tokens(title, None):
+                token_rows = title_postings.get(token)
+                if token_rows is None:
+                    title_postings[token] = [row_number]
+                else:
+                    token_rows.append(row_number)
+        self.length = len(texts)
+        self.postings = {
+            token: array("I", numbers) for token, numbers in postings.items()
+        }
+        self.tokens = sorted(self.postings)  # for prefix lookups
+        self.title_postings = {
+            token: array("I", numbers) for token, numbers in title_postings.items()
+        }
+        self.title_tokens = list(self.title_postings)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Index a block of table rows
+
+        :param rows: [domain, type, service, id, title, abstract, crs] rows
+        :type rows: list
+        @return: segment
+        @rtype: TokenSegment
+        """
+
+        # str() as per TableModel so None titles read as "None"
+        return cls([(str(row[4]), row[5]) for row in rows])
+
+    def matching_tokens(self, term):
+        """
+        Return the indexed tokens a term matches
+
+        :param term: case-folded search term
+        :type term: str
+        @return: tokens
+        @rtype: list
+        """
+
+        if len(term) < MIN_PREFIX:
+            return [term] if term in self.postings else []
+        first = bisect.bisect_left(self.tokens, term)
+        last = bisect.bisect_left(self.tokens, term + chr(0x10FFFF), first)
+        return self.tokens[first:last]
+
+    def title_rows(self, term):
+        """
+        Return the rows of each title token containing a term
+
+        :param term: case-folded search term
+        :type term: str
+        @return: arrays of row numbers
+        @rtype: list
+        """
+
+        tokens = self.title_tokens
+        return list(
+            map(
+                self.title_postings.__getitem__,
+                compress(tokens, map(operator.contains, tokens, repeat(term))),
+            )
+        )
+
+    def match(self, term, mask, start):
+        """
+        Flag the rows containing a token the term matches
+
+        :param term: case-folded search term
+        :type term: str
+        :param mask: mask of all rows
+        :type mask: bytearray
+        :param start: row number of the segment's first row in mask
+        :type start: int
+        """
+
+        for token in self.matching_tokens(term):
+            rows = self.postings[token]
+            if start:
+                rows = map(operator.add, rows, repeat(start))
+            flag_rows(mask, rows)
+
+
+class SearchIndex:  # pylint:disable=too-many-instance-attributes
+    """
+    Case-insensitive search of the table rows. Rows are accepted if
+    every term of the query is found in their layer name or domain,
+    or prefixes a token of their title or abstract. Only rows of
+    the selected service types are accepted
+    """
+
+    def __init__(self, rows=None):
+        """
+        Initialise SearchIndex
+
+        :param rows: table rows
+        :type rows: list
+        """
+
+        self.query = ""
+        self.terms = []
+        self.service_types = ("WMTS", "WFS")
+        self.titles = []
+        self.domains = []
+        self.domain_codes = {}  # case-folded domain: code
+        self.row_domains = bytearray()  # domain code of each row
+        self.services = []
+        self.abstracts = []  # to build segments not handed over
+        self.segments = []  # [first row number, TokenSegment or None]
+        self.term_masks = {}  # term: masks. Valid until rows change
+        # leading terms: (mask, {term: masks}) they were found with. Recent last
+        self.prefix_masks = OrderedDict()
+        self.service_mask = bytearray()  # 1 for rows of the service types
+        self.mask = bytearray()  # 1 for accepted rows
+        self.scores = bytearray()  # relevance of each row. Empty if not ranked
+        self.results = OrderedDict()  # query: (mask, scores). Recent first
+        if rows:
+            self.extend(rows)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def reset(self, rows, segments=None):
+        """
+        Replace the indexed rows. The query is kept
+
+        :param rows: table rows
+        :type rows: list
+        :param segments: TokenSegments of consecutive blocks of rows
+        :type segments: list
+        """
+
+        self.abstracts = []
+        self.titles = []
+        self.domains = []
+        self.domain_codes = {}
+        self.row_domains = bytearray()
+        self.services = []
+        self.segments = []
+        self.service_mask = bytearray()
+        self.mask = bytearray()
+        self.prefix_masks.clear()
+        self.results.clear()
+        if not segments or sum(segment.length for segment in segments) != len(rows):
+            self.extend(rows)
+            return
+        rows = iter(rows)
+        for segment in segments:
+            self.extend(list(islice(rows, segment.length)), segment)
+
+    def extend(self, rows, segment=None):
+        """
+        Index rows appended to the table
+
+        :param rows: table rows
+        :type rows: list
+        :param segment: TokenSegment of the rows. Built on first use if None
+        :type segment: TokenSegment
+        """
+
+        start = len(self.titles)
+        self.abstracts.extend([row[5] for row in rows])
+        # str() as per TableModel.data() so None titles read as "None"
+        self.titles.extend([str(row[4]).casefold() for row in rows])
+        self.domains.extend([str(row[0]).casefold() for row in rows])
+        for domain in set(self.domains[start:]):
+            self.domain_codes.setdefault(domain, len(self.domain_codes))
+        if len(self.domain_codes) <= MAX_DOMAIN_CODES:
+            self.row_domains.extend(
+                map(self.domain_codes.__getitem__, self.domains[start:])
+            )
+        self.services.extend([str(row[2]) for row in rows])
+        if rows:
+            self.segments.append([start, segment])
+        self.term_masks = {}
+        self.prefix_masks.clear()
+        self.results.clear()
+        self.service_mask.extend(self.match_services(self.services[start:]))
+        if self.terms:
+            # relevance is ranked across all rows
+            self.update()
+        else:
+            self.mask.extend(self.service_mask[start:])
+
+    def set_query(self, query):
+        """
+        Set the filter text
+
+        :param query: filter text. Whitespace separates terms
+        :type query: str
+        @return: True if the accepted rows or their ranking changed
+        @rtype: boolean
+        """
+
+        query = query.casefold()
+        if query == self.query:
+            return False
+        previous = (self.mask, self.scores)
+        refines = self.refines(query)
+        self.query = query
+        self.terms = query.split()
+        if query in self.results:
+            self.results.move_to_end(query, last=False)
+            self.mask, self.scores = self.results[query]
+        else:
+            # only the rows the previous query accepted can match
+            self.update(previous[0] if refines else None)
+        return (self.mask, self.scores) != previous
+
+    def refines(self, query):
+        """
+        Test if a query can only accept rows the current query accepts,
+        i.e. it extends the current query with more characters or terms
+
+        :param query: case-folded filter text
+        :type query: str
+        @return: True if query refines the current query
+        @rtype: boolean
+        """
+
+        if not self.terms or not query.startswith(self.query):
+            return False
+        if self.query[-1].isspace() or query[len(self.query)].isspace():
+            # terms were added, the current terms are unchanged
+            return True
+        # A short term only matches whole tokens. Once longer it
+        # also matches the tokens it prefixes
+        return len(self.terms[-1]) >= MIN_PREFIX
+
+    def set_service_types(self, service_types):
+        """
+        Set the service types rows are accepted for
+
+        :param service_types: e.g. ("WMTS", "WFS") or "WFS"
+        :type service_types: tuple
+        """
+
+        self.service_types = service_types
+        self.service_mask = self.match_services(self.services)
+        self.prefix_masks.clear()
+        self.results.clear()
+        self.update()
+
+    def update(self, candidates=None):
+        """
+        Evaluate the query and service types and keep the result. The
+        result of the longest run of leading terms evaluated before is
+        the starting point. Each further term is only tested against
+        the rows the terms before it accept
+
+        :param candidates: mask of the only rows that can be accepted, i.e.
+        the current result. The last term is only tested against these rows.
+        All rows if None
+        :type candidates: bytearray
+        """
+
+        terms = tuple(self.terms)
+        known = len(terms)
+        while known and terms[:known] not in self.prefix_masks:
+            known -= 1
+        if known:
+            self.prefix_masks.move_to_end(terms[:known])
+            mask, term_masks = self.prefix_masks[terms[:known]]
+        else:
+            mask, term_masks = bytearray(self.service_mask), {}
+        for number in range(known, len(terms)):
+            term = terms[number]
+            tested = None if number == 0 else mask
+            if candidates is not None and number == len(terms) - 1:
+                # no row the current result rejects can be accepted
+                mask = and_masks(mask, candidates)
+                tested = mask
+            if term not in term_masks:
+                # earlier masks of a repeated term cover these rows
+                term_masks = dict(term_masks)
+                term_masks[term] = self.match_term(term, tested)
+            mask = and_masks(mask, term_masks[term][2])
+            self.prefix_masks[terms[: number + 1]] = (mask, term_masks)
+        while len(self.prefix_masks) > RESULT_CACHE_SIZE:
+            self.prefix_masks.popitem(last=False)
+        self.mask = mask
+        self.scores = self.rank(term_masks)
+        self.results[self.query] = (self.mask, self.scores)
+        self.results.move_to_end(self.query, last=False)
+        while len(self.results) > RESULT_CACHE_SIZE:
+            self.results.popitem()
+
+    def match_tokens(self, term):
+        """
+        Return the rows with a title or abstract token the term matches.
+        Segments not yet built are built
+
+        :param term: case-folded search term
+        :type term: str
+        @return: mask
+        @rtype: bytearray
+        """
+
+        mask = bytearray(len(self.titles))
+        for start, segment in self.built_segments():
+            segment.match(term, mask, start)
+        return mask
+
+    def built_segments(self):
+        """
+        Return the segments, building those not yet built
+
+        @return: (first row number, TokenSegment) of each segment
+        @rtype: list
+        """
+
+        for number, (start, segment) in enumerate(self.segments):
+            if segment is None:
+                end = (
+                    self.segments[number + 1][0]
+                    if number + 1 < len(self.segments)
+                    else len(self.titles)
+                )
+                self.segments[number][1] = TokenSegment(
+                    list(zip(self.titles[start:end], self.abstracts[start:end]))
+                )
+        return self.segments
+
+    def match_title(self, term, rows=None):
+        """
+        Return the rows with a layer name containing a term. A term of
+        word characters is only found within a title token, so the
+        distinct title tokens are searched rather than each title.
+        Unless the tokens found are in more rows than are tested
+
+        :param term: case-folded search term
+        :type term: str
+        :param rows: mask of the rows to test. All rows if None
+        :type rows: bytearray
+        @return: mask of all rows. Rows not tested may be 0
+        @rtype: bytearray
+        """
+
+        if TOKEN_REGEX.fullmatch(term):
+            found = [
+                (start, segment.title_rows(term))
+                for start, segment in self.built_segments()
+            ]
+            tested = len(self.titles) if rows is None else rows.count(1)
+            if sum(len(numbers) for _, arrays in found for numbers in arrays) < tested:
+                mask = bytearray(len(self.titles))
+                for start, arrays in found:
+                    for numbers in arrays:
+                        if start:
+                            numbers = map(operator.add, numbers, repeat(start))
+                        flag_rows(mask, numbers)
+                return mask
+        return match_substring(self.titles, term, rows)
+
+    def match_term(self, term, rows=None):
+        """
+        Return the rows a term is found in. Masks of all rows are
+        kept for reuse until the rows change
+
+        :param term: case-folded search term
+        :type term: str
+        :param rows: mask of the rows to test if the term's masks are not
+        kept. All rows if None
+        :type rows: bytearray
+        @return: masks of the rows with the term in their layer name,
+        in a title or abstract token and in any of these or the domain
+        @rtype: tuple
+        """
+
+        if term in self.term_masks:
+            return self.term_masks[term]
+        title_mask = self.match_title(term, rows)
+        token_mask = self.match_tokens(term)
+        domain_mask = self.match_domains(term, rows)
+        masks = (
+            title_mask,
+            token_mask,
+            or_masks(or_masks(title_mask, token_mask), domain_mask),
+        )
+        if rows is None:
+            self.term_masks[term] = masks
+        return masks
+
+    def match_domains(self, term, rows=None):
+        """
+        Return the rows with a domain containing a term. Each distinct
+        domain is tested once, then the rows' domain codes are mapped
+
+        :param term: case-folded search term
+        :type term: str
+        :param rows: mask of the rows to test if the domains are not
+        coded. All rows if None
+        :type rows: bytearray
+        @return: mask of all rows. Rows not tested may be 0
+        @rtype: bytearray
+        """
+
+        if len(self.row_domains) != len(self.domains):
+            # too many domains to code
+            return match_substring(self.domains, term, rows)
+        table = bytearray(MAX_DOMAIN_CODES)
+        for domain, code in self.domain_codes.items():
+            table[code] = term in domain
+        return self.row_domains.translate(table)
+
+    def match_services(self, services):
+        """
+        :param services: row service types
+        :type services: list
+        @return: mask of the rows of the selected service types
+        @rtype: bytearray
+        """
+
+        return bytearray(map(operator.contains, repeat(self.service_types), services))
+
+    def ranking(self):
+        """
+        @return: True if the accepted rows are ranked by relevance
+        @rtype: boolean
+        """
+
+        return any(len(term) >= MIN_PREFIX for term in self.terms)
+
+    def rank(self, term_masks):
+        """
+        Score the relevance of the accepted rows. A term scores highest
+        when in the layer name, then when a title or abstract token
+
+        :param term_masks: {term: match_term() masks}
+        :type term_masks: dict
+        @return: score of each row. Empty if the rows are not ranked
+        @rtype: bytearray
+        """
+
+        if not self.ranking():
+            return bytearray()
+        # Add the weighted masks as integers. Each byte holds the score
+        # of a row and can not carry over into the next row's
+        total = 0
+        for term in sorted(term_masks)[:MAX_RANKED_TERMS]:
+            title_mask, token_mask, _mask = term_masks[term]
+            total += TITLE_WEIGHT * int.from_bytes(title_mask, "big")
+            total += TOKEN_WEIGHT * int.from_bytes(token_mask, "big")
+        accepted = int.from_bytes(self.mask, "big") * 0xFF
+        return bytearray((total & accepted).to_bytes(len(self.mask), "big"))
+
+    def accepts(self, row):
+        """
+        Test if a row matches the query
+
+        :param row: source row number
+        :type row: int
+        @return: True if the row is accepted
+        @rtype: boolean
+        """
+
+        return bool(self.mask[row])
+
+    def score(self, row):
+        """
+        Return the relevance of a row to the query
+
+        :param row: source row number
+        :type row: int
+        @return: score. 0 if the rows are not ranked
+        @rtype: int
+        """
+
+        if not self.scores:
+            return 0
+        return self.scores[row]
@@ -15,12 +15,30 @@
  ***************************************************************************/
 """
 
+# pylint: disable=too-many-lines
+
 import glob
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
 import os.path
 import re
+import sys
+import threading
 import time
-from urllib.error import URLError
-from urllib.request import urlopen
+import zlib
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from urllib.error import HTTPError, URLError
+from urllib.request import Request
+from xml.etree import ElementTree
 
 from owslib.wfs import WebFeatureService
 from owslib.wmts import WebMapTileService
@@ -32,6 +50,60 @@ try:
 except ImportError:
     from xml.etree.ElementTree import ParseError as XMLSyntaxError
 
+from .cache_store import STORE_FILE, CacheStore
+from .capabilities import (
+    RowStream,
+    UnsupportedCapabilities,
+    WfsExtractor,
+    WmtsExtractor,
+    crs_code,
+    extract_file_rows,
+    extract_wfs_rows,
+    extract_wmts_rows,
+    linked_crs,
+    open_document,
+    parse_dataset_id,
+    sort_crs,
+)
+from .download import CHUNK_SIZE, Download
+from .request_policy import RequestPolicy
+
+STREAM_EXTRACTORS = {"wfs": extract_wfs_rows, "wmts": extract_wmts_rows}
+# Extractors the docs are parsed with as they are downloaded
+ROW_EXTRACTORS = {"wfs": WfsExtractor, "wmts": WmtsExtractor}
+
+
+# Raised reading a truncated or corrupt gzip stream
+CORRUPT_GZIP = (EOFError, gzip.BadGzipFile, zlib.error)
+
+# Bytes at the start of a doc searched for a disabled service's message
+DISABLED_PEEK = 4096
+
+# Bump when the format of the table rows changes to invalidate stored indexes
+INDEX_VERSION = 2
+
+# Cached docs e.g. data.linz.govt.nz_wfs_20181025141022.xml
+CACHE_FILE_REGEX = re.compile(
+    r"^(?P<domain>.+)_(?P<service>wmts|wfs)_(?P<time>[0-9]+)\.xml$"
+)
+# Table rows stored by older plugin versions
+LEGACY_INDEX_REGEX = re.compile(r"^.+_(wmts|wfs)\.index(\..*\.tmp)?$")
+# Docs left part written, e.g. by a crash
+TEMP_FILE_REGEX = re.compile(r"^.+_(wmts|wfs)_[0-9]+\.xml\.[0-9]+\.tmp$")
+
+# Default number of capability documents fetched and parsed at once
+MAX_WORKERS = 4
+
+# Default number of processes capability documents are parsed in.
+# 0 parses them in the fetching threads
+PARSE_PROCESSES = 0
+
+# Seconds between checks of whether processing the feeds was cancelled
+CANCEL_POLL = 0.25
+
+# Default seconds a cached capabilities doc is served without revalidation
+CACHE_TTL = 12 * 60 * 60
+
 
 class ApiKey:
     """
@@ -79,7 +151,58 @@ class ApiKey:
         self.api_keys = self.get_api_keys()
 
 
-class Localstore:
+class CacheTtl:
+    """
+    Store the time to live of cached capabilities docs
+    for each domain. Within its TTL a cached doc is used
+    without requesting the service
+    """
+
+    def __init__(self):
+        self.cache_ttls = self.get_cache_ttls()
+
+    @staticmethod
+    def get_cache_ttls():
+        """
+        Return Domain / TTLs stored in QSettings
+
+        @return: e.g. {domain1: 3600, domain2: 86400}
+        @rtype: dict
+        """
+
+        ttls = QSettings().value("linz_data_importer/cache_ttls")
+        if not ttls:
+            return {}
+        return ttls
+
+    def get_cache_ttl(self, domain):
+        """
+        Returns the TTL related to a domain
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        @return: TTL in seconds. Defaults to CACHE_TTL
+        @rtype: int
+        """
+
+        try:
+            return int(self.cache_ttls.get(domain, CACHE_TTL))
+        except (TypeError, ValueError):
+            return CACHE_TTL
+
+    def set_cache_ttls(self, ttls):
+        """
+        Save TTLs as Qsettings Value
+
+        :param ttls: {domain1: seconds, domain2: seconds...}
+        :type ttls: dict
+        """
+
+        QSettings().setValue("linz_data_importer/cache_ttls", ttls)
+        self.cache_ttls = self.get_cache_ttls()
+
+
+class Localstore:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """
     Caching of capability documents
     """
@@ -99,10 +222,15 @@ class Localstore:
         self.domain = domain
         self.service = service
         self.xml = None
+        # hash of a doc streamed to the cache without being held
+        self.xml_hash = None
+        # cached doc that is parsed straight from the file when not held
+        self.xml_file = None
         self.pl_settings_dir = os.path.join(
             QgsApplication.qgisSettingsDirPath(), "linz-data-importer"
         )
         self.ensure_settings_dir()
+        self.store = CacheStore(self.pl_settings_dir)
         self.file = file
         if self.service:
             self.file = os.path.join(
@@ -127,10 +255,13 @@ class Localstore:
 
         if not file:
             file = self.file
-        try:
-            os.remove(file)
-        except OSError:
-            pass
+        # older caches stored the validators next to the doc
+        for path in (file, legacy_validators_file(file)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.store.delete_file(os.path.basename(file))
 
     def del_domains_xml(self, domain):
         """
@@ -145,9 +276,12 @@ class Localstore:
 
         directory = self.pl_settings_dir
         for filename in os.listdir(self.pl_settings_dir):
+            if filename.startswith(STORE_FILE):
+                continue
             if re.search(domain, filename):
                 file = os.path.join(directory, filename)
                 self.del_local_sevice_xml(file)
+        self.store.delete(domain)
 
     def del_all_local_service_xml(self, services=None):
         """
@@ -169,40 +303,29 @@ class Localstore:
 
     def purge_cache(self):
         """
-        Delete all cached documents but the
-        most current
+        Delete all cached documents but the ones referenced
+        by the store. Where the store has no reference for a
+        domain / service the most current is kept
         """
-        file_metadata = {}
-        os.chdir(self.pl_settings_dir)
-        cache_files = glob.glob("*_*_[0-9]*.xml")
 
-        # Get cache metadata
-        for filename in cache_files:
-            file_data = re.search(
-                r"(?P<domain>.*)(_)(?P<service>wmts|wfs)(_)(?P<time>[0-9]+)\.xml",
-                filename,
-            )
-            domain = file_data.group("domain")
-            service = file_data.group("service")
-            timestamp = file_data.group("time")
-            if domain not in file_metadata:
-                file_metadata[domain] = {}
-            if service not in file_metadata[domain]:
-                file_metadata[domain][service] = []
-            file_metadata[domain][service].append(timestamp)
-
-        # get list of most current
-        curr_files = []
-        for dom, service_properties in file_metadata.items():
-            for ser, file_times in service_properties.items():
-                curr_files.append(
-                    "{0}_{1}_{2}.xml".format(dom, ser, sorted(file_times)[-1])
-                )
-
-        # del old files
-        for file in cache_files:
-            if file not in curr_files:
-                self.del_local_sevice_xml(file)
+        stored_files = self.store.files()
+        cache_files = {}
+        for filename in os.listdir(self.pl_settings_dir):
+            if LEGACY_INDEX_REGEX.match(filename) or TEMP_FILE_REGEX.match(filename):
+                # superseded by the store, or never completed
+                os.remove(os.path.join(self.pl_settings_dir, filename))
+                continue
+            file_data = CACHE_FILE_REGEX.match(filename)
+            if file_data:
+                cache_files.setdefault(
+                    (file_data.group("domain"), file_data.group("service")), []
+                ).append(filename)
+
+        for files in cache_files.values():
+            keep = [file for file in files if file in stored_files] or [max(files)]
+            for file in files:
+                if file not in keep:
+                    self.del_local_sevice_xml(os.path.join(self.pl_settings_dir, file))
 
     def service_xml_is_local(self, file=None):
         """
@@ -215,13 +338,201 @@ class Localstore:
         """
 
         if not file:
-            os.chdir(self.pl_settings_dir)
-            files = glob.glob("{0}_{1}_*.xml".format(self.domain, self.service.lower()))
-            if files:
-                self.file = sorted(files)[-1]
+            latest_file = self.latest_local_service_xml()
+            if latest_file:
+                self.file = latest_file
                 return True
         return False
 
+    def latest_local_service_xml(self):
+        """
+        Return the most current cached capabilties xml doc
+        for the domain / service
+
+        @return: file path. None if no doc is cached
+        @rtype: str
+        """
+
+        entry = self.store.get(self.domain, self.service.lower())
+        if entry:
+            file = os.path.join(self.pl_settings_dir, entry["file"])
+            if os.path.exists(file):
+                return file
+        return self.adopt_local_service_xml()
+
+    def adopt_local_service_xml(self):
+        """
+        Find the most current cached doc for the domain / service by
+        its file name and record it in the store. These are docs cached
+        by older plugin versions, or copied into the settings dir
+
+        @return: file path. None if no doc is cached
+        @rtype: str
+        """
+
+        # No os.chdir() here. Feeds are read from concurrent threads
+        files = glob.glob(
+            os.path.join(
+                self.pl_settings_dir,
+                "{0}_{1}_*.xml".format(self.domain, self.service.lower()),
+            )
+        )
+        if not files:
+            return None
+        file = sorted(files)[-1]
+        validators = {}
+        try:
+            with open(legacy_validators_file(file), "r", encoding="utf-8") as fp:
+                validators = json.load(fp)
+            os.remove(legacy_validators_file(file))
+        except (OSError, ValueError):
+            pass
+        self.store.record(
+            self.domain,
+            self.service.lower(),
+            os.path.basename(file),
+            None,
+            validators,
+            os.path.getmtime(file),
+        )
+        return file
+
+    def cache_age(self):
+        """
+        Return the seconds since the cached capabilities doc
+        was fetched or last revalidated with the service
+
+        @return: age in seconds. None if no doc is cached
+        @rtype: float
+        """
+
+        if not self.latest_local_service_xml():
+            return None
+        return (
+            time.time() - self.store.get(self.domain, self.service.lower())["fetched"]
+        )
+
+    def cache_is_stale(self, ttl):
+        """
+        Test if the cached capabilities doc has outlived its TTL
+
+        :param ttl: time to live in seconds
+        :type ttl: int
+        @return: True if no doc is cached or the doc is older than ttl
+        @rtype: boolean
+        """
+
+        age = self.cache_age()
+        return age is None or age >= ttl
+
+    def read_validators(self, file=None):
+        """
+        Read the HTTP validators stored for a cached doc
+
+        :param file: cached capabilities doc file name
+        :type file: str
+        @return: e.g. {"ETag": '"abc"', "Last-Modified": "Wed, ..."}
+        @rtype: dict
+        """
+
+        if not file:
+            file = self.file
+        entry = self.store.get(self.domain, self.service.lower())
+        if not entry or entry["file"] != os.path.basename(file):
+            return {}
+        return entry["validators"]
+
+    def content_hash(self):
+        """
+        Return the hash of the capabilities doc
+
+        @return: sha1 hex digest
+        @rtype: str
+        """
+
+        if self.xml is None:
+            return self.xml_hash
+        return hashlib.sha1(self.xml).hexdigest()
+
+    def read_index(self, content_hash):
+        """
+        Read the stored table rows if they were
+        formatted from a doc with the given hash
+
+        :param content_hash: sha1 hex digest of the XML doc
+        :type content_hash: str
+        @return: table rows. None if there is no current index
+        @rtype: list
+        """
+
+        return self.store.read_rows(
+            self.domain, self.service.lower(), content_hash, INDEX_VERSION
+        )
+
+    def write_index(self, content_hash, rows, abstracts=()):
+        """
+        Store the table rows formatted from a doc and their abstracts
+
+        :param content_hash: sha1 hex digest of the XML doc
+        :type content_hash: str
+        :param rows: table rows
+        :type rows: list
+        :param abstracts: abstract of each row
+        :type abstracts: list
+        """
+
+        self.store.write_rows(
+            self.domain,
+            self.service.lower(),
+            content_hash,
+            INDEX_VERSION,
+            rows,
+            [(row[1], row[3], abstract) for row, abstract in zip(rows, abstracts)],
+        )
+
+    def read_abstracts(self):
+        """
+        Read the stored abstracts of the domain / service's layers
+
+        @return: {(type, id): abstract}
+        @rtype: dict
+        """
+
+        return self.store.read_abstracts(self.domain, self.service.lower())
+
+    def read_abstract(self, domain, service, object_type, object_id):
+        """
+        Read a layer's stored abstract
+
+        :param domain: Service Domain (e.g. data.linz.govt.nz)
+        :type domain: str
+        :param service: Service Type (WMTS or WFS)
+        :type service: str
+        :param object_type: layer or table
+        :type object_type: str
+        :param object_id: layer id
+        :type object_id: str
+        @return: abstract. None if the layer has no stored abstract
+        @rtype: str
+        """
+
+        return self.store.read_abstract(domain, service.lower(), object_type, object_id)
+
+    def open_local_service_xml(self, file=None):
+        """
+        Open the cached XML document for reading. Docs are cached
+        gzip compressed, older caches may hold plain XML.
+
+        :param file: file name
+        :type file: str
+        @return: file object yielding the decompressed XML
+        @rtype: io.BufferedIOBase
+        """
+
+        if not file:
+            file = self.file
+        return open_document(file)
+
     def read_local_service_xml(self, file=None):
         """
         Read the cached XML document
@@ -232,17 +543,101 @@ class Localstore:
 
         if not file:
             file = self.file
-        with open(file, "rb") as file_pointer:
-            self.xml = file_pointer.read()
+        try:
+            with self.open_local_service_xml(file) as file_pointer:
+                self.xml = file_pointer.read()
+        except CORRUPT_GZIP:
+            # truncated or corrupt gzip stream. The raw bytes are
+            # left to the parser to flag the doc as corrupt
+            with open(file, "rb") as file_pointer:
+                self.xml = file_pointer.read()
+
+    def stream_local_service_xml(self, file=None):
+        """
+        Use the cached XML document without reading it into memory. If
+        need be it is parsed straight from the file. Its hash is the one
+        recorded when it was cached, docs adopted into the cache are hashed
+
+        :param file: file name
+        :type file: str
+        """
+
+        if not file:
+            file = self.file
+        entry = self.store.get(self.domain, self.service.lower())
+        if entry and entry["file"] == os.path.basename(file) and entry["content_hash"]:
+            content_hash = entry["content_hash"]
+        else:
+            digest = hashlib.sha1()
+            try:
+                with self.open_local_service_xml(file) as file_pointer:
+                    for chunk in iter(lambda: file_pointer.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+            except CORRUPT_GZIP:
+                self.read_local_service_xml(file)
+                return
+            content_hash = digest.hexdigest()
+        self.xml = None
+        self.xml_file = file
+        self.xml_hash = content_hash
+
+    def temp_service_xml(self, file=None):
+        """
+        Return the name of the file a doc is written to
+        before it is committed to the cache
+
+        :param file: file name
+        :type file: str
+        @return: file name
+        @rtype: str
+        """
+
+        if not file:
+            file = self.file
+        return "{0}.{1}.tmp".format(file, threading.get_ident())
+
+    def commit_local_service_xml(self, file=None, validators=None):
+        """
+        Move the written doc into the cache and record
+        it as the domain / service's cached doc
+
+        :param file: file name
+        :type file: str
+        :param validators: the response's validators
+        :type validators: dict
+        """
+
+        if not file:
+            file = self.file
+        # readers only ever see a complete doc
+        temp_file = self.temp_service_xml(file)
+        os.replace(temp_file, file)
+        if self.xml_file == temp_file:
+            self.xml_file = file
+        self.store.record(
+            self.domain,
+            self.service.lower(),
+            os.path.basename(file),
+            self.content_hash(),
+            validators,
+        )
 
 
-class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
+class ServiceData(  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    Localstore
+):
     """
     Get, Store and Process WxS Data
     """
 
     def __init__(  # pylint:disable=too-many-arguments
-        self, domain, service, service_version, api_key_instance, upd_cache=False
+        self,
+        domain,
+        service,
+        service_version,
+        api_key_instance,
+        upd_cache=False,
+        cached_info=None,
     ):
         """
         Initialise Service Data instance
@@ -255,6 +650,11 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
         :type service_version: dict
         :param api_key_instance: API instance
         :type api_key_instance: linz-data-importer.service_data.ApiKey
+        :param upd_cache: Revalidate the cached doc against the server
+        :type upd_cache: bool
+        :param cached_info: Table rows formatted from the cached doc. Reused
+        if the server reports the doc as not modified
+        :type cached_info: list
         """
 
         self.version = service_version[service]
@@ -262,11 +662,23 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
             api_key_instance  # using one instance as the user can change keys on us
         )
         self.upd_cache = upd_cache
+        self.cached_info = cached_info
+        self.modified = True  # False if the server returned 304 Not Modified
         Localstore.__init__(self, domain, service)
+        self.request_policy = RequestPolicy(self.store)
         # Data
         self.obj = None  # owslib data obj
         self.info = None  # owslib data obj formatted for table
+        # abstracts of the rows, held from parsing until
+        # handed to the search index. See row_texts()
+        self.abstracts = None
+        # processes the doc is parsed in. See process_services()
+        self.parse_pool = None
+        # rows parsed as the doc was downloaded. See read_response()
+        self.streamed_rows = None
         self.err = None  # any errors
+        # error of a failed load the rows were served from the cache for
+        self.fallback_err = None
         self.disabled = False
         self.crs = []
 
@@ -280,8 +692,20 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
         @rtype: boolean
         """
 
+        if self.xml is not None:
+            head = self.xml
+        elif self.xml_file is not None:
+            try:
+                with self.open_local_service_xml(self.xml_file) as file_pointer:
+                    head = file_pointer.read(DISABLED_PEEK)
+            except CORRUPT_GZIP:
+                # left to the parser to flag the doc as corrupt
+                return True
+        else:
+            # parsed as it was downloaded. See read_response()
+            return True
         disbaled_str = ("Service {0} is disabled").format(self.service.upper())
-        if self.xml.find(disbaled_str.encode()) == -1:
+        if head.find(disbaled_str.encode()) == -1:
             return True
         self.disabled = True
         return False
@@ -300,7 +724,7 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
         # Plugin opened for first time
         # Read data from local store if exists
         if self.service_xml_is_local():
-            self.read_local_service_xml()
+            self.stream_local_service_xml()
         else:
             self.get_service_xml()
 
@@ -317,9 +741,7 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
         self.get_service_data()
         if self.err:
             return
-        self.get_service_obj()
-        if self.err:
-            return
+        self.parse_service_data()
 
     def process_service_data(self):
         """
@@ -327,22 +749,165 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
         """
 
         self.get_service_data()
-        if self.err:
+        if self.err and not self.fall_back_to_cache():
+            return
+
+        # The cached doc is still current. No need to parse it again
+        if not self.modified and self.cached_info is not None:
+            self.info = self.cached_info
+            return
+
+        # Nor if the doc has been parsed before. A doc with stored rows
+        # is not a disabled service's, so it is not read at all
+        self.info = self.read_index(self.content_hash())
+        if self.info is not None:
             return
 
         if not self.is_enabled():
             return
 
-        # service info obj
-        self.get_service_obj()
+        self.parse_service_data()
         if self.err == "{0}: XMLSyntaxError".format(self.domain):
             self.get_service_data_try_again()
+        if not self.err:
+            self.detach_abstracts()
+            self.write_index(self.content_hash(), self.info, self.abstracts)
+        elif self.cached_info is not None:
+            # keep the rows of the previous load
+            self.info = self.cached_info
+            self.fallback_err, self.err = self.err, None
+
+    def fall_back_to_cache(self):
+        """
+        The capabilities doc could not be fetched. Serve the cached
+        doc instead, keeping the error to report
+
+        @return: False if no doc is cached
+        @rtype: boolean
+        """
+
+        if not self.serve_cached_service_xml():
+            return False
+        self.fallback_err, self.err = self.err, None
+        return True
+
+    def processing_failed(self, error):
+        """
+        Processing the feed raised an unexpected error. Serve the
+        rows of the previous load, or else of the cached doc, keeping
+        the error to report
+
+        :param error: the error processing the feed raised
+        :type error: Exception
+        """
+
+        self.err = "Error: ({0}) {1}".format(self.domain, error)
+        try:
+            info = self.cached_info
+            if info is None and self.serve_cached_service_xml():
+                info = self.read_index(self.content_hash())
+        except Exception:  # pylint:disable=broad-except
+            # the cache may be what failed
+            info = None
+        self.info = info
+        if info is not None:
+            self.fallback_err, self.err = self.err, None
+
+    def detach_abstracts(self):
+        """
+        Move the abstracts out of the table rows. Only the
+        selected row's abstract is shown, it is read from the store
+        """
+
+        self.abstracts = [row[5] for row in self.info]
+        for row in self.info:
+            row[5] = None
+
+    def row_texts(self):
+        """
+        Return the title and abstract of each table row for the search
+        index. Abstracts not held since parsing are read from the store.
+        The held abstracts are released
+
+        @return: (title, abstract) of each row
+        @rtype: list
+        """
+
+        abstracts = self.abstracts
+        if abstracts is None:
+            stored = self.read_abstracts()
+            abstracts = [stored.get((row[1], row[3])) for row in self.info]
+        self.abstracts = None
+        return [(str(row[4]), abstract) for row, abstract in zip(self.info, abstracts)]
+
+    def parse_service_data(self):
+        """
+        Parse the capabilities doc and format it for the UI.
+        The streaming extractors are used where available
+        with owslib as the fallback
+        """
+
+        if self.stream_service_data():
+            return
+
+        # service info obj
+        if self.xml is None:
+            # owslib needs the whole doc
+            self.read_local_service_xml(self.xml_file)
+        self.get_service_obj()
         if self.err:
             return
 
         # Format the response data
         self.format_for_ui()
 
+    def stream_service_data(self):
+        """
+        Format the service data straight from the capabilities doc
+        without building owslib's document model
+
+        @return: False if the doc must be handled by owslib
+        @rtype: boolean
+        """
+
+        if self.service not in STREAM_EXTRACTORS:
+            return False
+        try:
+            self.info = self.extract_rows()
+        except UnsupportedCapabilities:
+            return False
+        except (ElementTree.ParseError,) + CORRUPT_GZIP:
+            # most likely the locally stored xml is corrupt
+            self.err = "{0}: XMLSyntaxError".format(self.domain)
+        return True
+
+    def extract_rows(self):
+        """
+        Extract the table rows from the capabilities doc, unless they
+        were parsed as it was downloaded. In a parse process if there
+        are any, otherwise in this thread
+
+        @return: table rows
+        @rtype: list
+        """
+
+        if self.streamed_rows is not None:
+            rows, self.streamed_rows = self.streamed_rows, None
+            return rows
+        extractor = STREAM_EXTRACTORS[self.service]
+        if self.xml is None:
+            # parsed straight from the cached doc
+            task = (extract_file_rows, extractor, self.xml_file, self.domain)
+        else:
+            task = (extractor, io.BytesIO(self.xml), self.domain)
+        if self.parse_pool is not None:
+            try:
+                return self.parse_pool.submit(*task).result()
+            except BrokenProcessPool:
+                # e.g. the processes could not be started
+                pass
+        return task[0](*task[1:])
+
     def get_service_obj(self):
         try:
             if self.service == "wmts":
@@ -361,63 +926,247 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
             # most likely the locally stored xml is corrupt
             self.err = "{0}: XMLSyntaxError".format(self.domain)
 
-    def get_service_xml(self):
+    def service_url(self):
         """
-        Get capability documents from the internet
+        Return the url of the capability document
+
+        @return: url
+        @rtype: str
         """
 
-        try:
-            if self.service == "wmts":
-                if self.domain == "basemaps.linz.govt.nz":
-                    url = (
-                        "https://{0}/v1/tiles/aerial/"
-                        "WMTSCapabilities.xml?api={1}".format(
-                            self.domain, self.api_key_int.get_api_key(self.domain)
-                        )
-                    )
-                else:
-                    url = (
-                        "https://{0}/services;"
-                        "key={1}/{2}/{3}/WMTSCapabilities.xml".format(
-                            self.domain,
-                            self.api_key_int.get_api_key(self.domain),
-                            self.service.lower(),
-                            self.version,
-                        )
+        url = None
+        if self.service == "wmts":
+            if self.domain == "basemaps.linz.govt.nz":
+                url = (
+                    "https://{0}/v1/tiles/aerial/"
+                    "WMTSCapabilities.xml?api={1}".format(
+                        self.domain, self.api_key_int.get_api_key(self.domain)
                     )
-
-            elif self.service == "wfs" and self.domain != "basemaps.linz.govt.nz":
+                )
+            else:
                 url = (
                     "https://{0}/services;"
-                    "key={1}/{2}?service={3}&version={4}"
-                    "&request=GetCapabilities".format(
+                    "key={1}/{2}/{3}/WMTSCapabilities.xml".format(
                         self.domain,
                         self.api_key_int.get_api_key(self.domain),
                         self.service.lower(),
-                        self.service.upper(),
                         self.version,
                     )
                 )
-            with urlopen(url) as xml:
-                self.xml = xml.read()
 
-            # write to cache
-            with open(self.file, "wb") as file_pointer:
-                file_pointer.write(self.xml)
+        elif self.service == "wfs" and self.domain != "basemaps.linz.govt.nz":
+            url = (
+                "https://{0}/services;"
+                "key={1}/{2}?service={3}&version={4}"
+                "&request=GetCapabilities".format(
+                    self.domain,
+                    self.api_key_int.get_api_key(self.domain),
+                    self.service.lower(),
+                    self.service.upper(),
+                    self.version,
+                )
+            )
+        return url
+
+    def conditional_headers(self, file):
+        """
+        Return the request headers that ask the server to only
+        send the doc if it differs from the cached doc
+
+        :param file: cached capabilities doc file name
+        :type file: str
+        @return: request headers
+        @rtype: dict
+        """
+
+        headers = {}
+        if not file:
+            return headers
+        validators = self.read_validators(file)
+        if validators.get("ETag"):
+            headers["If-None-Match"] = validators["ETag"]
+        if validators.get("Last-Modified"):
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+        return headers
+
+    def not_modified(self, file, headers):
+        """
+        The server has confirmed the cached doc is current.
+        Touch the cached doc and read it rather than
+        writing a new copy to the cache
+
+        :param file: cached capabilities doc file name
+        :type file: str
+        :param headers: 304 response headers
+        :type headers: http.client.HTTPMessage
+        """
+
+        self.modified = False
+        self.file = file
+        os.utime(self.file)
+        validators = self.read_validators()
+        validators.update(response_validators(headers))
+        self.store.revalidated(self.domain, self.service.lower(), validators)
+        self.stream_local_service_xml()
+
+    def serve_cached_service_xml(self):
+        """
+        Serve the latest cached doc as if the server
+        had reported it as not modified
+
+        @return: False if no doc is cached
+        @rtype: boolean
+        """
+
+        file = self.latest_local_service_xml()
+        if not file:
+            return False
+        self.modified = False
+        self.file = file
+        self.stream_local_service_xml()
+        return True
+
+    def get_service_xml(self):
+        """
+        Get capability documents from the internet. When
+        updating the cache, the cached doc is revalidated
+        """
+
+        try:
+            cached_file = None
+            if self.upd_cache:
+                cached_file = self.latest_local_service_xml()
+            try:
+                validators = self.fetch_service_xml(cached_file)
+            except HTTPError as error:
+                if error.code != 304 or not cached_file:
+                    raise
+                error.close()
+                self.not_modified(cached_file, error.headers)
+                return
+
+            # the doc was written as it was downloaded
+            self.commit_local_service_xml(validators=validators)
 
         except URLError as error:
-            if hasattr(error, "reason"):
-                self.err = "Error: ({0}) {1}".format(self.domain, error.reason)
+            # HTTPErrors are URLErrors, with the status message as the reason
+            self.err = "Error: ({0}) {1}".format(self.domain, error.reason)
+
+    def fetch_service_xml(self, cached_file=None):
+        """
+        Request the capability document. See RequestPolicy
+
+        :param cached_file: cached doc to revalidate. None for a full request
+        :type cached_file: str
+        @return: the response's validators
+        @rtype: dict
+        """
+
+        with Download(
+            self.store, self.pl_settings_dir, self.domain, self.service.lower()
+        ) as download:
+            try:
+                return self.request_service_xml(cached_file, download)
+            except HTTPError as error:
+                # the partial download is complete or does not match
+                if error.code != 416:
+                    raise
+                error.close()
+                download.discard()
+            return self.request_service_xml(cached_file, download)
+
+    def request_service_xml(self, cached_file, download):
+        """
+        Request the capability document, resuming any partial download
+
+        :param cached_file: cached doc to revalidate. None for a full request
+        :type cached_file: str
+        :param download: download of the doc
+        :type download: linz-data-importer.download.Download
+        @return: the response's validators
+        @rtype: dict
+        """
+
+        def service_request():
+            # per attempt, as an attempt can leave a partial download
+            headers = download.resume_headers() or self.conditional_headers(cached_file)
+            headers["Accept-Encoding"] = "gzip"
+            return Request(self.service_url(), headers=headers)
+
+        return self.request_policy.request(
+            self.domain,
+            service_request,
+            lambda response: self.read_response(response, download),
+        )
+
+    def read_response(self, response, download):
+        """
+        Stream the capability document to a temporary cache file and
+        parse it as it is downloaded. Otherwise it is parsed from the
+        file later, and only read into memory for owslib.
+        See commit_local_service_xml()
+
+        :param response: response
+        :type response: http.client.HTTPResponse
+        :param download: download of the doc
+        :type download: linz-data-importer.download.Download
+        @return: the response's validators
+        @rtype: dict
+        """
+
+        temp_file = self.temp_service_xml()
+        try:
+            with gzip.open(temp_file, "wb", compresslevel=6) as file_pointer:
+                self.streamed_rows = self.stream_response(
+                    download.chunks(response), file_pointer
+                )
+        except BaseException:
+            # e.g. a failed attempt. Nothing is left half written
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+        self.xml = None
+        # parsed from the file if the rows could not be streamed
+        self.xml_file = None if self.streamed_rows is not None else temp_file
+        return response_validators(response.headers)
 
-            elif hasattr(error, "code"):
-                self.err = "Error: ({0}) {1}".format(self.domain, error.reason)
+    def stream_response(self, chunks, file_pointer):
+        """
+        Write the decoded response to the file, hashing and
+        parsing it at the same time
+
+        :param chunks: the decoded response. See Download.chunks()
+        :type chunks: generator
+        :param file_pointer: file to write the doc to
+        :type file_pointer: gzip.GzipFile
+        @return: table rows. None if the doc could not be parsed as it
+        was downloaded
+        @rtype: list
+        """
+
+        digest = hashlib.sha1()
+        stream = None
+        if self.service in ROW_EXTRACTORS and self.parse_pool is None:
+            stream = RowStream(ROW_EXTRACTORS[self.service](self.domain))
+        for chunk in chunks:
+            digest.update(chunk)
+            file_pointer.write(chunk)
+            if stream is not None:
+                try:
+                    stream.feed(chunk)
+                except (UnsupportedCapabilities, ElementTree.ParseError):
+                    # left to parse_service_data()
+                    stream = None
+        self.xml_hash = digest.hexdigest()
+        if stream is None:
+            return None
+        try:
+            return stream.close()
+        except (UnsupportedCapabilities, ElementTree.ParseError):
+            return None
 
     def sort_crs(self):
-        # wfs returns some no valid crs values
-        valid = re.compile(r"^EPSG:\d+")
-        self.crs = [s for s in self.crs if valid.match(s)]
-        # sort
-        self.crs.sort(key=lambda x: int(x.split(":")[1]))
+        self.crs = sort_crs(self.crs)
 
     def format_for_ui(self):
         """
@@ -426,24 +1175,22 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
 
         service_data = []
         cont = self.obj.contents
-        full_id_regex = re.compile(
-            r"([aA-zZ]+\\.[aA-zZ]+\\.[aA-zZ]+\\.[aA-zZ]+\\:)?(?P<type>[aA-zZ]+)-(?P<id>[0-9]+)"
-        )
+        if self.service == "wmts":
+            # Resolved once. Not per layer
+            tms = self.obj.tilematrixsets
+            tms_crs = {
+                tms_id: "EPSG:{0}".format(crs_code(tile_matrix_set.crs))
+                for tms_id, tile_matrix_set in tms.items()
+            }
+            shared_crs = {}
         for _dataset_id, dataset_obj in cont.items():
             self.crs = []
-            if self.domain == "basemaps.linz.govt.nz":
-                object_id = dataset_obj.id
-                object_type = "layer"
-            else:
-                full_id = full_id_regex.search(dataset_obj.id)
-                object_type = full_id.group("type")
-                object_id = full_id.group("id")
+            object_type, object_id = parse_dataset_id(self.domain, dataset_obj.id)
             # Get and standarise espg codes
             if self.service == "wmts":
-                tms = self.obj.tilematrixsets
-                ogc_crs = [tms[t].crs for t in tms]
-                self.crs = ["EPSG:{0}".format(item.split(":")[-1]) for item in ogc_crs]
-                self.sort_crs()
+                self.crs = linked_crs(
+                    dataset_obj.tilematrixsetlinks, tms_crs, shared_crs
+                )
             elif self.service == "wfs":
                 self.crs = dataset_obj.crsOptions
                 self.crs = ["EPSG:{0}".format(item.code) for item in self.crs]
@@ -462,3 +1209,191 @@ class ServiceData(Localstore):  # pylint: disable=too-many-instance-attributes
             )
 
         self.info = service_data
+
+
+def legacy_validators_file(file):
+    """
+    Return the path of the file older plugin versions stored
+    the HTTP validators (ETag / Last-Modified) of a cached doc in
+
+    :param file: cached capabilities doc file name
+    :type file: str
+    @return: file name
+    @rtype: str
+    """
+
+    return "{0}.json".format(file)
+
+
+def response_validators(headers):
+    """
+    Return the validators (ETag / Last-Modified) of a HTTP response
+
+    :param headers: response headers
+    :type headers: http.client.HTTPMessage
+    @return: e.g. {"ETag": '"abc"', "Last-Modified": "Wed, ..."}
+    @rtype: dict
+    """
+
+    return {
+        name: headers[name] for name in ("ETag", "Last-Modified") if headers.get(name)
+    }
+
+
+def get_max_workers():
+    """
+    Return the number of capability documents to fetch and
+    parse concurrently as stored in QSettings
+
+    @return: number of worker threads
+    @rtype: int
+    """
+
+    workers = QSettings().value("linz_data_importer/max_workers", MAX_WORKERS)
+    try:
+        return max(1, int(workers))
+    except (TypeError, ValueError):
+        return MAX_WORKERS
+
+
+def get_parse_processes():
+    """
+    Return the number of processes to parse capability
+    documents in as stored in QSettings
+
+    @return: number of processes. 0 to parse in the fetching threads
+    @rtype: int
+    """
+
+    processes = QSettings().value("linz_data_importer/parse_processes", PARSE_PROCESSES)
+    try:
+        return max(0, int(processes))
+    except (TypeError, ValueError):
+        return PARSE_PROCESSES
+
+
+def python_executable():
+    """
+    Return the Python interpreter to start parse processes with.
+    Within QGIS sys.executable is QGIS itself
+
+    @return: path. None if no interpreter is found
+    @rtype: str
+    """
+
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    if os.name == "nt":
+        candidates = [os.path.join(sys.exec_prefix, "python.exe")]
+    else:
+        candidates = [
+            os.path.join(sys.exec_prefix, "bin", name)
+            for name in (
+                "python{0}.{1}".format(*sys.version_info[:2]),
+                "python3",
+            )
+        ]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def parse_process_pool(processes):
+    """
+    Return a pool of processes to parse capability documents in.
+    Parsing is CPU bound, the processes are not limited by the GIL
+
+    :param processes: number of processes
+    :type processes: int
+    @return: pool. None if processes is 0 or no interpreter is found
+    @rtype: concurrent.futures.ProcessPoolExecutor
+    """
+
+    executable = python_executable()
+    if processes < 1 or not executable:
+        return None
+    # spawned, as forking a process running Qt is unsafe
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(executable)
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+
+def process_services(
+    service_data_instances,
+    max_workers=None,
+    progress=None,
+    parse_processes=None,
+    cancelled=None,
+):
+    """
+    Get, process and format the service data of many ServiceData
+    instances concurrently using a bounded pool of worker threads.
+    Each instance is a single domain / service type feed. The
+    documents can be parsed in a pool of processes
+
+    :param service_data_instances: ServiceData instances to process
+    :type service_data_instances: list
+    :param max_workers: Max concurrent feeds. Defaults to get_max_workers()
+    :type max_workers: int
+    :param progress: called with (ServiceData instance, feeds processed,
+    total feeds) as each feed completes. Called from the thread that
+    called process_services
+    :type progress: callable
+    :param parse_processes: number of processes to parse the documents in.
+    0 to parse in the worker threads. Defaults to get_parse_processes()
+    :type parse_processes: int
+    :param cancelled: polled while the feeds are processed. Feeds not yet
+    started are dropped, and no more are reported, once it returns True
+    :type cancelled: callable
+    """
+
+    if max_workers is None:
+        max_workers = get_max_workers()
+    if parse_processes is None:
+        parse_processes = get_parse_processes()
+    parse_pool = parse_process_pool(parse_processes)
+    for service_data_instance in service_data_instances:
+        service_data_instance.parse_pool = parse_pool
+    try:
+        process_feeds(service_data_instances, max_workers, progress, cancelled)
+    finally:
+        for service_data_instance in service_data_instances:
+            service_data_instance.parse_pool = None
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+
+def process_feeds(service_data_instances, max_workers, progress, cancelled=None):
+    """
+    Process the ServiceData instances in a pool of worker threads.
+    See process_services()
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(service_data_instance.process_service_data): (
+                service_data_instance
+            )
+            for service_data_instance in service_data_instances
+        }
+        pending = set(futures)
+        done = 0
+        while pending:
+            completed, pending = wait(
+                pending, timeout=CANCEL_POLL, return_when=FIRST_COMPLETED
+            )
+            if cancelled and cancelled():
+                # feeds being processed are left to finish
+                for future in pending:
+                    future.cancel()
+                return
+            for future in completed:
+                try:
+                    future.result()
+                except Exception as error:  # pylint:disable=broad-except
+                    # a failed feed does not hold up the others
+                    futures[future].processing_failed(error)
+                done += 1
+                if progress:
+                    progress(futures[future], done, len(futures))
@@ -15,13 +15,98 @@
  ***************************************************************************/
 """
 
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import compress, count, repeat
+from operator import is_, is_not, itemgetter, lt, ne, not_
+
 from qgis.PyQt.QtCore import (  # pylint:disable=import-error
     QAbstractTableModel,
+    QModelIndex,
     QSortFilterProxyModel,
     Qt,
 )
 from qgis.PyQt.QtWidgets import QComboBox, QCompleter  # pylint:disable=import-error
 
+try:
+    from .search_index import SearchIndex
+except ImportError:
+    # Also imported as a top level module for ExtendedCombobox
+    # by the dialog's .ui file
+    from search_index import SearchIndex
+
+# domain, type, service, id and layer name. Description and crs are hidden
+DISPLAY_COLUMNS = 5
+# columns with few distinct values
+INTERNED_COLUMNS = (0, 1, 2)
+ID_COLUMN = 3
+# domain, service, type and id. Rows are matched by these when refreshed
+KEY_COLUMNS = (0, 2, 1, 3)
+# typed value a cell sorts by
+SORT_ROLE = Qt.UserRole
+
+
+def longest_increasing(values):
+    """
+    Return the positions of a longest increasing subsequence of values
+
+    :param values: distinct values
+    :type values: list
+    @return: positions, ascending
+    @rtype: list
+    """
+
+    tails = []  # least last value of a subsequence of each length
+    tail_positions = []
+    previous = [-1] * len(values)  # position before each in its subsequence
+    for position, value in enumerate(values):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_positions.append(position)
+        else:
+            tails[length] = value
+            tail_positions[length] = position
+        if length:
+            previous[position] = tail_positions[length - 1]
+    positions = []
+    position = tail_positions[-1] if tail_positions else -1
+    while position >= 0:
+        positions.append(position)
+        position = previous[position]
+    return positions[::-1]
+
+
+def differing(old_rows, new_rows, columns):
+    """
+    Return the rows with a value that differs from their previous value
+
+    :param old_rows: previous row number of each row
+    :type old_rows: list
+    :param new_rows: row numbers
+    :type new_rows: list
+    :param columns: (previous values, values) of each column
+    :type columns: list
+    @return: row numbers
+    @rtype: set
+    """
+
+    rows = set()
+    for old_values, new_values in columns:
+        rows.update(
+            compress(
+                new_rows,
+                map(
+                    ne,
+                    map(old_values.__getitem__, old_rows),
+                    map(new_values.__getitem__, new_rows),
+                ),
+            )
+        )
+    return rows
+
+
 ## Below model not currently in-use
 # class TableView(QTableView):
 #
@@ -50,9 +135,18 @@ from qgis.PyQt.QtWidgets import QComboBox, QCompleter  # pylint:disable=import-e
 #         self.setEditTriggers(QAbstractItemView.AllEditTriggers)
 
 
-class TableModel(QAbstractTableModel):
+class TableModel(  # pylint:disable=too-many-instance-attributes,too-many-public-methods
+    QAbstractTableModel
+):
     """
-    models that represent table data data as a two-dimensional array of items
+    models that represent table data data as a two-dimensional array of items.
+
+    Rows are stored by column. The displayed columns hold precomputed
+    display strings, with the repeated domain, type and service values
+    interned. Abstracts and crs lists are kept in side arrays. Rows are
+    filtered and sorted by the model itself, the model rows being the
+    stored rows the search index accepts, in sort order. Refreshed rows
+    are matched to the stored rows, see setData()
     """
 
     def __init__(self, data, headers, parent=None):
@@ -68,8 +162,81 @@ class TableModel(QAbstractTableModel):
         """
 
         QAbstractTableModel.__init__(self, parent)
-        self.arraydata = data
         self.header = headers
+        # display strings of the domain, type, service, id and layer name
+        self.columns = [[] for _column in range(DISPLAY_COLUMNS)]
+        self.abstracts = []
+        self.crs = []
+        self.crs_lists = {}  # crs tuple: list shared by the rows
+        self.order = array("I")  # stored row of each model row. Accepted only
+        self.sort_column = -1
+        self.sort_order = Qt.AscendingOrder
+        self.keys = {}  # column: sort keys. Valid until rows change
+        # (column, order, stored rows sorted by column, getter of their items)
+        self.column_order = None
+        # kept in step with the stored rows. See CustomSortFilterProxyModel
+        self.search_index = SearchIndex(data)
+        self.add_rows(data)
+        self.order = self.sorted_rows()
+
+    def stored_columns(self, data):
+        """
+        :param data: List of lists of row data
+        :param data: 2d array
+        @return: display columns, abstracts and crs of the rows as stored
+        @rtype: tuple
+        """
+
+        columns = []
+        for column in range(DISPLAY_COLUMNS):
+            if column in INTERNED_COLUMNS:
+                columns.append([sys.intern(str(row[column])) for row in data])
+            else:
+                columns.append([str(row[column]) for row in data])
+        return (
+            columns,
+            [row[5] for row in data],
+            [self.shared_crs(row[6]) for row in data],
+        )
+
+    def add_rows(self, data):
+        """
+        Store rows after the stored rows. They are not yet model rows
+
+        :param data: List of lists of row data
+        :param data: 2d array
+        """
+
+        columns, abstracts, crs = self.stored_columns(data)
+        for values, new_values in zip(self.columns, columns):
+            values.extend(new_values)
+        self.abstracts.extend(abstracts)
+        self.crs.extend(crs)
+        self.keys = {}
+        self.column_order = None
+
+    def clear_rows(self):
+        """
+        Remove all stored rows
+        """
+
+        self.columns = [[] for _column in range(DISPLAY_COLUMNS)]
+        self.abstracts = []
+        self.crs = []
+        self.crs_lists = {}
+        self.order = array("I")
+        self.keys = {}
+        self.column_order = None
+
+    def shared_crs(self, crs):
+        """
+        :param crs: crs of a row
+        :type crs: list
+        @return: an equal list shared by all rows with the same crs
+        @rtype: list
+        """
+
+        return self.crs_lists.setdefault(tuple(crs), crs)
 
     def rowCount(self, parent):  # pylint:disable=invalid-name,unused-argument
         """
@@ -81,7 +248,7 @@ class TableModel(QAbstractTableModel):
         :rtype: int
         """
 
-        return len(self.arraydata)
+        return len(self.order)
 
     def columnCount(self, parent):  # pylint:disable=invalid-name,unused-argument
         """
@@ -93,10 +260,7 @@ class TableModel(QAbstractTableModel):
         :rtype: int
         """
 
-        try:
-            return len(self.arraydata[0]) - 2  # hiding description
-        except (IndexError, ValueError):
-            return 0
+        return DISPLAY_COLUMNS  # hiding description and crs
 
     def data(self, index, role):
         """
@@ -104,7 +268,7 @@ class TableModel(QAbstractTableModel):
 
         :param parent: QModelIndex
         :param parent: PyQt4.QtCore.QModelIndex
-        :param role: DisplayRole
+        :param role: DisplayRole or SORT_ROLE
         :param role: int
         :return: Data related to index
         :rtype: str
@@ -112,23 +276,325 @@ class TableModel(QAbstractTableModel):
 
         if not index.isValid():
             return None
-        if role != Qt.DisplayRole:
-            return None
-        return str(self.arraydata[index.row()][index.column()])
+        if role == Qt.DisplayRole:
+            return self.columns[index.column()][self.order[index.row()]]
+        if role == SORT_ROLE:
+            return self.sort_value(index.column(), self.order[index.row()])
+        return None
+
+    def sort_value(self, column, stored_row):
+        """
+        Return the typed value a cell sorts by. Numeric ids sort as numbers
+
+        :param column: column number
+        :type column: int
+        :param stored_row: stored row number
+        :type stored_row: int
+        @return: value
+        @rtype: str or int
+        """
+
+        value = self.columns[column][stored_row]
+        if column == ID_COLUMN and value.isdigit():
+            return int(value)
+        return value
+
+    def sort_keys(self, column):
+        """
+        Return the sort keys of a column's stored rows
+
+        :param column: column number
+        :type column: int
+        @return: keys
+        @rtype: list
+        """
+
+        if column not in self.keys:
+            if column == ID_COLUMN:
+                # numeric ids in numeric order, then any other ids
+                self.keys[column] = [
+                    (0, int(value), "") if value.isdigit() else (1, 0, value)
+                    for value in self.columns[column]
+                ]
+            else:
+                self.keys[column] = self.columns[column]
+        return self.keys[column]
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """
+        Sort the rows by a column. While the search index ranks the
+        rows the most relevant are first, then sorted by the column
+
+        :param column: column number. -1 for the stored order
+        :type column: int
+        :param order: sort order
+        :type order: Qt.SortOrder
+        """
+
+        self.sort_column = column
+        self.sort_order = order
+        self.update_order()
+
+    def sorted_rows(self):
+        """
+        @return: the stored rows the search index accepts, in sort order
+        @rtype: array
+        """
+
+        mask = self.search_index.mask
+        if self.sort_column < 0:
+            rows = compress(range(len(self.abstracts)), mask)
+        else:
+            if self.column_order is None or self.column_order[:2] != (
+                self.sort_column,
+                self.sort_order,
+            ):
+                rows = sorted(
+                    range(len(self.abstracts)),
+                    key=self.sort_keys(self.sort_column).__getitem__,
+                    reverse=self.sort_order == Qt.DescendingOrder,
+                )
+                # gets the mask in column order without a Python call per row
+                getter = (
+                    itemgetter(*rows)
+                    if len(rows) > 1
+                    else lambda items: [items[row] for row in rows]
+                )
+                self.column_order = (self.sort_column, self.sort_order, rows, getter)
+            rows, getter = self.column_order[2:]
+            rows = compress(rows, getter(mask))
+        scores = self.search_index.scores
+        if scores:
+            # stable, so rows of equal relevance stay in column order
+            rows = sorted(rows, key=scores.__getitem__, reverse=True)
+        return array("I", rows)
+
+    def update_order(self):
+        """
+        Filter and sort the rows again as the search index's result
+        changes. Views and proxies process the new layout, rather than
+        the proxy filtering each row
+        """
+
+        self.layoutAboutToBeChanged.emit()
+        old_order = self.order
+        self.order = self.sorted_rows()
+        indexes = self.persistentIndexList()
+        if indexes:
+            rows = dict(zip(self.order, count()))
+            new_indexes = []
+            for index in indexes:
+                row = rows.get(old_order[index.row()])
+                # rows filtered out are no longer valid
+                new_indexes.append(
+                    QModelIndex() if row is None else self.index(row, index.column())
+                )
+            self.changePersistentIndexList(indexes, new_indexes)
+        self.layoutChanged.emit()
 
-    def setData(self, data):  # pylint:disable=invalid-name
+    def is_sorted(self):
         """
-        Sets the role data for the item at index to value
+        @return: True if the rows are not in stored order
+        @rtype: boolean
+        """
+
+        return self.sort_column >= 0 or bool(self.search_index.scores)
+
+    def setData(self, data, segments=None):  # pylint:disable=invalid-name
+        """
+        Replace the rows, e.g. as the catalogue is refreshed. Rows are
+        matched to the current rows by domain, service, type and id.
+        Views and proxies are only told of the rows removed, added,
+        changed or moved by the new sort order, so the selection and
+        scroll position are kept
 
         :param data: List of lists of row data
         :param data: 2d array
+        :param segments: search index TokenSegments of consecutive blocks of rows
+        :type segments: list
+        """
+
+        columns, abstracts, crs = self.stored_columns(data)
+        keys = dict(zip(zip(*(columns[column] for column in KEY_COLUMNS)), count()))
+        # new stored row of each stored row. None if removed
+        new_rows = list(
+            map(keys.get, zip(*(self.columns[column] for column in KEY_COLUMNS)))
+        )
+        old_rows = list(compress(count(), map(is_not, new_rows, repeat(None))))
+        kept_rows = list(map(new_rows.__getitem__, old_rows))
+        if len(keys) != len(data) or len(set(kept_rows)) != len(kept_rows):
+            # rows can not be told apart
+            self.replace_rows(data, segments)
+            return
+        self.remove_rows(
+            compress(
+                count(), map(is_, map(new_rows.__getitem__, self.order), repeat(None))
+            )
+        )
+        changed = differing(
+            old_rows,
+            kept_rows,
+            zip(self.columns + [self.abstracts, self.crs], columns + [abstracts, crs]),
+        )
+        old_results = (
+            self.search_index.mask,
+            self.search_index.scores or bytes(len(new_rows)),
+        )
+
+        self.columns, self.abstracts, self.crs = columns, abstracts, crs
+        self.order = array("I", map(new_rows.__getitem__, self.order))
+        self.keys = {}
+        self.column_order = None
+        self.search_index.reset(data, segments)
+        # rows the search index now accepts or ranks differently
+        changed.update(
+            differing(
+                old_rows,
+                kept_rows,
+                zip(
+                    old_results,
+                    (
+                        self.search_index.mask,
+                        self.search_index.scores or bytes(len(data)),
+                    ),
+                ),
+            )
+        )
+
+        self.move_rows(self.sorted_rows())
+        for row in compress(count(), map(changed.__contains__, self.order)):
+            self.dataChanged.emit(
+                self.index(row, 0), self.index(row, DISPLAY_COLUMNS - 1)
+            )
+
+    def move_rows(self, target):
+        """
+        Bring the rows into the target order. Rows not in the target
+        or out of its order are removed, then they and the stored rows
+        not in the order are inserted in the target order
+
+        :param target: the stored rows to show in order
+        :type target: array
+        """
+
+        positions = array("i", [-1]) * len(self.abstracts)
+        for row, stored_row in enumerate(target):
+            positions[stored_row] = row
+        order_positions = list(map(positions.__getitem__, self.order))
+        shown = list(compress(count(), map(ne, order_positions, repeat(-1))))
+        if len(shown) == len(order_positions) and all(
+            map(lt, order_positions, order_positions[1:])
+        ):
+            kept = set(self.order)
+        else:
+            in_order = longest_increasing(list(map(order_positions.__getitem__, shown)))
+            kept = set(map(self.order.__getitem__, map(shown.__getitem__, in_order)))
+            self.remove_rows(
+                compress(count(), map(not_, map(kept.__contains__, self.order)))
+            )
+        self.insert_rows(
+            target, compress(count(), map(not_, map(kept.__contains__, target)))
+        )
+
+    def remove_rows(self, rows):
+        """
+        Remove rows, signalling each run of adjacent rows
+
+        :param rows: row numbers, ascending
+        :type rows: iterable
+        """
+
+        rows = list(rows)
+        while rows:
+            first = last = rows.pop()
+            while rows and rows[-1] == first - 1:
+                first = rows.pop()
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.order[first : last + 1]
+            self.endRemoveRows()
+
+    def insert_rows(self, target, rows):
+        """
+        Insert stored rows, signalling each run of adjacent
+        rows, so the order becomes the target order
+
+        :param target: the stored rows to show in order
+        :type target: array
+        :param rows: row numbers in the target order of the stored rows
+        not in the order, ascending
+        :type rows: iterable
+        """
+
+        rows = list(rows)
+        number = 0
+        while number < len(rows):
+            end = number + 1
+            while end < len(rows) and rows[end] == rows[end - 1] + 1:
+                end += 1
+            first, last = rows[number], rows[end - 1]
+            self.beginInsertRows(QModelIndex(), first, last)
+            self.order[first:first] = target[first : last + 1]
+            self.endInsertRows()
+            number = end
+
+    def replace_rows(self, data, segments=None):
+        """
+        Replace all rows
+
+        :param data: List of lists of row data
+        :param data: 2d array
+        :param segments: search index TokenSegments of consecutive blocks of rows
+        :type segments: list
         """
 
-        # refreshing all data in table
         self.layoutAboutToBeChanged.emit()
-        self.arraydata = data
+        self.clear_rows()
+        self.add_rows(data)
+        self.search_index.reset(data, segments)
+        self.order = self.sorted_rows()
         self.layoutChanged.emit()
 
+    def appendData(self, data, segment=None):  # pylint:disable=invalid-name
+        """
+        Append a block of rows. Views and proxies only
+        process the new rows, the existing rows are untouched
+        unless the rows are sorted
+
+        :param data: List of lists of row data
+        :param data: 2d array
+        :param segment: search index TokenSegment of the rows
+        :type segment: TokenSegment
+        """
+
+        if not data:
+            return
+        first = len(self.abstracts)
+        self.add_rows(data)
+        self.search_index.extend(data, segment)
+        # only the rows the search index accepts are shown
+        rows = array(
+            "I",
+            compress(range(first, len(self.abstracts)), self.search_index.mask[first:]),
+        )
+        if rows:
+            self.beginInsertRows(
+                QModelIndex(), len(self.order), len(self.order) + len(rows) - 1
+            )
+            self.order.extend(rows)
+            self.endInsertRows()
+        if self.is_sorted():
+            self.update_order()
+
+    def clearData(self):  # pylint:disable=invalid-name
+        """
+        Remove all rows
+        """
+
+        self.beginResetModel()
+        self.clear_rows()
+        self.search_index.reset([])
+        self.endResetModel()
+
     def selectedRow(self, row):  # pylint:disable=invalid-name
         """
         Return data for row selected by user
@@ -139,7 +605,11 @@ class TableModel(QAbstractTableModel):
         :rtype: list
         """
 
-        return self.arraydata[row]
+        stored_row = self.order[row]
+        return [values[stored_row] for values in self.columns] + [
+            self.abstracts[stored_row],
+            self.crs[stored_row],
+        ]
 
     def headerData(self, col, orientation, role):  # pylint:disable=invalid-name
         """ "
@@ -0,0 +1,241 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+"""
+
+import io
+import unittest
+from xml.etree.ElementTree import ParseError
+
+from ..capabilities import (
+    RowStream,
+    UnsupportedCapabilities,
+    WfsExtractor,
+    WmtsExtractor,
+    extract_wfs_rows,
+    extract_wmts_rows,
+)
+
+WFS_XML = b"""<?xml version="1.0" encoding="utf-8"?>
+<wfs:WFS_Capabilities version="2.0.0"
+    xmlns:wfs="http://www.opengis.net/wfs/2.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1">
+  <ows:ServiceIdentification>
+    <ows:Title>LINZ Data Service</ows:Title>
+  </ows:ServiceIdentification>
+  <wfs:FeatureTypeList>
+    <wfs:FeatureType>
+      <wfs:Name>data.linz.govt.nz:layer-50772</wfs:Name>
+      <wfs:Title>NZ Primary Parcels</wfs:Title>
+      <wfs:Abstract>Parcels abstract</wfs:Abstract>
+      <wfs:DefaultCRS>urn:ogc:def:crs:EPSG::4167</wfs:DefaultCRS>
+      <wfs:OtherCRS>urn:ogc:def:crs:EPSG::2193</wfs:OtherCRS>
+      <wfs:OtherCRS>urn:ogc:def:crs:OGC:1.3:CRS84</wfs:OtherCRS>
+      <wfs:OtherCRS>EPSG:3857</wfs:OtherCRS>
+    </wfs:FeatureType>
+    <wfs:FeatureType>
+      <wfs:Name>data.linz.govt.nz:table-51696</wfs:Name>
+      <wfs:Title>NZ Addresses Table</wfs:Title>
+    </wfs:FeatureType>
+  </wfs:FeatureTypeList>
+</wfs:WFS_Capabilities>
+"""
+
+WMTS_XML = b"""<?xml version="1.0" encoding="utf-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">
+  <Contents>
+    <Layer>
+      <ows:Title>NZ Aerial Imagery</ows:Title>
+      <ows:Abstract>Imagery abstract</ows:Abstract>
+      <ows:Identifier>layer-51320</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>style=auto</ows:Identifier></Style>
+      <TileMatrixSetLink><TileMatrixSet>EPSG:3857</TileMatrixSet></TileMatrixSetLink>
+      <TileMatrixSetLink><TileMatrixSet>EPSG:2193</TileMatrixSet></TileMatrixSetLink>
+    </Layer>
+    <Layer>
+      <ows:Title>NZ Topo50 Maps</ows:Title>
+      <ows:Identifier>layer-50767</ows:Identifier>
+      <TileMatrixSetLink><TileMatrixSet>EPSG:2193</TileMatrixSet></TileMatrixSetLink>
+    </Layer>
+    <TileMatrixSet>
+      <ows:Identifier>EPSG:2193</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::2193</ows:SupportedCRS>
+      <TileMatrix><ows:Identifier>0</ows:Identifier></TileMatrix>
+      <TileMatrix><ows:Identifier>1</ows:Identifier></TileMatrix>
+    </TileMatrixSet>
+    <TileMatrixSet>
+      <ows:Identifier>EPSG:3857</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::3857</ows:SupportedCRS>
+      <TileMatrix><ows:Identifier>0</ows:Identifier></TileMatrix>
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+"""
+
+
+class WfsExtractorTest(unittest.TestCase):
+    """
+    Test the streaming WFS capabilities extractor
+    """
+
+    def test_extract_wfs_rows(self):
+        """
+        Test the table rows formatted from the FeatureTypes
+        """
+
+        rows = extract_wfs_rows(io.BytesIO(WFS_XML), "data.linz.govt.nz")
+        self.assertEqual(
+            rows,
+            [
+                [
+                    "data.linz.govt.nz",
+                    "layer",
+                    "WFS",
+                    "50772",
+                    "NZ Primary Parcels",
+                    "Parcels abstract",
+                    ["EPSG:2193", "EPSG:3857", "EPSG:4167"],
+                ],
+                [
+                    "data.linz.govt.nz",
+                    "table",
+                    "WFS",
+                    "51696",
+                    "NZ Addresses Table",
+                    None,
+                    [],
+                ],
+            ],
+        )
+
+    def test_extract_wfs_rows_unsupported(self):
+        """
+        Documents that are not WFS 2.0.0 are left for owslib
+        """
+
+        xml = WFS_XML.replace(b"wfs/2.0", b"wfs")
+        with self.assertRaises(UnsupportedCapabilities):
+            extract_wfs_rows(io.BytesIO(xml), "data.linz.govt.nz")
+
+    def test_extract_wfs_rows_corrupt(self):
+        """
+        Truncated documents raise a ParseError
+        """
+
+        with self.assertRaises(ParseError):
+            extract_wfs_rows(io.BytesIO(WFS_XML[:600]), "data.linz.govt.nz")
+
+
+class WmtsExtractorTest(unittest.TestCase):
+    """
+    Test the streaming WMTS capabilities extractor
+    """
+
+    def test_extract_wmts_rows(self):
+        """
+        Test the table rows formatted from the Layers. Each layer
+        gets the crs of the TileMatrixSets it links to
+        """
+
+        rows = extract_wmts_rows(io.BytesIO(WMTS_XML), "data.linz.govt.nz")
+        self.assertEqual(
+            rows,
+            [
+                [
+                    "data.linz.govt.nz",
+                    "layer",
+                    "WMTS",
+                    "51320",
+                    "NZ Aerial Imagery",
+                    "Imagery abstract",
+                    ["EPSG:2193", "EPSG:3857"],
+                ],
+                [
+                    "data.linz.govt.nz",
+                    "layer",
+                    "WMTS",
+                    "50767",
+                    "NZ Topo50 Maps",
+                    None,
+                    ["EPSG:2193"],
+                ],
+            ],
+        )
+
+    def test_extract_wmts_rows_basemaps(self):
+        """
+        LINZ Basemaps identifiers are used as is
+        """
+
+        rows = extract_wmts_rows(io.BytesIO(WMTS_XML), "basemaps.linz.govt.nz")
+        self.assertEqual([row[3] for row in rows], ["layer-51320", "layer-50767"])
+
+    def test_extract_wmts_rows_unsupported(self):
+        """
+        Documents that are not WMTS are left for owslib
+        """
+
+        with self.assertRaises(UnsupportedCapabilities):
+            extract_wmts_rows(io.BytesIO(WFS_XML), "data.linz.govt.nz")
+
+
+class RowStreamTest(unittest.TestCase):
+    """
+    Test documents fed to the extractors in chunks
+    """
+
+    @staticmethod
+    def stream(xml, extractor, size=7):
+        stream = RowStream(extractor)
+        for start in range(0, len(xml), size):
+            stream.feed(xml[start : start + size])
+        return stream.close()
+
+    def test_chunks_give_the_same_rows(self):
+        """
+        Test a document fed in chunks gives the rows of the whole document
+        """
+
+        self.assertEqual(
+            self.stream(WFS_XML, WfsExtractor("data.linz.govt.nz")),
+            extract_wfs_rows(io.BytesIO(WFS_XML), "data.linz.govt.nz"),
+        )
+        self.assertEqual(
+            self.stream(WMTS_XML, WmtsExtractor("data.linz.govt.nz"), 1000),
+            extract_wmts_rows(io.BytesIO(WMTS_XML), "data.linz.govt.nz"),
+        )
+
+    def test_unsupported_and_corrupt(self):
+        """
+        Test unsupported or truncated documents raise as when extracted
+        """
+
+        with self.assertRaises(UnsupportedCapabilities):
+            self.stream(WFS_XML, WmtsExtractor("data.linz.govt.nz"))
+        with self.assertRaises(ParseError):
+            self.stream(WFS_XML[:600], WfsExtractor("data.linz.govt.nz"))
+
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(unittest.makeSuite(WfsExtractorTest, "test"))
+    test_suite.addTests(unittest.makeSuite(WmtsExtractorTest, "test"))
+    test_suite.addTests(unittest.makeSuite(RowStreamTest, "test"))
+    return test_suite
+
+
+def run_tests():
+    unittest.TextTestRunner(verbosity=3).run(suite())
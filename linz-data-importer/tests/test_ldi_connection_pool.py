@@ -0,0 +1,182 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+"""
+
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+
+from ..cache_store import CacheStore
+from ..connection_pool import ConnectionPool, build_pooled_opener
+from ..request_policy import RequestPolicy
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """
+    Answer every request with a short body, keeping the connection
+    open. /close closes it without telling the client and
+    /not-modified answers 304 Not Modified
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        if self.path == "/not-modified":
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == "/close":
+            self.close_connection = True
+
+    def log_message(self, *args):  # pylint:disable=arguments-differ
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """
+    Test requests share keep-alive connections
+    """
+
+    def setUp(self):
+        """
+        Runs before each test
+        """
+
+        self.httpd = ThreadingHTTPServer(("localhost", 0), KeepAliveHandler)
+        self.httpd.lock = threading.Lock()
+        self.httpd.connections = 0
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = "http://localhost:{0}/".format(self.httpd.server_address[1])
+        self.pool = ConnectionPool()
+        self.opener = build_pooled_opener(self.pool)
+
+    def tearDown(self):
+        """
+        Runs after each test
+        """
+
+        self.pool.clear()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def fetch(self, path=""):
+        with self.opener.open(self.url + path, timeout=5) as response:
+            return response.read()
+
+    def test_connection_reused(self):
+        """
+        Test requests to a host are sent on one connection
+        """
+
+        for _ in range(3):
+            self.assertEqual(self.fetch(), b"ok")
+        self.assertEqual(self.httpd.connections, 1)
+        stats = self.pool.stats()
+        self.assertEqual((stats["opened"], stats["reused"]), (1, 2))
+        self.assertAlmostEqual(stats["reuse_rate"], 2 / 3)
+
+    def test_idle_connection_expired(self):
+        """
+        Test connections idle for longer than the idle timeout are closed
+        """
+
+        self.pool.idle_timeout = 0
+        self.fetch()
+        self.fetch()
+        self.assertEqual(self.httpd.connections, 2)
+        self.assertEqual(self.pool.stats()["expired"], 1)
+
+    def test_idle_connections_capped(self):
+        """
+        Test no more than max_idle_per_host connections are kept
+        """
+
+        self.pool.max_idle_per_host = 1
+        responses = [self.opener.open(self.url, timeout=5) for _ in range(2)]
+        for response in responses:
+            response.read()
+            response.close()
+        self.assertEqual(self.pool.stats()["discarded"], 1)
+        self.fetch()
+        self.assertEqual(self.httpd.connections, 2)
+
+    def test_stale_connection_replaced(self):
+        """
+        Test a request whose idle connection was closed by
+        the server is sent again on a new connection
+        """
+
+        self.fetch("close")
+        self.assertEqual(self.fetch(), b"ok")
+        self.assertEqual(self.httpd.connections, 2)
+        stats = self.pool.stats()
+        self.assertEqual((stats["stale"], stats["reused"], stats["opened"]), (1, 0, 2))
+
+    def test_unread_response_not_reused(self):
+        """
+        Test a connection is not reused if its response was not read
+        """
+
+        self.opener.open(self.url, timeout=5).close()
+        self.fetch()
+        self.assertEqual(self.httpd.connections, 2)
+
+    def test_error_response_released(self):
+        """
+        Test the connection of a HTTP error response the request
+        policy raises is handed back to the pool
+        """
+
+        cache_dir = tempfile.mkdtemp()
+        policy = RequestPolicy(CacheStore(cache_dir))
+        policy.opener = self.opener
+        errors = []  # kept so the responses are not closed when collected
+        try:
+            for _ in range(2):
+                with self.assertRaises(HTTPError) as context:
+                    policy.request(
+                        "localhost",
+                        lambda: self.url + "not-modified",
+                        lambda response: response.read(),
+                    )
+                errors.append(context.exception)
+        finally:
+            shutil.rmtree(cache_dir)
+        self.assertEqual(errors[1].code, 304)
+        self.assertEqual(self.httpd.connections, 1)
+
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(unittest.makeSuite(ConnectionPoolTest, "test"))
+    return test_suite
+
+
+def run_tests():
+    unittest.TextTestRunner(verbosity=3).run(suite())
@@ -15,11 +15,19 @@
  ***************************************************************************/
 """
 
+# pylint: disable=too-many-lines
+
 import glob
+import gzip
+import hashlib
 import os
 import shutil
+import sqlite3
+import threading
+import time
 import unittest
 import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from qgis.core import (  # pylint:disable=import-error
     QgsApplication,
@@ -30,6 +38,12 @@ from qgis.PyQt.QtCore import QSettings, Qt  # pylint:disable=import-error
 from qgis.PyQt.QtTest import QTest  # pylint:disable=import-error
 from qgis.utils import iface, plugins  # pylint:disable=import-error
 
+from ..catalogue_loader import failure_summary
+from ..request_policy import CircuitOpen
+from ..service_data import Localstore, ServiceData, process_services
+from .test_ldi_capabilities import WFS_XML
+from .utils import wait_for_load
+
 WAIT = 1000
 MAP_REFRESH_WAIT = 4000
 
@@ -165,7 +179,7 @@ class CorruptXml(unittest.TestCase):
         # Run Plugin
         self.ldi.services_loaded = False
         self.ldi.actions[0].trigger()
-        QTest.qWait(1000)
+        wait_for_load(self.ldi)
         # ensure all services are are present in the table
         data_types = {
             self.ldi.proxy_model.index(row, 2).data()
@@ -207,6 +221,7 @@ class CacheTest(unittest.TestCase):
                 os.remove(file)
             except OSError:
                 pass
+        self.ldi.local_store.store.delete("data.govt.test.nz")
 
     def test_purge_cache(self):
         """
@@ -222,6 +237,510 @@ class CacheTest(unittest.TestCase):
             post_purge_test_files, ["data.govt.test.nz_wfs_999999999999999.xml"]
         )
 
+    def test_purge_cache_keeps_stored_doc(self):
+        """
+        Test the purge keeps the doc referenced by the
+        cache store even if it is not the most current
+        """
+
+        self.ldi.local_store.store.record(
+            "data.govt.test.nz", "wfs", self.old_file2, None, {}
+        )
+        self.ldi.local_store.purge_cache()
+        post_purge_test_files = glob.glob("data.govt.test.nz_wfs_[0-9]*.xml")
+        self.assertEqual(post_purge_test_files, [self.old_file2])
+
+
+class IndexTest(unittest.TestCase):
+    """
+    Test the table rows stored for each cached doc
+    """
+
+    def setUp(self):
+        self.domain = "data.govt.test.nz"
+        self.local_store = Localstore()
+        self.cache_file = os.path.join(
+            self.local_store.pl_settings_dir,
+            "{0}_wfs_20200101000000.xml".format(self.domain),
+        )
+        self.write_cache(WFS_XML)
+
+    def tearDown(self):
+        """Runs after each test"""
+
+        self.local_store.del_domains_xml(self.domain)
+
+    def write_cache(self, xml):
+        with open(self.cache_file, "wb") as file_pointer:
+            file_pointer.write(xml)
+
+    def load(self):
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None)
+        feed.process_service_data()
+        self.assertIsNone(feed.err)
+        return feed
+
+    def cache_doc(self, xml):
+        """
+        Cache a doc as a download does, in a new file
+        """
+
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None)
+        with gzip.open(feed.temp_service_xml(), "wb") as file_pointer:
+            file_pointer.write(xml)
+        feed.xml_hash = hashlib.sha1(xml).hexdigest()
+        feed.commit_local_service_xml()
+        return feed.file
+
+    def test_index_is_used(self):
+        """
+        Test a doc is only parsed once
+        """
+
+        feed = self.load()
+        rows = feed.info
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(feed.read_index(feed.content_hash()), rows)
+
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None)
+        feed.parse_service_data = self.fail
+        feed.process_service_data()
+        self.assertEqual(feed.info, rows)
+
+    def test_recorded_hash_is_used(self):
+        """
+        Test the rows of a doc cached with its hash are found
+        without reading the doc
+        """
+
+        rows = self.load().info
+        # as recorded when a downloaded doc is cached
+        self.local_store.store.record(
+            self.domain,
+            "wfs",
+            os.path.basename(self.cache_file),
+            hashlib.sha1(WFS_XML).hexdigest(),
+            {},
+        )
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None)
+        feed.open_local_service_xml = self.fail
+        feed.process_service_data()
+        self.assertIsNone(feed.err)
+        self.assertEqual(feed.info, rows)
+
+    def test_index_is_invalidated(self):
+        """
+        Test a changed doc is parsed again
+        """
+
+        self.load()
+        self.cache_doc(WFS_XML.replace(b"NZ Primary Parcels", b"NZ Parcels"))
+        self.assertEqual(self.load().info[0][4], "NZ Parcels")
+
+    def test_compressed_cache(self):
+        """
+        Test a doc is cached gzip compressed and parsed
+        straight from the file, without being held
+        """
+
+        rows = self.load().info
+        self.local_store.store.delete(self.domain)
+        file = self.cache_doc(WFS_XML)
+        with open(file, "rb") as file_pointer:
+            self.assertEqual(gzip.decompress(file_pointer.read()), WFS_XML)
+
+        feed = self.load()
+        self.assertEqual(os.path.basename(feed.file), os.path.basename(feed.xml_file))
+        self.assertIsNone(feed.xml)
+        self.assertEqual(feed.info, rows)
+        self.assertEqual(feed.content_hash(), hashlib.sha1(WFS_XML).hexdigest())
+        feed.read_local_service_xml()
+        self.assertEqual(feed.xml, WFS_XML)
+
+    def test_parse_processes(self):
+        """
+        Test a doc parsed in a parse process gives the same rows
+        """
+
+        rows = self.load().info
+        # or the stored rows are used
+        self.local_store.store.delete(self.domain)
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None)
+        process_services([feed], 1, None, 1)
+        self.assertIsNone(feed.err)
+        self.assertEqual(feed.info, rows)
+        self.assertIsNone(feed.parse_pool)
+
+    def test_processing_is_cancelled(self):
+        """
+        Test feeds not yet started are dropped once processing is cancelled
+        """
+
+        started = []
+
+        class SlowFeed:
+            parse_pool = None
+
+            def process_service_data(self):
+                started.append(self)
+                time.sleep(0.5)
+
+        reported = []
+        process_services(
+            [SlowFeed() for _feed in range(4)],
+            1,
+            lambda *args: reported.append(args),
+            0,
+            lambda: True,
+        )
+        self.assertEqual(len(started), 1)
+        self.assertEqual(reported, [])
+
+    def test_failed_feed_is_isolated(self):
+        """
+        Test a feed raising an unexpected error does not stop the
+        other feeds loading. Its previous rows are served if it has any
+        """
+
+        rows = self.load().info
+
+        def locked(*_args):
+            raise sqlite3.OperationalError("database is locked")
+
+        failing = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None)
+        failing.read_index = locked
+        refreshed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None, False, rows)
+        refreshed.read_index = locked
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None)
+        reported = []
+        process_services(
+            [failing, refreshed, feed],
+            1,
+            lambda *args: reported.append(args[0]),
+            0,
+        )
+        self.assertEqual(reported, [failing, refreshed, feed])
+        self.assertIn("database is locked", failing.err)
+        self.assertIsNone(failing.info)
+        self.assertIsNone(refreshed.err)
+        self.assertIn("database is locked", refreshed.fallback_err)
+        self.assertEqual(refreshed.info, rows)
+        self.assertIsNone(feed.err)
+        self.assertEqual(feed.info, rows)
+
+    def test_abstracts_are_stored(self):
+        """
+        Test abstracts are kept out of the rows and read on demand
+        """
+
+        feed = self.load()
+        self.assertEqual([row[5] for row in feed.info], [None, None])
+        self.assertEqual(
+            feed.read_abstract(self.domain, "WFS", "layer", "50772"),
+            "Parcels abstract",
+        )
+        self.assertEqual(
+            feed.row_texts()[0], ("NZ Primary Parcels", "Parcels abstract")
+        )
+        self.assertIsNone(feed.abstracts)
+
+        # read back from the store when the rows come from the index
+        feed = self.load()
+        self.assertEqual(
+            feed.row_texts()[0], ("NZ Primary Parcels", "Parcels abstract")
+        )
+
+        self.local_store.del_domains_xml(self.domain)
+        self.assertIsNone(feed.read_abstract(self.domain, "WFS", "layer", "50772"))
+
+
+class RequestPolicyTest(unittest.TestCase):
+    """
+    Test failed requests are retried and a failing domain is skipped
+    """
+
+    def setUp(self):
+        self.domain = "data.govt.test.nz"
+        self.local_store = Localstore()
+        self.local_store.del_domains_xml(self.domain)
+        self.cache_file = os.path.join(
+            self.local_store.pl_settings_dir,
+            "{0}_wfs_20200101000000.xml".format(self.domain),
+        )
+        self.attempts = 0
+
+    def tearDown(self):
+        """Runs after each test"""
+
+        self.local_store.del_domains_xml(self.domain)
+
+    def load(self, upd_cache=True):
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None, upd_cache)
+        # nothing listens on the discard port
+        feed.service_url = lambda: "http://127.0.0.1:9/"
+        feed.request_policy.backoff = 0
+        opener = feed.request_policy.opener
+        opener_open = opener.open
+
+        def count_attempts(*args, **kwargs):
+            self.attempts += 1
+            return opener_open(*args, **kwargs)
+
+        opener.open = count_attempts
+        feed.process_service_data()
+        return feed
+
+    def test_failed_request_is_retried(self):
+        """
+        Test a failed request is retried before the error is reported
+        """
+
+        feed = self.load()
+        self.assertEqual(self.attempts, 3)
+        self.assertTrue(feed.err.startswith("Error: ({0})".format(self.domain)))
+
+    def test_failing_domain_is_skipped(self):
+        """
+        Test a failing domain is not requested, its cached rows are served
+        """
+
+        with open(self.cache_file, "wb") as file_pointer:
+            file_pointer.write(WFS_XML)
+        rows = self.load(False).info
+
+        # a failed update falls back to the cached rows
+        for _attempt in range(2):
+            feed = self.load()
+            self.assertIsNone(feed.err)
+            self.assertTrue(feed.fallback_err.startswith("Error: "))
+            self.assertEqual(feed.info, rows)
+        self.attempts = 0
+        feed = self.load()
+        self.assertEqual(self.attempts, 0)
+        self.assertIn("repeated failures", feed.fallback_err)
+        self.assertEqual(feed.info, rows)
+
+        # without a cached doc the skipped domain is reported
+        self.local_store.del_local_sevice_xml(self.cache_file)
+        with self.assertRaises(CircuitOpen):
+            feed.fetch_service_xml()
+        self.assertIn("repeated failures", self.load().err)
+
+    def test_failure_summary(self):
+        """
+        Test the errors of failed feeds are summarised once per domain
+        """
+
+        feeds = [self.load() for _service in ("wfs", "wmts")]
+        self.assertEqual(failure_summary(feeds), feeds[0].err)
+
+        with open(self.cache_file, "wb") as file_pointer:
+            file_pointer.write(WFS_XML)
+        feeds.append(self.load())
+        self.assertEqual(
+            failure_summary(feeds).split("\n"),
+            [feeds[0].err, feeds[2].fallback_err + " (showing cached datasets)"],
+        )
+        self.assertIsNone(failure_summary([]))
+
+
+class DownloadTest(unittest.TestCase):
+    """
+    Test capability docs are streamed to the cache
+    """
+
+    def setUp(self):
+        self.domain = "data.govt.test.nz"
+        self.local_store = Localstore()
+        self.local_store.del_domains_xml(self.domain)
+        self.body = WFS_XML
+        self.headers = {}
+        self.requests = []  # request headers
+        self.cut_at = None  # bytes sent before the connection drops
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint:disable=invalid-name
+                test.requests.append(self.headers)
+                etag = test.headers.get("ETag")
+                if etag and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                start = 0
+                if self.headers.get("If-Range") == test.headers.get("ETag"):
+                    start = int(self.headers.get("Range", "bytes=0-")[6:-1])
+                if start:
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range",
+                        "bytes {0}-{1}/{2}".format(
+                            start, len(test.body) - 1, len(test.body)
+                        ),
+                    )
+                else:
+                    self.send_response(200)
+                headers = {"Content-Length": str(len(test.body) - start)}
+                headers.update(test.headers)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(test.body[start : test.cut_at])
+                test.cut_at = None
+
+            def log_message(self, *args):  # pylint:disable=arguments-differ
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        """Runs after each test"""
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.local_store.del_domains_xml(self.domain)
+
+    def load(self, retries=2):
+        feed = ServiceData(self.domain, "wfs", {"wfs": "2.0.0"}, None, True)
+        feed.service_url = lambda: "http://127.0.0.1:{0}/".format(
+            self.server.server_port
+        )
+        feed.request_policy.backoff = 0
+        feed.request_policy.retries = retries
+        feed.process_service_data()
+        return feed
+
+    def part_file(self):
+        return os.path.join(
+            self.local_store.pl_settings_dir, "{0}_wfs.part".format(self.domain)
+        )
+
+    def temp_files(self):
+        return glob.glob(
+            os.path.join(
+                self.local_store.pl_settings_dir, "*{0}*.tmp".format(self.domain)
+            )
+        )
+
+    def assert_cached(self, feed):
+        self.assertIsNone(feed.err)
+        self.assertEqual(len(feed.info), 2)
+        # parsed as it was downloaded
+        self.assertIsNone(feed.xml)
+        self.assertEqual(feed.content_hash(), hashlib.sha1(WFS_XML).hexdigest())
+        self.assertEqual(feed.read_index(feed.content_hash()), feed.info)
+        feed.read_local_service_xml(feed.latest_local_service_xml())
+        self.assertEqual(feed.xml, WFS_XML)
+        self.assertEqual(self.temp_files(), [])
+        self.assertFalse(os.path.exists(self.part_file()))
+
+    def test_doc_is_streamed(self):
+        """
+        Test a downloaded doc is cached and parsed
+        """
+
+        self.assert_cached(self.load())
+
+    def test_gzip_doc_is_streamed(self):
+        """
+        Test a gzip encoded doc is decoded as it is downloaded
+        """
+
+        self.body = gzip.compress(WFS_XML)
+        self.headers = {
+            "Content-Encoding": "gzip",
+            "Content-Length": str(len(self.body)),
+        }
+        self.assert_cached(self.load())
+
+    def test_truncated_doc_is_not_cached(self):
+        """
+        Test a doc shorter than its Content-Length is not cached
+        """
+
+        self.headers = {"Content-Length": str(len(WFS_XML) + 100)}
+        feed = self.load()
+        self.assertIn("IncompleteRead", feed.err)
+        self.assertIsNone(feed.latest_local_service_xml())
+        self.assertEqual(self.temp_files(), [])
+
+    def test_interrupted_download_is_resumed(self):
+        """
+        Test the next attempt resumes an interrupted download
+        """
+
+        self.headers = {"Accept-Ranges": "bytes", "ETag": '"v1"'}
+        self.cut_at = 500
+        self.assert_cached(self.load())
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1]["Range"], "bytes=500-")
+        self.assertEqual(self.requests[1]["If-Range"], '"v1"')
+
+    def test_partial_download_is_kept(self):
+        """
+        Test a partial download is kept for the next load. A gzip
+        encoded doc is resumed from its encoded bytes
+        """
+
+        self.body = gzip.compress(WFS_XML)
+        self.headers = {
+            "Accept-Ranges": "bytes",
+            "Last-Modified": "Wed, 01 Jan 2020 00:00:00 GMT",
+            "Content-Encoding": "gzip",
+        }
+        self.cut_at = 200
+        self.assertIsNotNone(self.load(0).err)
+        self.assertEqual(os.path.getsize(self.part_file()), 200)
+
+        self.headers["ETag"] = self.headers.pop("Last-Modified")
+        self.assert_cached(self.load(0))
+        self.assertEqual(self.requests[1]["Range"], "bytes=200-")
+
+    def test_changed_doc_is_downloaded_again(self):
+        """
+        Test a partial download of a doc that has since changed is replaced
+        """
+
+        self.headers = {"Accept-Ranges": "bytes", "ETag": '"v1"'}
+        self.cut_at = 500
+        self.assertIsNotNone(self.load(0).err)
+
+        self.headers["ETag"] = '"v2"'
+        self.assert_cached(self.load(0))
+        self.assertEqual(self.requests[1]["Range"], "bytes=500-")
+
+    def test_unchanged_doc_is_revalidated(self):
+        """
+        Test the cached doc's ETag is sent with the request and a
+        304 Not Modified serves the cached rows and renews the doc
+        """
+
+        self.headers = {"ETag": '"v1"'}
+        rows = self.load().info
+        entry = self.local_store.store.get(self.domain, "wfs")
+        file = os.path.join(self.local_store.pl_settings_dir, entry["file"])
+        self.local_store.store.record(
+            self.domain,
+            "wfs",
+            entry["file"],
+            entry["content_hash"],
+            entry["validators"],
+            0,
+        )
+        os.utime(file, (0, 0))
+
+        feed = self.load()
+        self.assertIsNone(feed.err)
+        self.assertNotIn("If-None-Match", self.requests[0])
+        self.assertEqual(self.requests[1]["If-None-Match"], '"v1"')
+        self.assertFalse(feed.modified)
+        self.assertEqual(feed.file, file)
+        self.assertEqual(feed.info, rows)
+        self.assertGreater(self.local_store.store.get(self.domain, "wfs")["fetched"], 0)
+        self.assertGreater(os.path.getmtime(file), 0)
+
 
 class UserWorkFlows(unittest.TestCase):
     """
@@ -270,6 +789,7 @@ class UserWorkFlows(unittest.TestCase):
 
         # Run
         self.ldi.actions[0].trigger()
+        wait_for_load(self.ldi)
 
     def tearDown(self):
         """
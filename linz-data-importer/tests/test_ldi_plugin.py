@@ -26,6 +26,8 @@ from qgis.PyQt.QtCore import QSettings  # pylint:disable=import-error
 from qgis.PyQt.QtTest import QTest  # pylint:disable=import-error
 from qgis.utils import plugins  # pylint:disable=import-error
 
+from .utils import wait_for_load
+
 WAIT = 1000
 
 # Must have the below envi vars set
@@ -46,11 +48,13 @@ class UnitLevel(unittest.TestCase):
         # Get the test executors current key so that
         # We can revert back to when tests are complete
         cls.testers_keys = QSettings().value("linz_data_importer/apikeys")
+        cls.testers_ttls = QSettings().value("linz_data_importer/cache_ttls")
 
     @classmethod
     def tearDownClass(cls):
         # Runs at TestCase teardown.
         QSettings().setValue("linz_data_importer/apikeys", cls.testers_keys)
+        QSettings().setValue("linz_data_importer/cache_ttls", cls.testers_ttls)
 
     def copy_test_data(self):
         """
@@ -334,6 +338,7 @@ class UnitLevel(unittest.TestCase):
 
         self.ldi.services_loaded = False
         self.ldi.run()
+        wait_for_load(self.ldi)
 
         insitu_file_stats = {}
         cached_file_stats = {}
@@ -345,10 +350,12 @@ class UnitLevel(unittest.TestCase):
             file_path = os.path.join(self.pl_settings_dir, file)
             insitu_file_stats[file] = os.stat(file_path).st_mtime
 
+        # Cache has outlived its TTL
+        self.ldi.cache_ttl_instance.set_cache_ttls({self.domain1: 0})
         self.ldi.cache_updated = False
         self.ldi.update_cache = True
         self.ldi.update_service_data_cache()
-        QTest.qWait(15000)
+        wait_for_load(self.ldi)
 
         for service in ["wfs", "wmts"]:
             files = glob.glob("{0}_{1}*.xml".format(self.domain1, service))
@@ -357,6 +364,43 @@ class UnitLevel(unittest.TestCase):
             cached_file_stats[file] = os.stat(file_path).st_mtime
         self.assertNotEqual(cached_file_stats, insitu_file_stats)
 
+    def test_update_service_data_cache_within_ttl(self):
+        """
+        Test the cache is not updated while within its TTL
+        """
+
+        self.ldi.services_loaded = False
+        self.ldi.run()
+        wait_for_load(self.ldi)
+
+        os.chdir(self.pl_settings_dir)
+        insitu_files = sorted(glob.glob("{0}_*.xml".format(self.domain1)))
+
+        self.ldi.cache_ttl_instance.set_cache_ttls({self.domain1: 3600})
+        self.ldi.cache_updated = False
+        self.ldi.update_cache = True
+        self.ldi.update_service_data_cache()
+        self.assertIsNone(self.ldi.load_task)
+        self.assertTrue(self.ldi.cache_updated)
+        self.assertEqual(
+            sorted(glob.glob("{0}_*.xml".format(self.domain1))), insitu_files
+        )
+
+    def test_filter_table_debounced(self):
+        """
+        Test typing is coalesced into a single filter
+        """
+
+        wait_for_load(self.ldi)
+        for text in ("p", "pa", "par"):
+            self.ldi.dlg.uTextFilter.setText(text)
+        # nothing is filtered until typing pauses
+        self.assertTrue(self.ldi.filter_timer.isActive())
+        self.assertEqual(self.ldi.table_model.search_index.query, "")
+        QTest.qWait(WAIT)
+        self.assertFalse(self.ldi.filter_timer.isActive())
+        self.assertEqual(self.ldi.table_model.search_index.query, "par")
+
     def test_set_project_srid(self):
         """
         Test the setting of the projects crs
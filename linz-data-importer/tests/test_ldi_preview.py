@@ -0,0 +1,228 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from qgis.PyQt.QtCore import (  # pylint:disable=import-error
+    QBuffer,
+    QByteArray,
+    QIODevice,
+)
+from qgis.PyQt.QtGui import QImage, QPixmap  # pylint:disable=import-error
+from qgis.PyQt.QtTest import QTest  # pylint:disable=import-error
+
+from .. import preview
+from ..preview import (
+    PREVIEW_HEIGHT,
+    PreviewDiskCache,
+    PreviewLoader,
+    PreviewMemoryCache,
+    decode_preview,
+    fetch_preview,
+    neighbour_rows,
+)
+
+WAIT = 10000
+
+
+def png_data(width, height):
+    """
+    Return a blank PNG image
+    """
+
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(0)
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, "PNG")
+    return bytes(data)
+
+
+class PreviewTest(unittest.TestCase):
+    """
+    Test the background loading of preview images
+    """
+
+    def setUp(self):
+        """Runs before each test"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.disk_cache = PreviewDiskCache(self.cache_dir)
+        self.loader = PreviewLoader(disk_cache=self.disk_cache)
+        self.loaded = []
+        self.prefetched = []
+        self.loader.previewLoaded.connect(self.preview_loaded)
+        self.loader.previewPrefetched.connect(self.preview_prefetched)
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.loader.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def preview_loaded(self, generation, _object_id, image):
+        self.loaded.append((generation, image))
+
+    def preview_prefetched(self, object_id, image):
+        self.prefetched.append((object_id, image))
+
+    def wait_for_preview(self):
+        waited = 0
+        while not self.loaded and waited < WAIT:
+            QTest.qWait(100)
+            waited += 100
+
+    def test_decode_preview(self):
+        """
+        Test lower resolution images are scaled to the preview height
+        """
+
+        self.assertEqual(decode_preview(png_data(300, 200)).width(), 300)
+        self.assertEqual(decode_preview(png_data(150, 100)).height(), PREVIEW_HEIGHT)
+        self.assertIsNone(decode_preview(b"<html>Not Found</html>"))
+
+    def test_truncated_preview(self):
+        """
+        Test a preview response cut short is treated as not fetched
+        """
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint:disable=invalid-name
+                self.send_response(200)
+                self.send_header("Content-Length", "1000")
+                self.end_headers()
+                self.wfile.write(png_data(150, 100)[:10])
+                self.close_connection = True
+
+            def log_message(self, *args):  # pylint:disable=arguments-differ
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        preview_url = preview.PREVIEW_URL
+        preview.PREVIEW_URL = "http://127.0.0.1:{0}/{{0}}/{{1}}.png".format(
+            server.server_port
+        )
+        try:
+            self.assertIsNone(fetch_preview("50772", "150x100", 5))
+        finally:
+            preview.PREVIEW_URL = preview_url
+            server.shutdown()
+            server.server_close()
+
+    def test_request_supersedes(self):
+        """
+        Test only the latest request's preview is handed back
+        """
+
+        first = self.loader.request("50772")
+        latest = self.loader.request("50772")
+        self.assertFalse(self.loader.is_current(first))
+        self.wait_for_preview()
+        QTest.qWait(1000)
+        self.assertEqual([generation for generation, _ in self.loaded], [latest])
+        self.assertIsNotNone(self.loaded[0][1])
+
+    def test_request_disk_cached(self):
+        """
+        Test cached previews are read from disk, without fetching
+        """
+
+        self.disk_cache.write("test-1", "150x100", png_data(150, 100))
+        self.loader.request("test-1")
+        self.wait_for_preview()
+        self.assertEqual(self.loaded[0][1].height(), PREVIEW_HEIGHT)
+
+    def test_disk_cache_eviction(self):
+        """
+        Test the least recently used files are evicted once over budget
+        """
+
+        img_data = png_data(300, 200)
+        self.disk_cache.budget = len(img_data) * 2
+        for mtime, object_id in enumerate(("1", "2", "3"), 1):
+            self.disk_cache.write(object_id, "300x200", img_data)
+            path = self.disk_cache.path(object_id, "300x200")
+            os.utime(path, (mtime, mtime))
+        self.assertIsNone(self.disk_cache.read("1", "300x200"))
+        # reading marks as recently used
+        self.assertEqual(self.disk_cache.read("2", "300x200"), img_data)
+        self.disk_cache.write("4", "300x200", img_data)
+        self.assertEqual(self.disk_cache.read("2", "300x200"), img_data)
+        self.assertIsNone(self.disk_cache.read("3", "300x200"))
+
+    def test_memory_cache_eviction(self):
+        """
+        Test the least recently used pixmaps are dropped once over budget
+        """
+
+        pixmap = QPixmap.fromImage(QImage(300, 200, QImage.Format_RGB32))
+        memory_cache = PreviewMemoryCache(PreviewMemoryCache.cost(pixmap) * 2)
+        memory_cache.put("1", pixmap)
+        memory_cache.put("2", pixmap)
+        self.assertIsNotNone(memory_cache.get("1"))
+        memory_cache.put("3", pixmap)
+        self.assertIsNotNone(memory_cache.get("1"))
+        self.assertIsNone(memory_cache.get("2"))
+        self.assertIsNotNone(memory_cache.get("3"))
+
+    def test_prefetch(self):
+        """
+        Test prefetched previews are handed back for caching
+        """
+
+        self.disk_cache.write("test-1", "300x200", png_data(300, 200))
+        self.disk_cache.write("test-2", "300x200", png_data(300, 200))
+        self.loader.prefetch(["test-1", "test-2"])
+        QTest.qWait(1000)
+        self.assertEqual(
+            sorted(object_id for object_id, _image in self.prefetched),
+            ["test-1", "test-2"],
+        )
+        self.assertEqual(self.loaded, [])
+
+    def test_neighbour_rows(self):
+        """
+        Test the rows either side of the selection, nearest first
+        """
+
+        self.assertEqual(neighbour_rows(5, 10, 2), [6, 4, 7, 3])
+        self.assertEqual(neighbour_rows(0, 3, 3), [1, 2])
+
+    def test_cancel(self):
+        """
+        Test cancelled requests are not handed back
+        """
+
+        self.loader.request("50772")
+        self.loader.cancel()
+        QTest.qWait(WAIT)
+        self.assertEqual(self.loaded, [])
+
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(unittest.makeSuite(PreviewTest, "test"))
+    return test_suite
+
+
+def run_tests():
+    unittest.TextTestRunner(verbosity=3).run(suite())
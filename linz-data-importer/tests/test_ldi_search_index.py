@@ -0,0 +1,189 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+"""
+
+import unittest
+
+from ..search_index import SearchIndex, TokenSegment
+
+ROWS = [
+    ["data.linz.govt.nz", "layer", "WFS", "50772", "NZ Primary Parcels", "", []],
+    ["data.linz.govt.nz", "layer", "WMTS", "51320", "NZ Aerial Imagery", "", []],
+    ["data.mfe.govt.nz", "layer", "WFS", "52150", "Parcel Boundaries", "", []],
+    ["data.mfe.govt.nz", "table", "WFS", "52151", None, "", []],
+    [
+        "data.mfe.govt.nz",
+        "layer",
+        "WFS",
+        "52152",
+        "Land Cover",
+        "Boundaries of land parcels by cover class",
+        [],
+    ],
+]
+
+
+class SearchIndexTest(unittest.TestCase):
+    """
+    Test the table's search index
+    """
+
+    def accepted(self, search_index):
+        return [row for row in range(len(search_index)) if search_index.accepts(row)]
+
+    def test_empty_query(self):
+        """
+        Test all rows are accepted without a query
+        """
+
+        self.assertEqual(self.accepted(SearchIndex(ROWS)), [0, 1, 2, 3, 4])
+
+    def test_query_is_case_insensitive(self):
+        """
+        Test layer names and domains are matched ignoring case
+        """
+
+        search_index = SearchIndex(ROWS)
+        self.assertTrue(search_index.set_query("PARCEL"))
+        self.assertEqual(self.accepted(search_index), [0, 2, 4])
+        self.assertFalse(search_index.set_query("parcel"))
+        search_index.set_query("mfe")
+        self.assertEqual(self.accepted(search_index), [2, 3, 4])
+        search_index.set_query("none")
+        self.assertEqual(self.accepted(search_index), [3])
+
+    def test_query_terms(self):
+        """
+        Test rows must match every term, each in any column
+        """
+
+        search_index = SearchIndex(ROWS)
+        search_index.set_query("imagery data.linz")
+        self.assertEqual(self.accepted(search_index), [1])
+        search_index.set_query("imagery mfe")
+        self.assertEqual(self.accepted(search_index), [])
+
+    def test_abstract_tokens(self):
+        """
+        Test terms prefix abstract tokens. Short terms
+        only match whole tokens
+        """
+
+        search_index = SearchIndex(ROWS)
+        search_index.set_query("clas")
+        self.assertEqual(self.accepted(search_index), [4])
+        search_index.set_query("by")
+        self.assertEqual(self.accepted(search_index), [4])
+        search_index.set_query("cl")
+        self.assertEqual(self.accepted(search_index), [])
+
+    def test_ranking(self):
+        """
+        Test rows matching the layer name outrank those
+        only matching the abstract
+        """
+
+        search_index = SearchIndex(ROWS)
+        search_index.set_query("boundaries")
+        self.assertEqual(self.accepted(search_index), [2, 4])
+        self.assertGreater(search_index.score(2), search_index.score(4))
+        self.assertEqual(search_index.score(0), 0)
+        search_index.set_query("nz")
+        self.assertEqual(search_index.score(0), 0)
+
+    def test_segments(self):
+        """
+        Test prebuilt token segments are offset to their rows
+        """
+
+        search_index = SearchIndex()
+        search_index.reset(
+            ROWS, [TokenSegment.from_rows(ROWS[:3]), TokenSegment.from_rows(ROWS[3:])]
+        )
+        search_index.set_query("cover")
+        self.assertEqual(self.accepted(search_index), [4])
+        search_index.extend(ROWS[4:], TokenSegment.from_rows(ROWS[4:]))
+        self.assertEqual(self.accepted(search_index), [4, 5])
+
+    def test_refine_query(self):
+        """
+        Test extending the query only refines the accepted rows
+        """
+
+        search_index = SearchIndex(ROWS)
+        search_index.set_query("parcel")
+        self.assertTrue(search_index.refines("parcels"))
+        self.assertTrue(search_index.refines("parcel b"))
+        self.assertFalse(search_index.refines("parce"))
+        search_index.set_query("parcel by")
+        self.assertEqual(self.accepted(search_index), [4])
+        # Short terms match whole tokens. Longer ones match prefixes
+        search_index.set_query("cl")
+        self.assertFalse(search_index.refines("cla"))
+        search_index.set_query("cla")
+        self.assertEqual(self.accepted(search_index), [4])
+
+    def test_results_reused(self):
+        """
+        Test recent results are reused, e.g. on backspace,
+        until the rows change
+        """
+
+        search_index = SearchIndex(ROWS)
+        search_index.set_query("parcel")
+        mask = search_index.mask
+        search_index.set_query("parcels")
+        self.assertTrue(search_index.set_query("parcel"))
+        self.assertIs(search_index.mask, mask)
+        # the accepted rows and their ranking are unchanged
+        self.assertFalse(search_index.set_query("parcel "))
+        search_index.extend(ROWS[:1])
+        search_index.set_query("parcels")
+        self.assertEqual(self.accepted(search_index), [0, 4, 5])
+
+    def test_service_types(self):
+        """
+        Test rows are limited to the service types
+        """
+
+        search_index = SearchIndex(ROWS)
+        search_index.set_query("data.linz")
+        search_index.set_service_types("WMTS")
+        self.assertEqual(self.accepted(search_index), [1])
+        search_index.set_service_types(("WMTS", "WFS"))
+        self.assertEqual(self.accepted(search_index), [0, 1])
+
+    def test_extend_keeps_query(self):
+        """
+        Test appended rows are matched against the current query
+        """
+
+        search_index = SearchIndex(ROWS[:2])
+        search_index.set_query("parcel")
+        search_index.extend(ROWS[2:])
+        self.assertEqual(self.accepted(search_index), [0, 2, 4])
+        search_index.reset(ROWS[1:])
+        self.assertEqual(self.accepted(search_index), [1, 3])
+
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(unittest.makeSuite(SearchIndexTest, "test"))
+    return test_suite
+
+
+def run_tests():
+    unittest.TextTestRunner(verbosity=3).run(suite())
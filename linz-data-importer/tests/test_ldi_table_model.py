@@ -0,0 +1,251 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+"""
+
+import unittest
+
+from qgis.PyQt.QtCore import (  # pylint:disable=import-error
+    QModelIndex,
+    QPersistentModelIndex,
+    Qt,
+)
+
+from ..catalogue_loader import CatalogueLoadTask
+from ..linz_data_importer import CustomSortFilterProxyModel
+from ..search_index import TokenSegment
+from ..tablemodel import SORT_ROLE, TableModel, longest_increasing
+
+HEADERS = ["domain", "type", "service", "id", "layer name", "_desc", "_crs"]
+ROWS = [
+    ["data.linz.govt.nz", "layer", "WFS", "50772", "NZ Primary Parcels", "", []],
+    ["data.linz.govt.nz", "layer", "WMTS", "9", "NZ Aerial Imagery", "", []],
+    ["data.mfe.govt.nz", "layer", "WFS", "52150", "Parcel Boundaries", "a", ["1"]],
+    ["data.mfe.govt.nz", "table", "WFS", "layer-52151", None, "", []],
+    ["data.mfe.govt.nz", "layer", "WFS", "100", "Land Cover", "", ["1"]],
+]
+
+
+class LoadedFeed:
+    """
+    Stand in for a ServiceData instance that has loaded
+    """
+
+    disabled = False
+    err = None
+
+    def __init__(self, rows, content_hash="hash"):
+        self.info = rows
+        self.doc_hash = content_hash
+
+    def content_hash(self):
+        return self.doc_hash
+
+    def row_texts(self):
+        return [(str(row[4]), row[5]) for row in self.info]
+
+
+class TableModelTest(unittest.TestCase):
+    """
+    Test the table's model
+    """
+
+    def setUp(self):
+        """
+        Runs before each test
+        """
+
+        self.model = TableModel(ROWS, HEADERS)
+        self.proxy = CustomSortFilterProxyModel()
+        self.proxy.setSourceModel(self.model)
+
+    def column(self, column):
+        return [
+            self.proxy.data(self.proxy.index(row, column), Qt.DisplayRole)
+            for row in range(self.proxy.rowCount())
+        ]
+
+    def test_display(self):
+        """
+        Test cells display strings and rows are returned whole
+        """
+
+        self.assertEqual(self.proxy.columnCount(), 5)
+        self.assertEqual(self.column(4)[3], "None")
+        self.assertEqual(self.model.selectedRow(2), ROWS[2])
+        self.assertIs(self.model.crs[2], self.model.crs[4])
+        self.assertEqual(self.model.data(self.model.index(0, 3), SORT_ROLE), 50772)
+
+    def test_sort(self):
+        """
+        Test ids sort as numbers, before any that are not
+        """
+
+        self.proxy.sort(3, Qt.AscendingOrder)
+        self.assertEqual(self.column(3), ["9", "100", "50772", "52150", "layer-52151"])
+        self.proxy.sort(4, Qt.DescendingOrder)
+        self.assertEqual(self.column(3)[0], "52150")
+        self.assertEqual(self.model.selectedRow(0), ROWS[2])
+
+    def test_ranked_sort(self):
+        """
+        Test the most relevant rows come first, then the sort order applies
+        """
+
+        self.proxy.sort(3, Qt.DescendingOrder)
+        self.proxy.set_filter_text("parcel")
+        # "Parcel Boundaries" matches the title's first word exactly
+        self.assertEqual(self.column(3), ["52150", "50772"])
+        self.proxy.set_filter_text("")
+        self.assertEqual(self.column(3), ["layer-52151", "52150", "50772", "100", "9"])
+
+    def test_filter_hides_rows(self):
+        """
+        Test the model itself drops the rows filtered out, and the
+        indexes held on them
+        """
+
+        held = QPersistentModelIndex(self.model.index(1, 3))
+        kept = QPersistentModelIndex(self.model.index(2, 3))
+        self.proxy.set_filter_text("mfe")
+        self.assertEqual(self.model.rowCount(QModelIndex()), 3)
+        self.assertFalse(held.isValid())
+        self.assertEqual(kept.row(), 0)
+        self.assertEqual(self.model.selectedRow(0), ROWS[2])
+        self.proxy.set_filter_text("")
+        self.assertEqual(self.model.rowCount(QModelIndex()), 5)
+
+    def test_append_sorted(self):
+        """
+        Test appended rows take their place in the sorted table
+        """
+
+        self.model.setData(ROWS[:2], [TokenSegment.from_rows(ROWS[:2])])
+        self.proxy.sort(3, Qt.AscendingOrder)
+        self.model.appendData(ROWS[2:], TokenSegment.from_rows(ROWS[2:]))
+        self.assertEqual(self.column(3), ["9", "100", "50772", "52150", "layer-52151"])
+        self.model.clearData()
+        self.assertEqual(self.proxy.rowCount(), 0)
+
+    def test_refresh(self):
+        """
+        Test a refresh only signals the rows removed, added and changed
+        """
+
+        signals = []
+        for signal in ("rowsRemoved", "rowsInserted", "dataChanged", "layoutChanged"):
+            getattr(self.model, signal).connect(
+                lambda *args, signal=signal: signals.append(signal)
+            )
+        self.proxy.sort(3, Qt.AscendingOrder)
+        signals.clear()
+        rows = [list(row) for row in ROWS]
+        rows[0][4] = "NZ Parcels"
+        del rows[2]
+        rows.append(["data.mfe.govt.nz", "layer", "WFS", "53000", "Lakes", "", []])
+        self.model.setData(rows, [TokenSegment.from_rows(rows)])
+        self.assertEqual(
+            sorted(signals), ["dataChanged", "rowsInserted", "rowsRemoved"]
+        )
+        self.assertEqual(self.column(3), ["9", "100", "50772", "53000", "layer-52151"])
+        self.assertEqual(self.column(4)[2], "NZ Parcels")
+
+    def test_refresh_moves_rows(self):
+        """
+        Test rows of a refresh are moved to their new sort position
+        """
+
+        self.proxy.sort(4, Qt.AscendingOrder)
+        rows = [list(row) for row in ROWS]
+        rows[1][4] = "A Aerial Imagery"
+        self.assertEqual(self.column(3), ["100", "9", "50772", "layer-52151", "52150"])
+        self.model.setData(rows, [TokenSegment.from_rows(rows)])
+        self.assertEqual(self.column(3), ["9", "100", "50772", "layer-52151", "52150"])
+        self.assertEqual(longest_increasing([3, 0, 1, 4, 2, 5]), [1, 2, 4, 5])
+
+    def test_refresh_not_appended(self):
+        """
+        Test a cache update of a populated table does not append
+        the rows of each feed as it loads
+        """
+
+        task = CatalogueLoadTask([], update_cache=True)
+        task.feedLoaded.connect(self.model.appendData)
+        feed = LoadedFeed([list(row) for row in ROWS])
+        task.feed_processed(feed, 1, 1)
+        self.assertEqual(self.proxy.rowCount(), len(ROWS))
+        self.model.setData(feed.info, [task.feed_segments[feed]])
+        self.assertEqual(self.proxy.rowCount(), len(ROWS))
+
+    def test_unchanged_feed_segment_reused(self):
+        """
+        Test the search index tokens of a feed whose doc is
+        unchanged since the previous load are not built again
+        """
+
+        task = CatalogueLoadTask([], update_cache=True)
+        feed = LoadedFeed([list(row) for row in ROWS])
+        task.feed_processed(feed, 1, 1)
+        segment = task.feed_segments[feed]
+
+        task = CatalogueLoadTask([], True, previous_segments=task.hashed_segments)
+        unchanged = LoadedFeed([list(row) for row in ROWS])
+        changed = LoadedFeed([list(row) for row in ROWS[:2]], "changed")
+        task.feed_processed(unchanged, 1, 2)
+        task.feed_processed(changed, 2, 2)
+        self.assertIs(task.feed_segments[unchanged], segment)
+        self.assertIsNot(task.feed_segments[changed], segment)
+        self.assertEqual(task.feed_segments[changed].length, 2)
+        self.assertEqual(set(task.hashed_segments), {"hash", "changed"})
+
+    def test_failed_refresh_keeps_rows(self):
+        """
+        Test a refresh that raises is reported as failed, rather than
+        as loaded with no rows, so the table keeps its rows
+        """
+
+        # no workers to process the feeds with
+        task = CatalogueLoadTask([], True, max_workers=0, parse_processes=0)
+        task.loaded.connect(
+            lambda rows, segments, *_args: self.model.setData(rows, segments)
+        )
+        failures = []
+        task.failed.connect(lambda *args: failures.append(args))
+        task.finished(task.run())
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0][0].startswith("Error: "))
+        self.assertTrue(failures[0][1])
+        self.assertEqual(self.proxy.rowCount(), len(ROWS))
+
+    def test_cancelled_load_reported(self):
+        """
+        Test a load that did not complete is reported as failed
+        """
+
+        task = CatalogueLoadTask([])
+        failures = []
+        task.failed.connect(lambda *args: failures.append(args))
+        task.finished(False)
+        self.assertEqual(failures, [("Loading datasets was cancelled", False)])
+
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(unittest.makeSuite(TableModelTest, "test"))
+    return test_suite
+
+
+def run_tests():
+    unittest.TextTestRunner(verbosity=3).run(suite())
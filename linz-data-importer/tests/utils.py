@@ -0,0 +1,37 @@
+"""
+/***************************************************************************
+ LINZ Data Importer
+                                 A QGIS plugin
+ Import LINZ (and others) OGC Datasets into QGIS
+                              -------------------
+        begin                : 2018-04-07
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Land Information New Zealand
+        email                : splanzer@linz.govt.nz
+ ***************************************************************************/
+/***************************************************************************
+ *   This program is released under the terms of the 3 clause BSD license. *
+ *   see the LICENSE file for more information                             *
+ ***************************************************************************/
+"""
+
+from qgis.PyQt.QtTest import QTest  # pylint:disable=import-error
+
+LOAD_TIMEOUT = 60000
+
+
+def wait_for_load(ldi, timeout=LOAD_TIMEOUT):
+    """
+    Catalogue loading runs as a background task. Process
+    events until the plugin's load task has finished
+
+    :param ldi: LinzDataImporter plugin instance
+    :type ldi: LinzDataImporter
+    :param timeout: max milliseconds to wait
+    :type timeout: int
+    """
+
+    waited = 0
+    while ldi.load_task and waited < timeout:
+        QTest.qWait(100)
+        waited += 100